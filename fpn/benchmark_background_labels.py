@@ -0,0 +1,76 @@
+# --------------------------------------------------------
+# Deformable Convolutional Networks
+# Copyright (c) 2017 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""
+Time the rpn labels of an image without gt boxes: _sample_rows against npr.choice over all
+inside anchors, the shared zero bbox maps against fresh ones, and assign_pyramid_anchor.
+"""
+
+import _init_paths
+
+import argparse
+import time
+import numpy as np
+import numpy.random as npr
+
+from config.config import config, update_config
+from rpn.rpn import assign_pyramid_anchor, _sample_rows, _get_zero_bbox_maps
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark rpn labels of gt free images')
+    parser.add_argument('--cfg', help='experiment configure file name', required=True, type=str)
+    parser.add_argument('--height', help='network input height', default=608, type=int)
+    parser.add_argument('--width', help='network input width', default=1024, type=int)
+    parser.add_argument('--repeat', help='timed runs per setting', default=20, type=int)
+    args = parser.parse_args()
+    update_config(args.cfg)
+    return args
+
+
+def mean_ms(fn, repeat):
+    fn()
+    tic = time.time()
+    for _ in range(repeat):
+        fn()
+    return (time.time() - tic) / repeat * 1e3
+
+
+def main():
+    args = parse_args()
+    npr.seed(0)
+    strides = config.network.RPN_FEAT_STRIDE
+    feat_shapes = [[(1, 1, int(np.ceil(args.height / float(s))), int(np.ceil(args.width / float(s))))] for s in strides]
+    im_info = np.array([[args.height, args.width, 1.0]], dtype=np.float32)
+    gt_boxes = np.zeros((0, 6), dtype=np.float32)
+    A = len(config.network.ANCHOR_SCALES) * len(config.network.ANCHOR_RATIOS)
+    num_cells = config.CROP_NUM ** 2 * sum([shape[0][2] * shape[0][3] for shape in feat_shapes])
+    num_rows = A * num_cells
+    num_samples = config.TRAIN.RPN_BATCH_SIZE
+    print('%dx%d input, %d crops, %d anchors, mean of %d runs' % (args.width, args.height, config.CROP_NUM ** 2,
+                                                                 num_rows, args.repeat))
+
+    rows = _sample_rows(num_rows, num_samples)
+    assert len(np.unique(rows)) == num_samples and np.all(np.diff(rows) > 0)
+    choice_ms = mean_ms(lambda: np.sort(npr.choice(num_rows, size=num_samples, replace=False)), args.repeat)
+    sample_ms = mean_ms(lambda: _sample_rows(num_rows, num_samples), args.repeat)
+    print('%d of %d rows: npr.choice %.2f ms, _sample_rows %.3f ms (%.0fx)' % (num_samples, num_rows, choice_ms,
+                                                                            sample_ms, choice_ms / sample_ms))
+
+    zeros_ms = mean_ms(lambda: [np.zeros((1, A * 4, num_cells), dtype=np.float32) for _ in range(2)], args.repeat)
+    shared_ms = mean_ms(lambda: _get_zero_bbox_maps(A, num_cells), args.repeat)
+    print('bbox_target + bbox_weight (1, %d, %d): np.zeros %.2f ms, _get_zero_bbox_maps %.3f ms'
+          % (A * 4, num_cells, zeros_ms, shared_ms))
+
+    def label():
+        return assign_pyramid_anchor(feat_shapes, gt_boxes, im_info, config, feat_strides=strides,
+                                     scales=config.network.ANCHOR_SCALES, ratios=config.network.ANCHOR_RATIOS,
+                                     allowed_border=np.inf)
+    assert np.sum(label()['label'] == 0) == num_samples
+    print('assign_pyramid_anchor without gt boxes: %.2f ms' % mean_ms(label, args.repeat))
+
+if __name__ == '__main__':
+    main()
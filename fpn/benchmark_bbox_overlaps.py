@@ -0,0 +1,66 @@
+# --------------------------------------------------------
+# Deformable Convolutional Networks
+# Copyright (c) 2017 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""
+Time bbox_overlaps of the anchors of one crop against its gt boxes, one call per pyramid
+level as in _crop_block_overlaps: the dense kernel against the x1 sorted one.
+"""
+
+import _init_paths
+
+import argparse
+import time
+import numpy as np
+
+from bbox.bbox_transform import bbox_overlaps, bbox_overlaps_sparse
+from rpn.anchor_grid import get_anchor_grid
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark bbox_overlaps kernels')
+    parser.add_argument('--height', help='network input height', default=608, type=int)
+    parser.add_argument('--width', help='network input width', default=1024, type=int)
+    parser.add_argument('--repeat', help='timed runs per setting', default=5, type=int)
+    args = parser.parse_args()
+    return args
+
+
+def mean_ms(fn, repeat):
+    fn()
+    tic = time.time()
+    for _ in range(repeat):
+        fn()
+    return (time.time() - tic) / repeat * 1e3
+
+
+def main():
+    args = parse_args()
+    rng = np.random.RandomState(0)
+    scales = np.array([8])
+    ratios = np.array([0.5, 1, 2])
+    levels = [get_anchor_grid(args.height // stride, args.width // stride, stride, scales, ratios)
+              for stride in (4, 8, 16, 32, 64)]
+    print('%d anchors of a %dx%d crop, mean of %d runs' % (sum([len(x) for x in levels]), args.width, args.height,
+                                                           args.repeat))
+    for num_gt in (2, 5, 20, 100):
+        x1 = rng.uniform(0, args.width - 64, num_gt)
+        y1 = rng.uniform(0, args.height - 64, num_gt)
+        side = rng.uniform(4, 64, (num_gt, 2))
+        gt_boxes = np.stack([x1, y1, x1 + side[:, 0], y1 + side[:, 1]], axis=1)
+        for anchors in levels:
+            dense = bbox_overlaps(anchors, gt_boxes)
+            assert np.abs(bbox_overlaps(anchors, gt_boxes, kernel='sorted') - dense).max() < 1e-12
+
+        def run(kernel):
+            return lambda: [bbox_overlaps(anchors, gt_boxes, kernel=kernel) for anchors in levels]
+        dense_ms = mean_ms(run('dense'), args.repeat)
+        sorted_ms = mean_ms(run('sorted'), args.repeat)
+        sparse_ms = mean_ms(lambda: [bbox_overlaps_sparse(anchors, gt_boxes) for anchors in levels], args.repeat)
+        print('%3d gt boxes: dense %.1f ms, sorted %.1f ms (%.1fx), sparse %.1f ms (%.1fx)'
+              % (num_gt, dense_ms, sorted_ms, dense_ms / sorted_ms, sparse_ms, dense_ms / sparse_ms))
+
+if __name__ == '__main__':
+    main()
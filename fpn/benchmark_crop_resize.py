@@ -0,0 +1,101 @@
+# --------------------------------------------------------
+# Deformable Convolutional Networks
+# Copyright (c) 2017 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""
+Time tiling and resizing one image: crop_image + resize_crop against the former
+per tile copy into int64 and per 3 channel group resize through float32/float64.
+"""
+
+import _init_paths
+
+import argparse
+import time
+import cv2
+import numpy as np
+from math import floor
+
+from utils.image import crop_image, get_crop_grid, resize_crop
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark crop_image and resize_crop')
+    parser.add_argument('--height', help='source image height', default=1944, type=int)
+    parser.add_argument('--width', help='source image width', default=2592, type=int)
+    parser.add_argument('--stride', help='IMAGE_STRIDE to pad to', default=32, type=int)
+    parser.add_argument('--repeat', help='timed runs per setting', default=5, type=int)
+    args = parser.parse_args()
+    return args
+
+
+def loop_crop_image(img, n):
+    height, width, channel = img.shape[:]
+    grid_h = floor(height * 1.0 / (n - 1))
+    grid_w = floor(width * 1.0 / (n - 1))
+    step_h = floor(height * float(n - 2) / float(pow((n - 1), 2)))
+    step_w = floor(width * float(n - 2) / float(pow((n - 1), 2)))
+    croped_image = np.zeros((int(grid_h), int(grid_w), pow(n, 2) * channel), dtype=int)
+    for i in range(n):
+        for j in range(n):
+            rect = [i * step_h, j * step_w, i * step_h + grid_h, j * step_w + grid_w]
+            croped_img = img[int(rect[0]):int(rect[2]), int(rect[1]):int(rect[3]), :]
+            croped_image[:, :, (i * n + j) * channel:(i * n + j + 1) * channel] = croped_img[:, :, :]
+    return croped_image
+
+
+def loop_resize_crop(im, target_size, max_size, stride=0, interpolation=cv2.INTER_LINEAR):
+    im_shape = im.shape
+    im_size_min = np.min(im_shape[0:2])
+    im_size_max = np.max(im_shape[0:2])
+    im_scale = float(target_size) / float(im_size_min)
+    if np.round(im_scale * im_size_max) > max_size:
+        im_scale = float(max_size) / float(im_size_max)
+    channel = im.shape[2]
+    t_im = cv2.resize(im[:, :, 0].astype(np.float32), None, None, fx=im_scale, fy=im_scale, interpolation=interpolation)
+    n_im = np.zeros((t_im.shape[0], t_im.shape[1], channel), dtype=int)
+    for i in range(channel // 3):
+        n_im[:, :, i * 3:(i + 1) * 3] = cv2.resize(im[:, :, i * 3:(i + 1) * 3].astype(np.float32), None, None,
+                                                   fx=im_scale, fy=im_scale, interpolation=interpolation)
+    im = n_im
+    if stride == 0:
+        return im, im_scale
+    im_height = int(np.ceil(im.shape[0] / float(stride)) * stride)
+    im_width = int(np.ceil(im.shape[1] / float(stride)) * stride)
+    padded_im = np.zeros((im_height, im_width, im.shape[2]))
+    padded_im[:im.shape[0], :im.shape[1], :] = im
+    return padded_im, im_scale
+
+
+def mean_ms(fn, repeat):
+    fn()
+    tic = time.time()
+    for _ in range(repeat):
+        fn()
+    return (time.time() - tic) / repeat * 1e3
+
+
+def main():
+    args = parse_args()
+    rng = np.random.RandomState(0)
+    img = rng.randint(0, 256, (args.height, args.width, 3)).astype(np.uint8)
+    print('%dx%d source, stride %d, mean of %d runs' % (args.width, args.height, args.stride, args.repeat))
+    for n in (3, 4):
+        grid = get_crop_grid(args.height, args.width, n)
+        tiles = np.empty((grid[0], grid[1], 3 * n * n), dtype=np.uint8)
+        for target_size, max_size in ((600, 1000), (1000, 1667)):
+            def loop():
+                return loop_resize_crop(loop_crop_image(img, n), target_size, max_size, stride=args.stride)
+
+            def current():
+                return resize_crop(crop_image(img, n, out=tiles), target_size, max_size, stride=args.stride)
+
+            old, new = loop()[0], current()[0]
+            assert old.shape == new.shape and np.abs(old - new).max() <= 1
+            old_ms, new_ms = mean_ms(loop, args.repeat), mean_ms(current, args.repeat)
+            print('%dx%d @%d/%d: %.1f ms -> %.1f ms (%.1fx)' % (n, n, target_size, max_size, old_ms, new_ms,
+                                                              old_ms / new_ms))
+
+if __name__ == '__main__':
+    main()
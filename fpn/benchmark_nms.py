@@ -0,0 +1,71 @@
+# --------------------------------------------------------
+# Deformable Convolutional Networks
+# Copyright (c) 2017 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""
+Time the nms of the proposal layer for one image: clustered proposals of the 9 crop channels,
+batched_nms_wrapper of every built backend against the python nms run per channel.
+"""
+
+import _init_paths
+
+import argparse
+import time
+import numpy as np
+
+from nms.nms import nms, batched_nms_wrapper, cpu_nms, gpu_nms
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark nms backends')
+    parser.add_argument('--gpu', help='gpu of gpu_nms', default=0, type=int)
+    parser.add_argument('--thresh', help='nms threshold', default=0.7, type=float)
+    parser.add_argument('--repeat', help='timed runs per setting', default=5, type=int)
+    args = parser.parse_args()
+    return args
+
+
+def mean_ms(fn, repeat):
+    fn()
+    tic = time.time()
+    for _ in range(repeat):
+        fn()
+    return (time.time() - tic) / repeat * 1e3
+
+
+def proposals(rng, num, crops=9, size=1000):
+    centers = rng.uniform(0, size, (max(num // 50, 1), 2))
+    xy = centers[rng.randint(0, len(centers), num)] + rng.normal(0, 30, (num, 2))
+    wh = rng.uniform(16, 256, (num, 2))
+    dets = np.hstack((xy, xy + wh, rng.rand(num, 1))).astype(np.float32)
+    return dets, rng.randint(0, crops, num)
+
+
+def main():
+    args = parse_args()
+    rng = np.random.RandomState(0)
+    backends = ['numpy'] + (['cpu'] if cpu_nms is not None else []) + (['gpu'] if gpu_nms is not None else [])
+    print('nms %.1f, 9 crop channels, mean of %d runs' % (args.thresh, args.repeat))
+    for pre_nms, post_nms in ((12000, 2000), (6000, 300)):
+        dets, groups = proposals(rng, pre_nms)
+        max_keep = post_nms // 9
+
+        def per_channel():
+            keep = []
+            for group in range(9):
+                inds = np.where(groups == group)[0]
+                keep.extend(inds[nms(dets[inds], args.thresh)[:max_keep]])
+            return keep
+        expected = per_channel()
+        timings = ['python nms %.1f ms' % mean_ms(per_channel, args.repeat)]
+        for backend in backends:
+            device_id = args.gpu if backend == 'gpu' else None
+            batched = batched_nms_wrapper(backend, args.thresh, device_id, max_keep)
+            assert list(batched(dets, groups)) == expected
+            timings.append('%s %.1f ms' % (backend, mean_ms(lambda: batched(dets, groups), args.repeat)))
+        print('%d -> %d: %s' % (pre_nms, post_nms, ', '.join(timings)))
+
+if __name__ == '__main__':
+    main()
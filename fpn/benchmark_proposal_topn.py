@@ -0,0 +1,113 @@
+# --------------------------------------------------------
+# Deformable Convolutional Networks
+# Copyright (c) 2017 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""
+Time the proposals of one image in PyramidProposalOperator: the pre-nms top N picked per level
+before decoding, with and without pre_nms_per_level, against decoding every anchor of every level.
+"""
+
+import _init_paths
+
+import argparse
+import time
+import numpy as np
+import numpy.random as npr
+
+from bbox.bbox_transform import bbox_pred, clip_boxes
+from nms.nms import batched_nms_wrapper
+from operator_py.pyramid_proposal import PyramidProposalOperator, CROP_NUMS
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the pre-nms top N of the proposal layer')
+    parser.add_argument('--height', help='network input height', default=608, type=int)
+    parser.add_argument('--width', help='network input width', default=1024, type=int)
+    parser.add_argument('--min_size', help='rpn min size', default=16, type=int)
+    parser.add_argument('--repeat', help='timed runs per setting', default=5, type=int)
+    args = parser.parse_args()
+    return args
+
+
+def mean_ms(fn, repeat):
+    fn()
+    tic = time.time()
+    for _ in range(repeat):
+        fn()
+    return (time.time() - tic) / repeat * 1e3
+
+
+def decode_all_proposals(op, cls_prob_dict, bbox_pred_dict, im_info, nms, pre_nms_topN, post_nms_topN, min_size):
+    """ _image_proposals before the per level top N: every anchor is decoded, filtered and sorted """
+    proposal_list, score_list, channel_list = [], [], []
+    A = op._num_anchors
+    for s in op._feat_stride:
+        stride = int(s)
+        height, width = int(im_info[0] / stride), int(im_info[1] / stride)
+        anchors, channels = op._anchors(stride, height, width)
+        num_rows = anchors.shape[0]
+        scores = op._clip_pad(cls_prob_dict['stride' + str(s)][:, A:, :, :], (height, width))
+        scores = scores.transpose((0, 2, 3, 1)).reshape(-1)[:num_rows]
+        bbox_deltas = op._clip_pad(bbox_pred_dict['stride' + str(s)], (height, width))
+        bbox_deltas = bbox_deltas.transpose((0, 2, 3, 1)).reshape((-1, 4))[:num_rows]
+        proposals = clip_boxes(bbox_pred(anchors, bbox_deltas), im_info[:2])
+        keep = op._filter_boxes(proposals, min_size * im_info[2])
+        proposal_list.append(proposals[keep, :])
+        score_list.append(scores[keep].reshape((-1, 1)))
+        channel_list.append(channels[keep])
+    proposals = np.vstack(proposal_list)
+    scores = np.vstack(score_list)
+    channels = np.concatenate(channel_list).astype(int)
+    order = scores.ravel().argsort()[::-1][:pre_nms_topN]
+    proposals, scores, channels = proposals[order, :], scores[order], channels[order]
+    det = np.hstack((proposals, scores)).astype(np.float32)
+    keeps = op._channel_keeps(nms(det, channels), channels, int(post_nms_topN / CROP_NUMS))
+    return proposals[keeps, :], scores[keeps]
+
+
+def main():
+    args = parse_args()
+    rng = np.random.RandomState(0)
+    strides = (4, 8, 16, 32, 64)
+    A = 3
+    shapes = [(1, 2 * A * CROP_NUMS, int(np.ceil(args.height / float(s))), int(np.ceil(args.width / float(s))))
+              for s in strides]
+    # scores distinct over all levels, so every path ranks the rows the same way
+    sizes = [int(np.prod(shape)) for shape in shapes]
+    scores = np.split((rng.permutation(sum(sizes)) / float(sum(sizes))).astype(np.float32), np.cumsum(sizes)[:-1])
+    cls_prob_dict, bbox_pred_dict = {}, {}
+    for s, shape, level_scores in zip(strides, shapes, scores):
+        cls_prob_dict['stride' + str(s)] = level_scores.reshape(shape)
+        bbox_pred_dict['stride' + str(s)] = rng.normal(0, 0.2, (1, 4 * A * CROP_NUMS) + shape[2:]).astype(np.float32)
+    im_info = np.array([args.height, args.width, 1.0], dtype=np.float32)
+    print('%dx%d input, %d crops, min size %d, mean of %d runs' % (args.width, args.height, CROP_NUMS, args.min_size,
+                                                                 args.repeat))
+
+    for pre_nms_topN, post_nms_topN in ((12000, 2000), (6000, 300)):
+        nms = batched_nms_wrapper('numpy', 0.7, max_keep=post_nms_topN // CROP_NUMS)
+        ops = [PyramidProposalOperator(str(strides), '(8)', '(0.5, 1, 2)', False, pre_nms_topN, post_nms_topN, 0.7,
+                                       args.min_size, 'numpy', per_level) for per_level in (False, True)]
+
+        def run(op):
+            return lambda: op._image_proposals(cls_prob_dict, bbox_pred_dict, 0, im_info, nms, pre_nms_topN,
+                                               post_nms_topN, args.min_size)
+
+        def decode_all():
+            return decode_all_proposals(ops[0], cls_prob_dict, bbox_pred_dict, im_info, nms, pre_nms_topN,
+                                        post_nms_topN, args.min_size)
+        npr.seed(0)
+        expected = decode_all()
+        npr.seed(0)
+        proposals, scores = run(ops[0])()
+        assert np.array_equal(proposals, expected[0]) and np.array_equal(scores, expected[1])
+
+        all_ms = mean_ms(decode_all, args.repeat)
+        top_ms = mean_ms(run(ops[0]), args.repeat)
+        level_ms = mean_ms(run(ops[1]), args.repeat)
+        print('%d -> %d: decode all %.1f ms, top N per level %.1f ms (%.1fx), pre_nms_per_level %.1f ms'
+              % (pre_nms_topN, post_nms_topN, all_ms, top_ms, all_ms / top_ms, level_ms))
+
+if __name__ == '__main__':
+    main()
@@ -24,6 +24,15 @@ config.gpus = ''
 config.CLASS_AGNOSTIC = True
 config.SCALES = [(600, 1000)]  # first is scale (the shorter side); second is max size
 config.CROP_NUM = 3
+# 'crop_first' resizes every full resolution tile, 'resize_first' resizes the image once and tiles it
+config.CROP_PIPELINE = 'crop_first'
+# byte budget of the in-process LRU cache of resized tile stacks, 0 disables it
+config.TILE_CACHE_BYTES = 0
+# byte budget of each LRU cache of anchor grids, inside anchor indices, zero bbox target maps
+# and proposal layer anchors
+config.ANCHOR_CACHE_BYTES = 256 * 1024 * 1024
+# directory of tile shards written by make_tile_shards.py, '' decodes the images
+config.TILE_SHARD_PATH = ''
 config.TEST_SCALES = [(600, 1000)]
 # default training
 config.default = edict()
@@ -36,6 +45,8 @@ config.network.pretrained = ''
 config.network.pretrained_epoch = 0
 config.network.PIXEL_MEANS = np.array([0, 0, 0])
 config.network.IMAGE_STRIDE = 0
+# feed uint8 BGR tiles and normalize them inside the symbol
+config.network.DEVICE_NORMALIZE = False
 config.network.RPN_FEAT_STRIDE = 16
 config.network.RCNN_FEAT_STRIDE = 16
 config.network.FIXED_PARAMS = []
@@ -102,6 +113,12 @@ config.TRAIN.BATCH_IMAGES = 2
 config.TRAIN.END2END = False
 # group images with similar aspect ratio
 config.TRAIN.ASPECT_GROUPING = True
+# worker processes assembling batches, 0 prefetches in a thread
+config.TRAIN.LOADER_WORKERS = 0
+# batches prefetched ahead of the training loop
+config.TRAIN.LOADER_DEPTH = 2
+# worker processes assembling the per device slices of a batch, 0 assembles them in turn
+config.TRAIN.SLICE_WORKERS = 0
 
 # R-CNN
 # rcnn rois batch size
@@ -127,12 +144,25 @@ config.TRAIN.RPN_CLOBBER_POSITIVES = False
 # rpn bounding box regression params
 config.TRAIN.RPN_BBOX_WEIGHTS = (1.0, 1.0, 1.0, 1.0)
 config.TRAIN.RPN_POSITIVE_WEIGHT = -1.0
+# bbox_overlaps kernel for anchor assignment: 'dense', or 'sorted' which prunes pairs apart along x
+# and wins once a crop holds tens of gt boxes
+config.TRAIN.RPN_OVERLAPS_KERNEL = 'dense'
+# directory caching anchor labels before subsampling, '' disables it
+config.TRAIN.RPN_LABEL_CACHE = ''
+# ship the RPN_BATCH_SIZE sampled anchors instead of dense rpn label maps, densified in the symbol
+config.TRAIN.RPN_SPARSE_LABEL = False
 
 # used for end2end training
 # RPN proposal
 config.TRAIN.CXX_PROPOSAL = True
+# pyramid_proposal_nd: the proposal layer in NDArray ops on the device instead of numpy on the host
+config.TRAIN.RPN_PROPOSAL_ND = False
 config.TRAIN.RPN_NMS_THRESH = 0.7
+# nms of the proposal layer: 'auto' (gpu_nms on gpu contexts, numpy on cpu), 'gpu', 'cpu' (Cython cpu_nms) or 'numpy'
+config.TRAIN.RPN_NMS_BACKEND = 'auto'
 config.TRAIN.RPN_PRE_NMS_TOP_N = 12000
+# RPN_PRE_NMS_TOP_N proposals of every pyramid level go to nms instead of the RPN_PRE_NMS_TOP_N best of all levels
+config.TRAIN.RPN_PRE_NMS_PER_LEVEL = False
 config.TRAIN.RPN_POST_NMS_TOP_N = 2000
 config.TRAIN.RPN_MIN_SIZE = config.network.RPN_FEAT_STRIDE
 # approximate bounding box regression
@@ -147,13 +177,22 @@ config.TEST = edict()
 config.TEST.HAS_RPN = False
 # size of images for each device
 config.TEST.BATCH_IMAGES = 1
+# worker processes assembling batches, 0 prefetches in a thread
+config.TEST.LOADER_WORKERS = 0
+config.TEST.LOADER_DEPTH = 2
 
 # RPN proposal
 config.TEST.CXX_PROPOSAL = True
+config.TEST.RPN_PROPOSAL_ND = False
 config.TEST.RPN_NMS_THRESH = 0.7
+config.TEST.RPN_NMS_BACKEND = 'auto'
 config.TEST.RPN_PRE_NMS_TOP_N = 6000
+config.TEST.RPN_PRE_NMS_PER_LEVEL = False
 config.TEST.RPN_POST_NMS_TOP_N = 300
 config.TEST.RPN_MIN_SIZE = config.network.RPN_FEAT_STRIDE
+# (height, width) input sizes the proposal layer makes its anchors for when it is created, only the first
+# few are used; test_rcnn fills in the sizes of the test images at every test scale, most common first, if empty
+config.TEST.RPN_PREWARM_SHAPES = []
 
 # RPN generate proposal
 config.TEST.PROPOSAL_NMS_THRESH = 0.7
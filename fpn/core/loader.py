@@ -11,28 +11,79 @@
 # https://github.com/ijkguo/mx-rcnn/
 # --------------------------------------------------------
 
+import logging
 import numpy as np
 import mxnet as mx
+from mxnet.io import DataDesc
 from mxnet.executor_manager import _split_input_slice
 
 from config.config import config
 from rpn.rpn import get_rpn_testbatch, get_rpn_batch, assign_pyramid_anchor
 from rcnn import get_rcnn_testbatch
+from utils.image import tensor_vstack, get_crop_shape
+from utils.tile_cache import get_tile_cache
+from utils.slice_pool import SlicePool, map_serial
 
 
-def par_assign_anchor_wrapper(cfg, iroidb, feat_sym, feat_strides, anchor_scales, anchor_ratios, allowed_border):
+def _as_nd(array):
+    # uint8 tiles go to the device as they are and are normalized by the symbol,
+    # int32 sparse rpn label indices stay exact
+    if array.dtype in (np.uint8, np.int32):
+        return mx.nd.array(array, dtype=array.dtype)
+    return mx.nd.array(array)
+
+
+class FeatureShapeCache(object):
+    """
+    output shapes of the pyramid feature symbols, memoized by the padded input size
+    shapes are those of a batch of one image; the loader only uses their spatial size
+    """
+    def __init__(self, feat_sym):
+        self.feat_sym = feat_sym
+        self._shapes = {}
+
+    def __len__(self):
+        return len(self._shapes)
+
+    def get(self, data_shape):
+        """
+        :param data_shape: (num_images, channels, height, width) of 'data'
+        :return: [infer_shape output shapes of every feat_sym]
+        """
+        key = tuple(data_shape[1:])
+        feat_shape = self._shapes.get(key)
+        if feat_shape is None:
+            feat_shape = [x.infer_shape(data=(1,) + key)[1] for x in self.feat_sym]
+            self._shapes[key] = feat_shape
+        return feat_shape
+
+    def prewarm(self, roidb, cfg):
+        """ resolve the input size of every image of roidb at every scale in cfg.SCALES """
+        channels = 3 * cfg.CROP_NUM * cfg.CROP_NUM
+        im_sizes = set([(int(r['height']), int(r['width'])) for r in roidb])
+        for height, width in im_sizes:
+            for scale in cfg.SCALES:
+                self.get((1, channels) + get_crop_shape(height, width, scale, cfg))
+
+
+def par_assign_anchor_wrapper(cfg, iroidb, feat_shapes, feat_strides, anchor_scales, anchor_ratios, allowed_border):
     # get testing data for multigpu
     data, rpn_label = get_rpn_batch(iroidb, cfg)
-    data_shape = {k: v.shape for k, v in data.items()}
-    del data_shape['im_info']
 
-    # add gt_boxes to data for e2e
-    data['gt_boxes'] = rpn_label['gt_boxes'][np.newaxis, :, :]
+    # add gt_boxes to data for e2e, (num_images, max num_boxes, 6) padded with -1 rows
+    data['gt_boxes'] = tensor_vstack([gt_boxes[np.newaxis, :, :] for gt_boxes in rpn_label['gt_boxes']], pad=-1)
     #print "data['gt_boxes']"+str(data['gt_boxes'].shape)
-    feat_shape = [y[1] for y in [x.infer_shape(**data_shape) for x in feat_sym]]
-    label = assign_pyramid_anchor(feat_shape, rpn_label['gt_boxes'], data['im_info'], cfg,
-                                  feat_strides, anchor_scales, anchor_ratios, allowed_border)
-    
+    # the images are padded to one size and share the feature shapes
+    feat_shape = feat_shapes.get(data['data'].shape)
+    labels = [assign_pyramid_anchor(feat_shape, gt_boxes, data['im_info'][i:i + 1], cfg,
+                                    feat_strides, anchor_scales, anchor_ratios, allowed_border)
+              for i, gt_boxes in enumerate(rpn_label['gt_boxes'])]
+    if len(labels) == 1:
+        # nothing to stack, keeps the shared zero targets of a gt free image uncopied
+        label = labels[0]
+    else:
+        label = dict((k, np.concatenate([l[k] for l in labels], axis=0)) for k in labels[0])
+
     return {'data': data, 'label': label}
 
 
@@ -71,7 +122,7 @@ class TestLoader(mx.io.DataIter):
 
     @property
     def provide_data(self):
-        return [[(k, v.shape) for k, v in zip(self.data_name, idata)] for idata in self.data]
+        return [[DataDesc(k, v.shape, v.dtype) for k, v in zip(self.data_name, idata)] for idata in self.data]
 
     @property
     def provide_label(self):
@@ -79,7 +130,7 @@ class TestLoader(mx.io.DataIter):
 
     @property
     def provide_data_single(self):
-        return [(k, v.shape) for k, v in zip(self.data_name, self.data[0])]
+        return [DataDesc(k, v.shape, v.dtype) for k, v in zip(self.data_name, self.data[0])]
 
     @property
     def provide_label_single(self):
@@ -91,18 +142,39 @@ class TestLoader(mx.io.DataIter):
             np.random.shuffle(self.index)
 
     def iter_next(self):
-        return self.cur < self.size
+        return self.has_batch(self.cur)
+
+    def has_batch(self, cur):
+        return cur < self.size
+
+    def batch_index(self, cur):
+        return self.index[cur:min(cur + self.batch_size, self.size)]
 
     def next(self):
         if self.iter_next():
-            self.get_batch()
-            self.cur += self.batch_size
-            return self.im_info, mx.io.DataBatch(data=self.data, label=self.label,
-                                   pad=self.getpad(), index=self.getindex(),
-                                   provide_data=self.provide_data, provide_label=self.provide_label)
+            return self.feed_batch(self.load_batch(self.batch_index(self.cur)))
         else:
             raise StopIteration
 
+    def load_batch(self, index):
+        """ numpy data of the roidb entries in index, safe to run in a worker process """
+        roidb = [self.roidb[i] for i in index]
+        if self.has_rpn:
+            data, label, im_info = get_rpn_testbatch(roidb, self.cfg)
+        else:
+            data, label, im_info = get_rcnn_testbatch(roidb, self.cfg)
+        return data, im_info
+
+    def feed_batch(self, batch):
+        """ take a batch of load_batch as the current one and advance """
+        data, im_info = batch
+        self.data = [[_as_nd(idata[name]) for name in self.data_name] for idata in data]
+        self.im_info = [np.array(x) for x in im_info]
+        self.cur += self.batch_size
+        return self.im_info, mx.io.DataBatch(data=self.data, label=self.label,
+                               pad=self.getpad(), index=self.getindex(),
+                               provide_data=self.provide_data, provide_label=self.provide_label)
+
     def getindex(self):
         return self.cur / self.batch_size
 
@@ -113,15 +185,8 @@ class TestLoader(mx.io.DataIter):
             return 0
 
     def get_batch(self):
-        cur_from = self.cur
-        cur_to = min(cur_from + self.batch_size, self.size)
-        roidb = [self.roidb[self.index[i]] for i in range(cur_from, cur_to)]
-        if self.has_rpn:
-            data, label, im_info = get_rpn_testbatch(roidb, self.cfg)
-        else:
-            data, label, im_info = get_rcnn_testbatch(roidb, self.cfg)
-        self.data = [[mx.nd.array(idata[name]) for name in self.data_name] for idata in data]
-        self.im_info = im_info
+        data, self.im_info = self.load_batch(self.batch_index(self.cur))
+        self.data = [[_as_nd(idata[name]) for name in self.data_name] for idata in data]
 
     def get_batch_individual(self):
         cur_from = self.cur
@@ -131,7 +196,7 @@ class TestLoader(mx.io.DataIter):
             data, label, im_info = get_rpn_testbatch(roidb, self.cfg)
         else:
             data, label, im_info = get_rcnn_testbatch(roidb, self.cfg)
-        self.data = [mx.nd.array(data[name]) for name in self.data_name]
+        self.data = [_as_nd(data[name]) for name in self.data_name]
         self.im_info = im_info
 
 
@@ -140,7 +205,6 @@ class TestLoader(mx.io.DataIter):
 
 class PyramidAnchorIterator(mx.io.DataIter):
 
-    # pool = Pool(processes=4)
     def __init__(self, feat_sym, roidb, cfg, batch_size=1, shuffle=False, ctx=None, work_load_list=None,
                  feat_strides=(4, 8, 16, 32, 64), anchor_scales=(8, ), anchor_ratios=(0.5, 1, 2), allowed_border=0,
                  aspect_grouping=False):
@@ -188,6 +252,8 @@ class PyramidAnchorIterator(mx.io.DataIter):
         #                   ['bbox_weight_p' + str(x) for x in self.feat_pyramid_level]
 
         self.label_name = ['label', 'bbox_target', 'bbox_weight']
+        if self.cfg.TRAIN.RPN_SPARSE_LABEL:
+            self.label_name += ['label_ind', 'bbox_ind']
 
         # status variable for synchronization between get_data and get_label
         self.cur = 0
@@ -195,28 +261,44 @@ class PyramidAnchorIterator(mx.io.DataIter):
         self.data = None
         self.label = None
 
+        # feature sizes of every image size and scale, so batches need no shape inference
+        self.feat_shapes = FeatureShapeCache(feat_sym)
+        self.feat_shapes.prewarm(roidb, cfg)
+        logging.info('resolved feature shapes of %d input sizes' % len(self.feat_shapes))
+
         # get first batch to fill in provide_data and provide_label
+        self.slice_pool = None
         self.reset()
         self.get_batch_parallel()
 
+        # assemble the device slices of a batch in worker processes, slots sized after the first batch
+        if self.cfg.TRAIN.SLICE_WORKERS > 0 and len(self.ctx) > 1:
+            arrays = sum(self.data, []) + sum(self.label, [])
+            slot_bytes = 2 * sum([x.size * np.dtype(x.dtype).itemsize for x in arrays]) // len(self.ctx)
+            self.slice_pool = SlicePool(self.load_slice, self.cfg.TRAIN.SLICE_WORKERS, len(self.ctx), slot_bytes)
+
     @property
     def provide_data(self):
-        return [[(k, v.shape) for k, v in zip(self.data_name, self.data[i])] for i in xrange(len(self.data))]
+        return [[DataDesc(k, v.shape, v.dtype) for k, v in zip(self.data_name, self.data[i])] for i in xrange(len(self.data))]
 
     @property
     def provide_label(self):
-        return [[(k, v.shape) for k, v in zip(self.label_name, self.label[i])] for i in xrange(len(self.data))]
+        return [[DataDesc(k, v.shape, v.dtype) for k, v in zip(self.label_name, self.label[i])] for i in xrange(len(self.data))]
 
     @property
     def provide_data_single(self):
-        return [(k, v.shape) for k, v in zip(self.data_name, self.data[0])]
+        return [DataDesc(k, v.shape, v.dtype) for k, v in zip(self.data_name, self.data[0])]
 
     @property
     def provide_label_single(self):
-        return [(k, v.shape) for k, v in zip(self.label_name, self.label[0])]
+        return [DataDesc(k, v.shape, v.dtype) for k, v in zip(self.label_name, self.label[0])]
 
     def reset(self):
         self.cur = 0
+        # with LOADER_WORKERS > 0 the tiles are cached in the workers, ProcessPrefetchingIter logs those
+        tile_cache = get_tile_cache(self.cfg)
+        if tile_cache is not None and tile_cache.hits + tile_cache.misses > 0:
+            logging.info(str(tile_cache))
         if self.shuffle:
             if self.aspect_grouping:
                 widths = np.array([r['width'] for r in self.roidb])
@@ -235,19 +317,28 @@ class PyramidAnchorIterator(mx.io.DataIter):
                 np.random.shuffle(self.index)
 
     def iter_next(self):
-        return self.cur + self.batch_size <= self.size
+        return self.has_batch(self.cur)
+
+    def has_batch(self, cur):
+        return cur + self.batch_size <= self.size
+
+    def batch_index(self, cur):
+        return self.index[cur:min(cur + self.batch_size, self.size)]
 
     def next(self):
         if self.iter_next():
-            self.get_batch_parallel()
-            # self.get_batch()
-            self.cur += self.batch_size
-            return mx.io.DataBatch(data=self.data, label=self.label,
-                                   pad=self.getpad(), index=self.getindex(),
-                                   provide_data=self.provide_data, provide_label=self.provide_label)
+            return self.feed_batch(self.load_batch(self.batch_index(self.cur)))
         else:
             raise StopIteration
 
+    def feed_batch(self, batch):
+        """ take a batch of load_batch as the current one and advance """
+        self.set_batch(batch)
+        self.cur += self.batch_size
+        return mx.io.DataBatch(data=self.data, label=self.label,
+                               pad=self.getpad(), index=self.getindex(),
+                               provide_data=self.provide_data, provide_label=self.provide_label)
+
     def getindex(self):
         return self.cur / self.batch_size
 
@@ -267,7 +358,7 @@ class PyramidAnchorIterator(mx.io.DataIter):
         input_batch_size = max_shapes['data'][0]
         im_info = [[max_shapes['data'][2], max_shapes['data'][3], 1.0]]
 
-        feat_shape = [y[1] for y in [x.infer_shape(**max_shapes) for x in self.feat_sym]]
+        feat_shape = self.feat_shapes.get(max_shapes['data'])
         label = assign_pyramid_anchor(feat_shape, np.zeros((0, 5)), im_info, self.cfg,
                                       self.feat_strides, self.anchor_scales, self.anchor_ratios, self.allowed_border)
         label = [label[k] for k in self.label_name]
@@ -276,9 +367,10 @@ class PyramidAnchorIterator(mx.io.DataIter):
         return max_data_shape, label_shape
 
     def get_batch_parallel(self):
-        cur_from = self.cur
-        cur_to = min(cur_from + self.batch_size, self.size)
-        roidb = [self.roidb[self.index[i]] for i in range(cur_from, cur_to)]
+        self.set_batch(self.load_batch(self.batch_index(self.cur)))
+
+    def load_batch(self, index):
+        """ numpy data and labels of the roidb entries in index, one pair per device, safe to run in a worker process """
         # decide multi device slice
         work_load_list = self.work_load_list
         ctx = self.ctx
@@ -288,13 +380,25 @@ class PyramidAnchorIterator(mx.io.DataIter):
             "Invalid settings for work load. "
         slices = _split_input_slice(self.batch_size, work_load_list)
 
-        rst = []
-        for idx, islice in enumerate(slices):
-            iroidb = [roidb[i] for i in range(islice.start, islice.stop)]
-            rst.append(par_assign_anchor_wrapper(self.cfg, iroidb, self.feat_sym, self.feat_strides, self.anchor_scales,
-                                                 self.anchor_ratios, self.allowed_border))
+        slice_index = [index[islice.start:islice.stop] for islice in slices]
+        if self.slice_pool is not None and self.slice_pool.usable():
+            rst = self.slice_pool.map([(inds,) for inds in slice_index])
+        else:
+            # also the path inside prefetch worker processes, which cannot fork a pool of their own;
+            # seeded like the pool, SLICE_WORKERS does not change the batch
+            rst = map_serial(self.load_slice, [(inds,) for inds in slice_index])
 
         all_data = [_['data'] for _ in rst]
         all_label = [_['label'] for _ in rst]
-        self.data = [[mx.nd.array(data[key]) for key in self.data_name] for data in all_data]
-        self.label = [[mx.nd.array(label[key]) for key in self.label_name] for label in all_label]
+        return all_data, all_label
+
+    def load_slice(self, index):
+        """ numpy data and label of the roidb entries in index for one device """
+        iroidb = [self.roidb[i] for i in index]
+        return par_assign_anchor_wrapper(self.cfg, iroidb, self.feat_shapes, self.feat_strides, self.anchor_scales,
+                                         self.anchor_ratios, self.allowed_border)
+
+    def set_batch(self, batch):
+        all_data, all_label = batch
+        self.data = [[_as_nd(data[key]) for key in self.data_name] for data in all_data]
+        self.label = [[_as_nd(label[key]) for key in self.label_name] for label in all_label]
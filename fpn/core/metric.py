@@ -15,12 +15,21 @@ import mxnet as mx
 import numpy as np
 
 
-def get_rpn_names():
+def get_rpn_names(sparse_label=False):
     pred = ['rpn_cls_prob', 'rpn_bbox_loss']
     label = ['rpn_label', 'rpn_bbox_target', 'rpn_bbox_weight']
+    if sparse_label:
+        label += ['rpn_label_ind', 'rpn_bbox_ind']
     return pred, label
 
 
+def _sampled_rpn_pred(pred, label_ind):
+    """ (b, c, p) rpn predictions => (b, K, c) predictions of the K anchors of a sparse rpn label """
+    # padding entries point one past the last anchor and carry label -1
+    label_ind = np.minimum(label_ind.astype(int), pred.shape[2] - 1)
+    return pred[np.arange(pred.shape[0])[:, np.newaxis], :, label_ind]
+
+
 def get_rcnn_names(cfg):
     pred = ['rcnn_cls_prob', 'rcnn_bbox_loss']
     label = ['rcnn_label', 'rcnn_bbox_target', 'rcnn_bbox_weight']
@@ -82,16 +91,22 @@ class RPNFGFraction(mx.metric.EvalMetric):
 
 
 class RPNAccMetric(mx.metric.EvalMetric):
-    def __init__(self):
+    def __init__(self, sparse_label=False):
         super(RPNAccMetric, self).__init__('RPNAcc')
-        self.pred, self.label = get_rpn_names()
+        self.sparse_label = sparse_label
+        self.pred, self.label = get_rpn_names(sparse_label)
 
     def update(self, labels, preds):
         pred = preds[self.pred.index('rpn_cls_prob')]
         label = labels[self.label.index('rpn_label')]
 
         # pred (b, c, p) or (b, c, h, w)
-        pred_label = mx.ndarray.argmax_channel(pred).asnumpy().astype('int32')
+        if self.sparse_label:
+            pred = _sampled_rpn_pred(pred.asnumpy().reshape((pred.shape[0], pred.shape[1], -1)),
+                                     labels[self.label.index('rpn_label_ind')].asnumpy())
+            pred_label = pred.argmax(axis=2).astype('int32')
+        else:
+            pred_label = mx.ndarray.argmax_channel(pred).asnumpy().astype('int32')
         pred_label = pred_label.reshape((pred_label.shape[0], -1))
         # label (b, p)
         label = label.asnumpy().astype('int32')
@@ -133,9 +148,10 @@ class RCNNAccMetric(mx.metric.EvalMetric):
 
 
 class RPNLogLossMetric(mx.metric.EvalMetric):
-    def __init__(self):
+    def __init__(self, sparse_label=False):
         super(RPNLogLossMetric, self).__init__('RPNLogLoss')
-        self.pred, self.label = get_rpn_names()
+        self.sparse_label = sparse_label
+        self.pred, self.label = get_rpn_names(sparse_label)
 
     def update(self, labels, preds):
         pred = preds[self.pred.index('rpn_cls_prob')]
@@ -144,7 +160,11 @@ class RPNLogLossMetric(mx.metric.EvalMetric):
         # label (b, p)
         label = label.asnumpy().astype('int32').reshape((-1))
         # pred (b, c, p) or (b, c, h, w) --> (b, p, c) --> (b*p, c)
-        pred = pred.asnumpy().reshape((pred.shape[0], pred.shape[1], -1)).transpose((0, 2, 1))
+        pred = pred.asnumpy().reshape((pred.shape[0], pred.shape[1], -1))
+        if self.sparse_label:
+            pred = _sampled_rpn_pred(pred, labels[self.label.index('rpn_label_ind')].asnumpy())
+        else:
+            pred = pred.transpose((0, 2, 1))
         pred = pred.reshape((label.shape[0], -1))
 
         # filter with keep_inds
@@ -190,9 +210,9 @@ class RCNNLogLossMetric(mx.metric.EvalMetric):
 
 
 class RPNL1LossMetric(mx.metric.EvalMetric):
-    def __init__(self):
+    def __init__(self, sparse_label=False):
         super(RPNL1LossMetric, self).__init__('RPNL1Loss')
-        self.pred, self.label = get_rpn_names()
+        self.pred, self.label = get_rpn_names(sparse_label)
 
     def update(self, labels, preds):
         bbox_loss = preds[self.pred.index('rpn_bbox_loss')].asnumpy()
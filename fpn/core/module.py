@@ -29,6 +29,8 @@ from mxnet import metric
 
 from .DataParallelExecutorGroup import DataParallelExecutorGroup
 from mxnet import ndarray as nd
+from mxnet.io import DataDesc
+from mxnet.base import mx_real_t
 from mxnet import optimizer as opt
 
 
@@ -827,19 +829,25 @@ class MutableModule(BaseModule):
             max_shapes_dict.update(dict(self._max_label_shapes[0]))
 
         max_data_shapes = list()
-        for name, shape in data_shapes[0]:
+        for desc in data_shapes[0]:
+            # keep the dtype of DataDesc inputs, e.g. uint8 image data
+            name, shape = desc[0], desc[1]
+            dtype = desc.dtype if isinstance(desc, DataDesc) else mx_real_t
             if name in max_shapes_dict:
-                max_data_shapes.append((name, max_shapes_dict[name]))
+                max_data_shapes.append(DataDesc(name, max_shapes_dict[name], dtype))
             else:
-                max_data_shapes.append((name, shape))
+                max_data_shapes.append(DataDesc(name, shape, dtype))
 
         max_label_shapes = list()
         if not label_shapes.count(None) == len(label_shapes):
-            for name, shape in label_shapes[0]:
+            for desc in label_shapes[0]:
+                # keep the dtype of DataDesc labels, e.g. int32 sparse rpn label indices
+                name, shape = desc[0], desc[1]
+                dtype = desc.dtype if isinstance(desc, DataDesc) else mx_real_t
                 if name in max_shapes_dict:
-                    max_label_shapes.append((name, max_shapes_dict[name]))
+                    max_label_shapes.append(DataDesc(name, max_shapes_dict[name], dtype))
                 else:
-                    max_label_shapes.append((name, shape))
+                    max_label_shapes.append(DataDesc(name, shape, dtype))
 
         if len(max_label_shapes) == 0:
             max_label_shapes = None
@@ -20,8 +20,9 @@ import numpy as np
 from module import MutableModule
 from utils import image
 from bbox.bbox_transform import bbox_pred, clip_boxes
-from nms.nms import py_nms_wrapper, py_softnms_wrapper
+from nms.nms import batched_nms_wrapper, py_softnms_wrapper
 from utils.PrefetchingIter import PrefetchingIter
+from utils.ProcessPrefetchingIter import ProcessPrefetchingIter
 
 
 class Predictor(object):
@@ -134,8 +135,15 @@ def pred_eval(predictor, test_data, imdb, cfg, vis=False, thresh=1e-3, logger=No
     assert vis or not test_data.shuffle
     data_names = [k[0] for k in test_data.provide_data[0]]
 
-    if not isinstance(test_data, PrefetchingIter):
-        test_data = PrefetchingIter(test_data)
+    # a freshly wrapped loader is reset for the first test scale already, workers fork once per scale
+    cfg.SCALES = [cfg.TEST_SCALES[0]]
+    wrapped = True
+    if cfg.TEST.LOADER_WORKERS > 0:
+        test_data = ProcessPrefetchingIter(test_data, num_workers=cfg.TEST.LOADER_WORKERS, depth=cfg.TEST.LOADER_DEPTH)
+    elif not isinstance(test_data, PrefetchingIter):
+        test_data = PrefetchingIter(test_data, depth=cfg.TEST.LOADER_DEPTH)
+    else:
+        wrapped = False
 
     # limit detections to max_per_image over all classes
     max_per_image = cfg.TEST.max_per_image
@@ -145,8 +153,9 @@ def pred_eval(predictor, test_data, imdb, cfg, vis=False, thresh=1e-3, logger=No
         det_file_single_scale = os.path.join(imdb.result_path, imdb.name + '_detections_' + str(test_scale_index) + '.pkl')
         # if os.path.exists(det_file_single_scale):
         #    continue
-        cfg.SCALES = [test_scale]
-        test_data.reset()
+        if test_scale_index > 0 or not wrapped:
+            cfg.SCALES = [test_scale]
+            test_data.reset()
 
         # all detections are collected into:
         #    all_boxes[cls][image] = N x 5 array of detections in
@@ -176,15 +185,22 @@ def pred_eval(predictor, test_data, imdb, cfg, vis=False, thresh=1e-3, logger=No
                     else:
                         all_boxes[idx_class][idx_im] = np.vstack((all_boxes[idx_class][idx_im], all_boxes_single_scale[idx_class][idx_im]))
 
-    for idx_class in range(1, imdb.num_classes):
-        for idx_im in range(0, num_images):
-            if cfg.TEST.USE_SOFTNMS:
-                soft_nms = py_softnms_wrapper(cfg.TEST.SOFTNMS_THRESH, max_dets=max_per_image)
+    if cfg.TEST.USE_SOFTNMS:
+        soft_nms = py_softnms_wrapper(cfg.TEST.SOFTNMS_THRESH, max_dets=max_per_image)
+        for idx_class in range(1, imdb.num_classes):
+            for idx_im in range(0, num_images):
                 all_boxes[idx_class][idx_im] = soft_nms(all_boxes[idx_class][idx_im])
-            else:
-                nms = py_nms_wrapper(cfg.TEST.NMS)
-                keep = nms(all_boxes[idx_class][idx_im])
-                all_boxes[idx_class][idx_im] = all_boxes[idx_class][idx_im][keep, :]
+    else:
+        # one nms call per image for all classes, a detection only suppresses its own class
+        nms = batched_nms_wrapper('numpy', cfg.TEST.NMS)
+        for idx_im in range(0, num_images):
+            image_dets = [all_boxes[j][idx_im] for j in range(1, imdb.num_classes)]
+            classes = np.repeat(np.arange(1, imdb.num_classes), [len(dets) for dets in image_dets])
+            keep = np.asarray(nms(np.vstack(image_dets), classes), dtype=int)
+            for j, dets in enumerate(image_dets, 1):
+                # kept rows of class j, still in score order
+                class_keep = keep[classes[keep] == j] - np.searchsorted(classes, j)
+                all_boxes[j][idx_im] = dets[class_keep, :]
 
     if max_per_image > 0:
         for idx_im in range(0, num_images):
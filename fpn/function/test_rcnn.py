@@ -16,6 +16,7 @@ import pprint
 import logging
 import time
 import os
+from collections import Counter
 import mxnet as mx
 
 from symbols import *
@@ -23,6 +24,20 @@ from dataset import *
 from core.loader import TestLoader
 from core.tester import Predictor, pred_eval
 from utils.load_model import load_param
+from utils.image import get_crop_shape
+from rpn.anchor_grid import set_anchor_cache_bytes
+
+
+def get_test_shapes(roidb, cfg):
+    """
+    input (height, width) of the images of roidb at every scale in cfg.TEST_SCALES, the most common first
+    """
+    counts = Counter([(int(r['height']), int(r['width'])) for r in roidb])
+    shape_counts = Counter()
+    for (height, width), count in counts.items():
+        for scale in cfg.TEST_SCALES:
+            shape_counts[get_crop_shape(height, width, scale, cfg)] += count
+    return [shape for shape, _ in shape_counts.most_common()]
 
 
 def test_rcnn(cfg, dataset, image_set, root_path, dataset_path,
@@ -34,13 +49,16 @@ def test_rcnn(cfg, dataset, image_set, root_path, dataset_path,
     # print cfg
     pprint.pprint(cfg)
     logger.info('testing cfg:{}\n'.format(pprint.pformat(cfg)))
+    set_anchor_cache_bytes(cfg.ANCHOR_CACHE_BYTES)
 
     # load symbol and testing data
     if has_rpn:
-        sym_instance = eval(cfg.symbol + '.' + cfg.symbol)()
-        sym = sym_instance.get_symbol(cfg, is_train=False)
         imdb = eval(dataset)(image_set, root_path, dataset_path, result_path=output_path)
         roidb = imdb.gt_roidb()
+        if not cfg.TEST.RPN_PREWARM_SHAPES:
+            cfg.TEST.RPN_PREWARM_SHAPES = get_test_shapes(roidb, cfg)
+        sym_instance = eval(cfg.symbol + '.' + cfg.symbol)()
+        sym = sym_instance.get_symbol(cfg, is_train=False)
     else:
         sym_instance = eval(cfg.symbol + '.' + cfg.symbol)()
         sym = sym_instance.get_symbol_rcnn(cfg, is_train=False)
@@ -0,0 +1,51 @@
+# --------------------------------------------------------
+# Deformable Convolutional Networks
+# Copyright (c) 2017 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+import _init_paths
+
+import argparse
+import os
+from config.config import config, update_config
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Pack preprocessed crop tiles into shards')
+    # general
+    parser.add_argument('--cfg', help='experiment configure file name', required=True, type=str)
+
+    args, rest = parser.parse_known_args()
+    update_config(args.cfg)
+
+    parser.add_argument('--output', help='shard directory, set it as TILE_SHARD_PATH', required=True, type=str)
+    parser.add_argument('--test', help='pack the test image set instead of the training sets', action='store_true')
+    parser.add_argument('--shard_mb', help='shard size in MB', default=1024, type=int)
+    args = parser.parse_args()
+    return args
+
+args = parse_args()
+
+from utils.load_data import load_gt_roidb, merge_roidb, filter_roidb
+from utils.tile_shards import write_tile_shards
+
+
+def main():
+    # the shards are made from the images, never from other shards
+    config.TILE_SHARD_PATH = ''
+    config.TILE_CACHE_BYTES = 0
+    if args.test:
+        roidb = load_gt_roidb(config.dataset.dataset, config.dataset.test_image_set, config.dataset.root_path,
+                              config.dataset.dataset_path)
+        config.SCALES = config.TEST_SCALES
+    else:
+        image_sets = [iset for iset in config.dataset.image_set.split('+')]
+        roidbs = [load_gt_roidb(config.dataset.dataset, image_set, config.dataset.root_path, config.dataset.dataset_path,
+                                flip=config.TRAIN.FLIP)
+                  for image_set in image_sets]
+        roidb = filter_roidb(merge_roidb(roidbs), config)
+    write_tile_shards(roidb, config, args.output, shard_bytes=args.shard_mb << 20)
+
+if __name__ == '__main__':
+    main()
@@ -45,37 +45,28 @@ class ProposalTargetOperator(mx.operator.CustomOp):
         assert self._batch_rois == -1 or self._batch_rois % self._batch_images == 0, \
             'batchimages {} must devide batch_rois {}'.format(self._batch_images, self._batch_rois)
         all_rois = in_data[0].asnumpy()
-        gt_boxes = in_data[1].asnumpy()
-        '''
-        print '-----------------------------'
-        print all_rois.shape
-        print all_rois[:100,0]
-        
-        print '-----------------------------'
-        print gt_boxes.shape
-        print gt_boxes[:,4]
-        '''
-        
+        # gt boxes of every image, padded with -1 rows to the image with the most boxes
+        all_gt_boxes = in_data[1].asnumpy().reshape((self._batch_images, -1, 6))
+
         if self._batch_rois == -1:
-            rois_per_image = all_rois.shape[0] + gt_boxes.shape[0]
+            assert self._batch_images == 1, 'BATCH_ROIS -1 takes every roi and needs a single image per device'
+            rois_per_image = all_rois.shape[0] + all_gt_boxes.shape[1]
             fg_rois_per_image = rois_per_image
         else:
             rois_per_image = self._batch_rois / self._batch_images
             fg_rois_per_image = np.round(self._fg_fraction * rois_per_image).astype(int)
 
-        # Include ground-truth boxes in the set of candidate rois
-        zeros = np.zeros((gt_boxes.shape[0], 1), dtype=gt_boxes.dtype)
-        
-        #print 'zeros.shape:'+str(zeros.shape)
-        print 'gt_boxes.shape:'+str(gt_boxes.shape)
-        print 'all_rois.shape:'+str(all_rois.shape)        
-        
-        all_rois = np.vstack((all_rois, np.hstack((zeros, gt_boxes[:, :-2]))))
-        # Sanity check: single batch only
-        assert np.all(all_rois[:, 0] == 0), 'Only single item batches are supported'
-
-        rois, labels, bbox_targets, bbox_weights = \
-            sample_rois(all_rois, fg_rois_per_image, rois_per_image, self._num_classes, self._cfg, gt_boxes=gt_boxes)
+        image_samples = []
+        for i in range(self._batch_images):
+            gt_boxes = all_gt_boxes[i]
+            gt_boxes = gt_boxes[gt_boxes[:, 4] > 0]
+            # Include ground-truth boxes in the set of candidate rois of image i
+            batch_inds = np.empty((gt_boxes.shape[0], 1), dtype=gt_boxes.dtype)
+            batch_inds.fill(i)
+            image_rois = np.vstack((all_rois[all_rois[:, 0] == i], np.hstack((batch_inds, gt_boxes[:, :-2]))))
+            image_samples.append(sample_rois(image_rois, fg_rois_per_image, rois_per_image, self._num_classes, self._cfg,
+                                             gt_boxes=gt_boxes))
+        rois, labels, bbox_targets, bbox_weights = [np.concatenate(x, axis=0) for x in zip(*image_samples)]
 
         if DEBUG:
             print "labels=", labels
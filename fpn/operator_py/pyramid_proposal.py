@@ -8,18 +8,24 @@
 import mxnet as mx
 import numpy as np
 import numpy.random as npr
+import re
 from distutils.util import strtobool
 
 from bbox.bbox_transform import bbox_pred, clip_boxes
-from rpn.generate_anchor import generate_anchors
-from nms.nms import gpu_nms_wrapper
+from rpn.anchor_grid import get_anchor_grid, _LRUCache
+from nms.nms import batched_nms_wrapper
 
 DEBUG = False
 
 LAYER_NUM = 5
+# proposals are made and suppressed per crop channel
+CROP_NUMS = 9
+# the anchors are made up front for at most this many of prewarm_shapes, the most common input sizes come first
+MAX_PREWARM_SHAPES = 4
 class PyramidProposalOperator(mx.operator.CustomOp):
     def __init__(self, feat_stride, scales, ratios, output_score,
-                 rpn_pre_nms_top_n, rpn_post_nms_top_n, threshold, rpn_min_size):
+                 rpn_pre_nms_top_n, rpn_post_nms_top_n, threshold, rpn_min_size, nms_backend='auto',
+                 pre_nms_per_level=False, prewarm_shapes=()):
         super(PyramidProposalOperator, self).__init__()
         self._feat_stride = np.fromstring(feat_stride[1:-1], dtype=int, sep=',')
         self._scales = np.fromstring(scales[1:-1], dtype=float, sep=',')
@@ -30,13 +36,23 @@ class PyramidProposalOperator(mx.operator.CustomOp):
         self._rpn_post_nms_top_n = rpn_post_nms_top_n
         self._threshold = threshold
         self._rpn_min_size = rpn_min_size
+        self._nms_backend = nms_backend
+        self._pre_nms_per_level = pre_nms_per_level
+        # anchors and crop channel of every row, by (stride, height, width), made up front for
+        # the first image sizes of prewarm_shapes
+        self._level_anchors = _LRUCache()
+        for im_height, im_width in prewarm_shapes[:MAX_PREWARM_SHAPES]:
+            for s in self._feat_stride:
+                self._anchors(int(s), int(im_height) // int(s), int(im_width) // int(s))
 
     def forward(self, is_train, req, in_data, out_data, aux):
-        nms = gpu_nms_wrapper(self._threshold, in_data[0].context.device_id)
+        # gpu nms for data on a gpu unless the backend says otherwise, only a channel's share of the rois is kept
+        context = in_data[0].context
+        device_id = context.device_id if context.device_type == 'gpu' else None
+        nms = batched_nms_wrapper(self._nms_backend, self._threshold, device_id,
+                                  max_keep=int(self._rpn_post_nms_top_n / CROP_NUMS))
 
         batch_size = in_data[0].shape[0]
-        if batch_size > 1:
-            raise ValueError("Sorry, multiple images each device is not implemented")
 
         # for each (H, W) location i
         #   generate A anchor boxes centered on cell i
@@ -49,6 +65,36 @@ class PyramidProposalOperator(mx.operator.CustomOp):
         # take after_nms_topN proposals after NMS
         # return the top proposals (-> RoIs top, scores top)
         
+        cls_prob_dict, bbox_pred_dict = self._level_inputs(in_data)
+
+        pre_nms_topN = self._rpn_pre_nms_top_n
+        post_nms_topN = self._rpn_post_nms_top_n
+        min_size = self._rpn_min_size
+
+        # copy every level to the host once, images are taken out of the batch below
+        cls_prob_dict = dict((k, v.asnumpy()) for k, v in cls_prob_dict.items())
+        bbox_pred_dict = dict((k, v.asnumpy()) for k, v in bbox_pred_dict.items())
+        all_im_info = in_data[-1].asnumpy()
+
+        blobs = []
+        score_list = []
+        for i in range(batch_size):
+            proposals, scores = self._image_proposals(cls_prob_dict, bbox_pred_dict, i, all_im_info[i, :], nms,
+                                                      pre_nms_topN, post_nms_topN, min_size)
+            # Output rois array, the first column is the image of the roi in the batch
+            batch_inds = np.empty((proposals.shape[0], 1), dtype=np.float32)
+            batch_inds.fill(i)
+            blobs.append(np.hstack((batch_inds, proposals.astype(np.float32, copy=False))))
+            score_list.append(scores)
+        blob = np.vstack(blobs)
+        # if is_train:
+        self.assign(out_data[0], req[0], blob)
+        #print "out_data[0].shape"+str(out_data[0].shape)
+        if self._output_score:
+            self.assign(out_data[1], req[1], np.vstack(score_list).astype(np.float32, copy=False))
+
+    def _level_inputs(self, in_data):
+        """ rpn_cls_prob and rpn_bbox_pred inputs of every level, by 'stride<s>' """
         if LAYER_NUM==7:
             cls_prob_dict = {
                 'stride64': in_data[6],
@@ -127,101 +173,66 @@ class PyramidProposalOperator(mx.operator.CustomOp):
             'stride1': in_data[2],
         }        
         '''
-        pre_nms_topN = self._rpn_pre_nms_top_n
-        post_nms_topN = self._rpn_post_nms_top_n
-        min_size = self._rpn_min_size
+        return cls_prob_dict, bbox_pred_dict
 
+    def _image_proposals(self, cls_prob_dict, bbox_pred_dict, i, im_info, nms, pre_nms_topN, post_nms_topN, min_size):
+        """
+        proposals of image i of the batch
+        :return: proposals [num_rois, 4], scores [num_rois, 1]
+        """
         proposal_list = []
         score_list = []
         channel_record_list = []
-        crop_nums=9
+        crop_nums = CROP_NUMS
 
         for s in self._feat_stride:
             stride = int(s)
-            sub_anchors = generate_anchors(base_size=stride, scales=self._scales, ratios=self._ratios)
-            #print "cls_prob_dict['stride' + str(s)].shape:"+str(cls_prob_dict['stride' + str(s)].shape)
-            #print cls_prob_dict['stride' + str(s)].asnumpy().shape
-            scores = cls_prob_dict['stride' + str(s)].asnumpy()[:, self._num_anchors:, :, :]
-            #print "scores.shape:"+str(scores.shape)
-            bbox_deltas = bbox_pred_dict['stride' + str(s)].asnumpy()
-            #print "bbox_deltas.shape:"+str(bbox_deltas.shape)
-            im_info = in_data[-1].asnumpy()[0, :]
             # 1. Generate proposals from bbox_deltas and shifted anchors
             # use real image size instead of padded feature map sizes
             height, width = int(im_info[0] / stride), int(im_info[1] / stride)
 
-            # Enumerate all shifts
-            shift_x = np.arange(0, width) * stride
-            shift_y = np.arange(0, height) * stride
-            shift_x, shift_y = np.meshgrid(shift_x, shift_y)
-            shifts = np.vstack((shift_x.ravel(), shift_y.ravel(), shift_x.ravel(), shift_y.ravel())).transpose()
-
-            # Enumerate all shifted anchors:
-            #
-            # add A anchors (1, A, 4) to
-            # cell K shifts (K, 1, 4) to get
-            # shift anchors (K, A, 4)
-            # reshape to (K*A, 4) shifted anchors
+            # Enumerate all shifted anchors, (crop, h, w, a) ordered, shared with the anchor loader
             A = self._num_anchors
-            K = shifts.shape[0]
-            temp_anchors = sub_anchors.reshape((1, A, 4)) + shifts.reshape((1, K, 4)).transpose((1, 0, 2))
-            temp_anchors = temp_anchors.reshape((K * A, 4))
-            anchors = np.zeros((0,4))
-            channel_records = np.zeros((0,1))
-            for channel in range(crop_nums):
-                anchors = np.vstack((anchors,temp_anchors))
-                channels = np.ones(K*A)*channel
-                channels = channels.reshape((-1,1))
-                channel_records = np.vstack((channel_records,channels))
-            # Transpose and reshape predicted bbox transformations to get them
-            # into the same order as the anchors:
-            #
-            # bbox deltas will be (1, 4 * A, H, W) format
-            # transpose to (1, H, W, 4 * A)
-            # reshape to (1 * H * W * A, 4) where rows are ordered by (h, w, a)
-            # in slowest to fastest order
-            bbox_deltas = self._clip_pad(bbox_deltas, (height, width))
-            bbox_deltas = bbox_deltas.transpose((0, 2, 3, 1)).reshape((-1, 4))
-
-            # Same story for the scores:
-            #
-            # scores are (1, A, H, W) format
-            # transpose to (1, H, W, A)
-            # reshape to (1 * H * W * A, 1) where rows are ordered by (h, w, a)
-            scores = self._clip_pad(scores, (height, width))
-            scores = scores.transpose((0, 2, 3, 1)).reshape((-1, 1))
-          
-            # Convert anchors into proposals via bbox transformations
-            proposals = bbox_pred(anchors, bbox_deltas)
+            anchors, channels = self._anchors(stride, height, width)
+            num_rows = anchors.shape[0]
 
-            # 2. clip predicted boxes to image
-            proposals = clip_boxes(proposals, im_info[:2])
+            # scores are (1, C, H, W) format
+            # transpose to (1, H, W, C)
+            # flatten, row r is the r-th (h, w, c) entry and goes with anchor r,
+            # the bbox deltas are paired the same way, 4 values per row
+            scores = self._clip_pad(cls_prob_dict['stride' + str(s)][i:i + 1, A:, :, :], (height, width))
+            scores = scores.transpose((0, 2, 3, 1)).reshape(-1)[:num_rows]
 
+            # 2. clip predicted boxes to image
             # 3. remove predicted boxes with either height or width < threshold
             # (NOTE: convert min_size to input image scale stored in im_info[2])
-
-            #print "proposals.shape"
-            #print proposals.shape
-            keep = self._filter_boxes(proposals, min_size * im_info[2])
-            proposals = proposals[keep, :]
-            #print "scores.shape"
-            #print scores.shape
-            scores = scores[keep]
-
-            channel_records = channel_records[keep] 
-            
-            proposal_list.append(proposals)
-            score_list.append(scores)
-            channel_record_list.append(channel_records)
+            # only the best scored rows are decoded, as many as it takes to have the level's
+            # top pre_nms_topN proposals that pass the size filter
+            top_n = num_rows if pre_nms_topN <= 0 else min(pre_nms_topN, num_rows)
+            num_candidates = top_n
+            while True:
+                rows = self._top_rows(scores, num_candidates)
+                bbox_deltas = self._row_deltas(bbox_pred_dict['stride' + str(s)], i, rows, width)
+                proposals = clip_boxes(bbox_pred(anchors[rows, :], bbox_deltas), im_info[:2])
+                keep = self._filter_boxes(proposals, min_size * im_info[2])
+                if len(keep) >= top_n or num_candidates == num_rows:
+                    break
+                num_candidates = min(num_rows, 2 * num_candidates)
+            keep = keep[self._top_rows(scores[rows[keep]], top_n)]
+            rows = rows[keep]
+
+            proposal_list.append(proposals[keep, :])
+            score_list.append(scores[rows].reshape((-1, 1)))
+            channel_record_list.append(channels[rows].astype(np.float64).reshape((-1, 1)))
 
         channel_records = np.vstack(channel_record_list)
         proposals = np.vstack(proposal_list)
         scores = np.vstack(score_list)
 
         # 4. sort all (proposal, score) pairs by score from highest to lowest
-        # 5. take top pre_nms_topN (e.g. 6000)
+        # 5. take top pre_nms_topN (e.g. 6000), or with pre_nms_per_level all the top pre_nms_topN of every level
         order = scores.ravel().argsort()[::-1]
-        if pre_nms_topN > 0:
+        if pre_nms_topN > 0 and not self._pre_nms_per_level:
             order = order[:pre_nms_topN]
         proposals = proposals[order, :]
         scores = scores[order]
@@ -232,49 +243,92 @@ class PyramidProposalOperator(mx.operator.CustomOp):
         # 6. apply nms (e.g. threshold = 0.7)
         # 7. take after_nms_topN (e.g. 300)
         # 8. return the top proposals (-> RoIs top)
-        # 9. nms on different channel
-        keeps = np.zeros(0)
-        avg_post_nms_topN = int(post_nms_topN/crop_nums)
-        for i in range(crop_nums):
-            channel_index = np.where(channel_records==i)[0]
-            temp_ch_proposals = proposals[channel_index,:]
-            #print proposals.shape
-            #print temp_ch_proposals.shape
-            temp_scores = scores[channel_index]
-            #print temp_scores.shape
-            det = np.hstack((temp_ch_proposals, temp_scores)).astype(np.float32)
-            #print det.shape
-            #keep = np.zeros(1)
-            if det.shape[0]>0:
-                keep = nms(det)
-                if avg_post_nms_topN > 0:
-                    keep = keep[:avg_post_nms_topN]
-                # pad to ensure output size remains unchanged
-                if len(keep) < avg_post_nms_topN:
-                    pad = npr.choice(keep, size=avg_post_nms_topN - len(keep))
-                    keep = np.hstack((keep, pad))
-                keeps = np.hstack((keeps,channel_index[keep])).astype(np.int)
+        # 9. nms on different channel: one batched call, a proposal only suppresses its own channel
+        channels = channel_records.ravel().astype(int)
+        det = np.hstack((proposals, scores)).astype(np.float32)
+        keep = nms(det, channels)
+        per_channel = int(post_nms_topN / crop_nums)
+        if len(keep) == 0:
+            # nothing left of the image, the full image box keeps the output size
+            num_rois = crop_nums * per_channel if per_channel > 0 else 1
+            proposals = np.tile(np.array([[0, 0, im_info[1] - 1, im_info[0] - 1]]), (num_rois, 1))
+            return proposals, np.zeros((num_rois, 1), dtype=scores.dtype)
+        keeps = self._channel_keeps(keep, channels, per_channel, crop_nums)
 
         proposals = proposals[keeps, :]
         scores = scores[keeps]
         channel_records = channel_records[keeps]
         #proposals.hstack((proposals,channel_records))
         #print channel_records.shape
-        # Output rois array
-        # Our RPN implementation only supports a single input image, so all
-        # batch inds are 0
-        batch_inds = np.zeros((proposals.shape[0], 1), dtype=np.float32)
-        blob = np.hstack((batch_inds, proposals.astype(np.float32, copy=False)))
-        # if is_train:
-        self.assign(out_data[0], req[0], blob)
-        #print "out_data[0].shape"+str(out_data[0].shape)
-        if self._output_score:
-            self.assign(out_data[1], req[1], scores.astype(np.float32, copy=False))
+        return proposals, scores
 
     def backward(self, req, out_grad, in_data, out_data, in_grad, aux):
         for i in range(len(in_grad)):
             self.assign(in_grad[i], req[i], 0)
 
+    def _anchors(self, stride, height, width):
+        """
+        anchors of a level, (crop, h, w, a) ordered, and the crop channel of every anchor, both read only
+        """
+        key = (stride, height, width)
+        level = self._level_anchors.get(key)
+        if level is None:
+            anchors = get_anchor_grid(height, width, stride, self._scales, self._ratios, CROP_NUMS)
+            channels = np.repeat(np.arange(CROP_NUMS, dtype=np.int32), anchors.shape[0] // CROP_NUMS)
+            channels.flags.writeable = False
+            level = (anchors, channels)
+            self._level_anchors.put(key, level)
+        return level
+
+    @staticmethod
+    def _top_rows(values, k):
+        """ indexes of the k largest values, unordered """
+        if k >= len(values):
+            return np.arange(len(values))
+        return np.argpartition(values, len(values) - k)[len(values) - k:]
+
+    @staticmethod
+    def _row_deltas(bbox_deltas, i, rows, width):
+        """
+        [len(rows), 4] deltas of rows of image i, row r being the r-th 4 values of its deltas
+        transposed to (H, W, C) and clipped to width, without transposing the whole map
+        """
+        num_channels = bbox_deltas.shape[1]
+        first = 4 * rows
+        h = first // (width * num_channels)
+        w = first // num_channels % width
+        c = first % num_channels
+        return bbox_deltas[i, c[:, np.newaxis] + np.arange(4), h[:, np.newaxis], w[:, np.newaxis]]
+
+    @staticmethod
+    def _channel_keeps(keep, channels, per_channel, num_channels=0):
+        """
+        rows of the output, channel by channel: the per_channel best kept proposals of every channel that has any,
+        padded by random picks of its kept proposals to keep the output size unchanged
+        :param keep: nms kept indexes, in score order within a channel, at most per_channel of every channel
+        :param channels: crop channel of every proposal
+        :param per_channel: rows per channel, <= 0 takes all kept proposals without padding
+        :param num_channels: with num_channels, channels 0 to num_channels - 1 without kept proposals get
+        per_channel copies of the best kept proposal, the lowest index as indexes are in score order
+        """
+        keep = np.asarray(keep, dtype=int)
+        keep = keep[np.argsort(channels[keep], kind='mergesort')]
+        if per_channel <= 0 or len(keep) == 0:
+            return keep
+        kept_channels, starts, counts = np.unique(channels[keep], return_index=True, return_counts=True)
+        slots = np.tile(np.arange(per_channel), len(counts))
+        # npr.randint draws what npr.choice(keep, size=...) of every channel did, in channel order
+        for j in np.where(counts < per_channel)[0]:
+            slots[j * per_channel + counts[j]:(j + 1) * per_channel] = npr.randint(0, counts[j],
+                                                                                   size=per_channel - counts[j])
+        keeps = keep[np.repeat(starts, per_channel) + slots]
+        if num_channels <= len(kept_channels):
+            return keeps
+        rows = np.empty((num_channels, per_channel), dtype=int)
+        rows.fill(keep.min())
+        rows[kept_channels] = keeps.reshape((-1, per_channel))
+        return rows.ravel()
+
     @staticmethod
     def _filter_boxes(boxes, min_size):
         """ Remove all boxes with any side smaller than min_size """
@@ -303,7 +357,8 @@ class PyramidProposalOperator(mx.operator.CustomOp):
 @mx.operator.register("pyramid_proposal")
 class PyramidProposalProp(mx.operator.CustomOpProp):
     def __init__(self, feat_stride='(64, 32, 16, 8, 4)', scales='(8)', ratios='(0.5, 1, 2)', output_score='False',
-                 rpn_pre_nms_top_n='12000', rpn_post_nms_top_n='2000', threshold='0.3', rpn_min_size='16', output_pyramid_rois='False'):
+                 rpn_pre_nms_top_n='12000', rpn_post_nms_top_n='2000', threshold='0.3', rpn_min_size='16', output_pyramid_rois='False',
+                 nms_backend='auto', pre_nms_per_level='False', prewarm_shapes='()'):
         super(PyramidProposalProp, self).__init__(need_top_grad=False)
         self._feat_stride = feat_stride
         self._scales = scales
@@ -314,6 +369,11 @@ class PyramidProposalProp(mx.operator.CustomOpProp):
         self._threshold = float(threshold)
         self._rpn_min_size = int(rpn_min_size)
         self.output_pyramid_rois = strtobool(output_pyramid_rois)
+        self._nms_backend = nms_backend
+        self._pre_nms_per_level = strtobool(pre_nms_per_level)
+        # ((height, width), ...) of the input images
+        sizes = [int(v) for v in re.findall(r'\d+', prewarm_shapes)]
+        self._prewarm_shapes = tuple(zip(sizes[0::2], sizes[1::2]))
 
     def list_arguments(self):
         arg_list = []
@@ -334,11 +394,13 @@ class PyramidProposalProp(mx.operator.CustomOpProp):
                 return ['output']
 
     def infer_shape(self, in_shape):
-        output_shape = (self._rpn_post_nms_top_n, 5)
-        score_shape = (self._rpn_post_nms_top_n, 1)
+        # rpn_post_nms_top_n rois for every image
+        batch_size = in_shape[0][0]
+        output_shape = (batch_size * self._rpn_post_nms_top_n, 5)
+        score_shape = (batch_size * self._rpn_post_nms_top_n, 1)
 
         if self.output_pyramid_rois:
-            return in_shape, [output_shape, output_shape, output_shape, output_shape, (self._rpn_post_nms_top_n,)]
+            return in_shape, [output_shape, output_shape, output_shape, output_shape, (batch_size * self._rpn_post_nms_top_n,)]
         else:
             if self._output_score:
                 return in_shape, [output_shape, score_shape]
@@ -347,7 +409,8 @@ class PyramidProposalProp(mx.operator.CustomOpProp):
 
     def create_operator(self, ctx, shapes, dtypes):
         return PyramidProposalOperator(self._feat_stride, self._scales, self._ratios, self._output_score,
-                                       self._rpn_pre_nms_top_n, self._rpn_post_nms_top_n, self._threshold, self._rpn_min_size)
+                                       self._rpn_pre_nms_top_n, self._rpn_post_nms_top_n, self._threshold, self._rpn_min_size,
+                                       self._nms_backend, self._pre_nms_per_level, self._prewarm_shapes)
 
     def declare_backward_dependency(self, out_grad, in_data, out_data):
         return []
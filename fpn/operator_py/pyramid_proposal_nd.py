@@ -0,0 +1,152 @@
+# --------------------------------------------------------
+# Deformable Convolutional Networks
+# Copyright (c) 2017 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""
+Pyramid Proposal Operator on NDArrays makes the proposals of PyramidProposalOperator with NDArray ops
+(decode, clip, topk, contrib.box_nms) on the context of its inputs, no feature map goes to the host.
+Selected with TRAIN.RPN_PROPOSAL_ND / TEST.RPN_PROPOSAL_ND.
+"""
+
+import mxnet as mx
+
+from rpn.anchor_grid import _LRUCache
+from operator_py.pyramid_proposal import PyramidProposalOperator, PyramidProposalProp, CROP_NUMS
+
+
+class PyramidProposalNDOperator(PyramidProposalOperator):
+    def __init__(self, *args, **kwargs):
+        super(PyramidProposalNDOperator, self).__init__(*args, **kwargs)
+        assert self._rpn_post_nms_top_n % CROP_NUMS == 0, \
+            'rpn_post_nms_top_n {} is not a multiple of the {} crops'.format(self._rpn_post_nms_top_n, CROP_NUMS)
+        # device copies of _anchors, by (stride, height, width)
+        self._device_anchors = _LRUCache()
+
+    def forward(self, is_train, req, in_data, out_data, aux):
+        batch_size = in_data[0].shape[0]
+        cls_prob_dict, bbox_pred_dict = self._level_inputs(in_data)
+        # only im_info comes to the host, it sets the shapes of the level slices
+        all_im_info = in_data[-1].asnumpy()
+
+        blobs = []
+        score_list = []
+        for i in range(batch_size):
+            proposals, scores = self._image_proposals_nd(cls_prob_dict, bbox_pred_dict, i, all_im_info[i, :])
+            # Output rois array, the first column is the image of the roi in the batch
+            blobs.append(mx.nd.concat(mx.nd.full((proposals.shape[0], 1), i, ctx=proposals.context), proposals, dim=1))
+            score_list.append(scores)
+        self.assign(out_data[0], req[0], mx.nd.concat(*blobs, dim=0))
+        if self._output_score:
+            self.assign(out_data[1], req[1], mx.nd.concat(*score_list, dim=0))
+
+    def _device_level_anchors(self, stride, height, width, ctx):
+        key = (stride, height, width)
+        level = self._device_anchors.get(key)
+        if level is None:
+            anchors, channels = self._anchors(stride, height, width)
+            level = (mx.nd.array(anchors, ctx=ctx), mx.nd.array(channels, ctx=ctx))
+            self._device_anchors.put(key, level)
+        return level
+
+    def _image_proposals_nd(self, cls_prob_dict, bbox_pred_dict, i, im_info):
+        """
+        proposals of image i of the batch, see PyramidProposalOperator._image_proposals
+        a crop channel without proposals gets copies of the best proposal of the image, so there are always
+        rpn_post_nms_top_n of them; an image without any gets the full image box with score 0
+        :return: proposals [rpn_post_nms_top_n, 4], scores [rpn_post_nms_top_n, 1]
+        """
+        A = self._num_anchors
+        pre_nms_topN = self._rpn_pre_nms_top_n
+        per_channel = self._rpn_post_nms_top_n // CROP_NUMS
+        min_size = self._rpn_min_size * im_info[2]
+
+        level_dets = []
+        for s in self._feat_stride:
+            stride = int(s)
+            height, width = int(im_info[0] / stride), int(im_info[1] / stride)
+            cls_prob = cls_prob_dict['stride' + str(s)]
+            anchors, channels = self._device_level_anchors(stride, height, width, cls_prob.context)
+            num_rows = anchors.shape[0]
+
+            # rows are (h, w, c) ordered as in _image_proposals
+            scores = mx.nd.slice(cls_prob, begin=(i, A, 0, 0), end=(i + 1, None, height, width))
+            scores = mx.nd.slice_axis(scores.transpose((0, 2, 3, 1)).reshape((-1,)), axis=0, begin=0, end=num_rows)
+            bbox_deltas = mx.nd.slice(bbox_pred_dict['stride' + str(s)], begin=(i, 0, 0, 0),
+                                      end=(i + 1, None, height, width))
+            bbox_deltas = bbox_deltas.transpose((0, 2, 3, 1)).reshape((-1, 4))
+
+            x1, y1, x2, y2 = self._decode(anchors, bbox_deltas)
+            x1 = mx.nd.clip(x1, 0, float(im_info[1] - 1))
+            y1 = mx.nd.clip(y1, 0, float(im_info[0] - 1))
+            x2 = mx.nd.clip(x2, 0, float(im_info[1] - 1))
+            y2 = mx.nd.clip(y2, 0, float(im_info[0] - 1))
+            # proposals smaller than min_size get score -1, box_nms drops them
+            small = ((x2 - x1 + 1) < min_size) + ((y2 - y1 + 1) < min_size)
+            scores = mx.nd.where(small.reshape((-1,)) > 0, mx.nd.full((num_rows,), -1, ctx=scores.context), scores)
+
+            # box_nms has no +1 in its box areas, x2 + 1 and y2 + 1 give the overlaps of nms
+            dets = mx.nd.concat(channels.reshape((-1, 1)), scores.reshape((-1, 1)), x1, y1, x2 + 1, y2 + 1, dim=1)
+            if 0 < pre_nms_topN < num_rows:
+                dets = mx.nd.take(dets, mx.nd.topk(scores, k=pre_nms_topN, dtype='int32'))
+            level_dets.append(dets)
+
+        dets = mx.nd.concat(*level_dets, dim=0)
+        if 0 < pre_nms_topN < dets.shape[0] and not self._pre_nms_per_level:
+            dets = mx.nd.take(dets, mx.nd.topk(mx.nd.slice_axis(dets, axis=1, begin=1, end=2).reshape((-1,)),
+                                               k=pre_nms_topN, dtype='int32'))
+
+        # nms within every crop channel, kept rows come first in score order, the others are all -1
+        dets = mx.nd.contrib.box_nms(dets, overlap_thresh=self._threshold, valid_thresh=-0.5, topk=-1,
+                                     coord_start=2, score_index=1, id_index=0, force_suppress=False)
+        dets_channels = mx.nd.slice_axis(dets, axis=1, begin=0, end=1).reshape((-1,))
+        dets_scores = mx.nd.slice_axis(dets, axis=1, begin=1, end=2).reshape((-1,))
+
+        # per_channel best of every channel, padded with random picks of its kept proposals like _channel_keeps
+        slots = mx.nd.arange(per_channel, ctx=dets.context)
+        rows = []
+        for channel in range(CROP_NUMS):
+            channel_scores = mx.nd.where(dets_channels == channel, dets_scores, mx.nd.full(dets_scores.shape, -1, ctx=dets.context))
+            best_scores, best_rows = mx.nd.topk(channel_scores, k=min(per_channel, dets.shape[0]), ret_typ='both')
+            count = mx.nd.sum(best_scores >= 0)
+            pads = mx.nd.floor(mx.nd.broadcast_mul(mx.nd.random.uniform(shape=(per_channel,), ctx=dets.context), count))
+            picks = mx.nd.where(mx.nd.broadcast_lesser(slots, count), slots, pads)
+            # row 0 is the best proposal of the image
+            rows.append(mx.nd.broadcast_mul(mx.nd.take(best_rows, picks), count > 0))
+        dets = mx.nd.take(dets, mx.nd.concat(*rows, dim=0))
+        # nothing kept: row 0 is an all -1 row of box_nms, it becomes the full image box
+        full_image = mx.nd.array([[0, 0, 0, 0, im_info[1], im_info[0]]], ctx=dets.context)
+        kept = mx.nd.slice_axis(dets, axis=1, begin=1, end=2) >= 0
+        dets = mx.nd.where(mx.nd.broadcast_to(kept, shape=dets.shape), dets,
+                           mx.nd.broadcast_to(full_image, shape=dets.shape))
+
+        proposals = mx.nd.slice_axis(dets, axis=1, begin=2, end=6) - mx.nd.array([0, 0, 1, 1], ctx=dets.context)
+        scores = mx.nd.slice_axis(dets, axis=1, begin=1, end=2)
+        return proposals, scores
+
+    @staticmethod
+    def _decode(anchors, bbox_deltas):
+        """ bbox_pred of NDArrays, the x1, y1, x2, y2 columns """
+        ax1, ay1, ax2, ay2 = mx.nd.split(anchors, num_outputs=4, axis=1)
+        dx, dy, dw, dh = mx.nd.split(bbox_deltas, num_outputs=4, axis=1)
+        widths = ax2 - ax1 + 1.0
+        heights = ay2 - ay1 + 1.0
+        ctr_x = ax1 + 0.5 * (widths - 1.0)
+        ctr_y = ay1 + 0.5 * (heights - 1.0)
+
+        pred_ctr_x = dx * widths + ctr_x
+        pred_ctr_y = dy * heights + ctr_y
+        pred_w = mx.nd.exp(dw) * widths
+        pred_h = mx.nd.exp(dh) * heights
+        return (pred_ctr_x - 0.5 * (pred_w - 1.0), pred_ctr_y - 0.5 * (pred_h - 1.0),
+                pred_ctr_x + 0.5 * (pred_w - 1.0), pred_ctr_y + 0.5 * (pred_h - 1.0))
+
+
+@mx.operator.register("pyramid_proposal_nd")
+class PyramidProposalNDProp(PyramidProposalProp):
+    def create_operator(self, ctx, shapes, dtypes):
+        return PyramidProposalNDOperator(self._feat_stride, self._scales, self._ratios, self._output_score,
+                                         self._rpn_pre_nms_top_n, self._rpn_post_nms_top_n, self._threshold,
+                                         self._rpn_min_size, self._nms_backend, self._pre_nms_per_level,
+                                         self._prewarm_shapes)
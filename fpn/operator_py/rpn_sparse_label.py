@@ -0,0 +1,72 @@
+# --------------------------------------------------------
+# Deformable Convolutional Networks
+# Copyright (c) 2017 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""
+RPN Sparse Label Operator scatters the sampled anchors of a sparse rpn label (see config.TRAIN.RPN_SPARSE_LABEL)
+into the dense label, bbox_target and bbox_weight maps assign_pyramid_anchor would have made, on the device.
+"""
+
+import mxnet as mx
+
+
+class RPNSparseLabelOperator(mx.operator.CustomOp):
+    def __init__(self):
+        super(RPNSparseLabelOperator, self).__init__()
+
+    def _scatter(self, values, indices, size):
+        # every row gets one spare slot past size for the padding entries
+        batch_size = values.shape[0]
+        values = values.reshape((batch_size, -1))
+        indices = indices.reshape((batch_size, -1))
+        rows = mx.nd.arange(batch_size, ctx=values.context, dtype='int32').reshape((batch_size, 1))
+        # int32 all the way, float32 is not exact past 2 ** 24 anchors
+        indices = mx.nd.stack(mx.nd.broadcast_to(rows, shape=indices.shape), indices.astype('int32'), axis=0)
+        dense = mx.nd.scatter_nd(values, indices, shape=(batch_size, size + 1))
+        return mx.nd.slice_axis(dense, axis=1, begin=0, end=size)
+
+    def forward(self, is_train, req, in_data, out_data, aux):
+        label, bbox_target, bbox_weight, label_ind, bbox_ind = in_data[:5]
+        label_shape, bbox_shape = out_data[0].shape, out_data[1].shape
+        bbox_size = bbox_shape[1] * bbox_shape[2]
+
+        # unlabelled anchors are -1
+        dense_label = self._scatter(label + 1, label_ind, label_shape[1]) - 1
+        self.assign(out_data[0], req[0], dense_label)
+        self.assign(out_data[1], req[1], self._scatter(bbox_target, bbox_ind, bbox_size).reshape(bbox_shape))
+        self.assign(out_data[2], req[2], self._scatter(bbox_weight, bbox_ind, bbox_size).reshape(bbox_shape))
+
+    def backward(self, req, out_grad, in_data, out_data, in_grad, aux):
+        for i in range(len(in_grad)):
+            self.assign(in_grad[i], req[i], 0)
+
+
+@mx.operator.register('rpn_sparse_label')
+class RPNSparseLabelProp(mx.operator.CustomOpProp):
+    def __init__(self):
+        super(RPNSparseLabelProp, self).__init__(need_top_grad=False)
+
+    def list_arguments(self):
+        return ['label', 'bbox_target', 'bbox_weight', 'label_ind', 'bbox_ind', 'cls_score', 'bbox_pred']
+
+    def list_outputs(self):
+        return ['label_output', 'bbox_target_output', 'bbox_weight_output']
+
+    def infer_shape(self, in_shape):
+        # the rpn outputs give the dense shapes: cls_score (n, 2, A * crops * H * W), bbox_pred (n, A * 4, crops * H * W)
+        cls_score_shape = in_shape[5]
+        bbox_pred_shape = in_shape[6]
+        label_shape = (cls_score_shape[0], cls_score_shape[2])
+        return in_shape, [label_shape, bbox_pred_shape, bbox_pred_shape]
+
+    def infer_type(self, in_type):
+        # label_ind and bbox_ind are int32
+        return in_type, [in_type[0]] * 3, []
+
+    def create_operator(self, ctx, shapes, dtypes):
+        return RPNSparseLabelOperator()
+
+    def declare_backward_dependency(self, out_grad, in_data, out_data):
+        return []
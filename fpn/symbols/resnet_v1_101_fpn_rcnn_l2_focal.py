@@ -9,10 +9,12 @@ import cPickle
 import mxnet as mx
 from utils.symbol import Symbol
 from operator_py.pyramid_proposal import *
+from operator_py.pyramid_proposal_nd import *
 from operator_py.proposal_target import *
 from operator_py.fpn_roi_pooling import *
 from operator_py.box_annotator_ohem import *
 from operator_py.focal_loss_OptimizedVersion import *
+from operator_py.rpn_sparse_label import *
 
 
 class resnet_v1_101_fpn_rcnn_l2_focal(Symbol):
@@ -810,6 +812,15 @@ class resnet_v1_101_fpn_rcnn_l2_focal(Symbol):
         rpn_bbox_pred_t = mx.sym.Reshape(data=rpn_bbox_pred, shape=(0, 4 * num_anchors, -1), name='rpn_bbox_pred_t_' + suffix)
         return rpn_cls_score_t2, rpn_cls_prob_t, rpn_bbox_pred_t, rpn_bbox_pred
 
+    def get_normalized_data(self, data, pixel_means):
+        # uint8 BGR tiles (n, 3 * crops, H, W) => float RGB tiles with the pixel means removed
+        data = mx.sym.Cast(data=data, dtype='float32', name='data_cast')
+        data = mx.sym.Reshape(data=data, shape=(0, -4, -1, 3, -2), name='data_split_rgb')
+        bgr = mx.sym.SliceChannel(data=data, num_outputs=3, axis=2, name='data_bgr')
+        rgb = [bgr[2 - i] - float(pixel_means[2 - i]) for i in range(3)]
+        data = mx.sym.Concat(*rgb, dim=2, name='data_rgb')
+        return mx.sym.Reshape(data=data, shape=(0, -3, -2), name='data_norm')
+
     def get_symbol(self, cfg, is_train=True):
 
         # config alias for convenient
@@ -818,6 +829,8 @@ class resnet_v1_101_fpn_rcnn_l2_focal(Symbol):
 
         data = mx.sym.Variable(name="data")
         im_info = mx.sym.Variable(name="im_info")
+        if cfg.network.DEVICE_NORMALIZE:
+            data = self.get_normalized_data(data, cfg.network.PIXEL_MEANS)
 
         # shared convolutional layers
         res2, res3, res4, res5 = self.get_resnet_backbone(data)
@@ -853,19 +866,30 @@ class resnet_v1_101_fpn_rcnn_l2_focal(Symbol):
 
             rpn_cls_score = mx.sym.Concat(rpn_cls_score_p2, rpn_cls_score_p3, rpn_cls_score_p4, rpn_cls_score_p5, rpn_cls_score_p6, dim=2)
             rpn_bbox_loss = mx.sym.Concat(rpn_bbox_loss_p2, rpn_bbox_loss_p3, rpn_bbox_loss_p4, rpn_bbox_loss_p5, rpn_bbox_loss_p6, dim=2)
+            if cfg.TRAIN.RPN_SPARSE_LABEL:
+                # the loader ships the sampled anchors only, scatter them into dense maps here
+                rpn_label_ind = mx.sym.Variable(name='label_ind')
+                rpn_bbox_ind = mx.sym.Variable(name='bbox_ind')
+                rpn_label, rpn_bbox_target, rpn_bbox_weight = \
+                    mx.sym.Custom(label=rpn_label, bbox_target=rpn_bbox_target, bbox_weight=rpn_bbox_weight,
+                                  label_ind=rpn_label_ind, bbox_ind=rpn_bbox_ind, cls_score=mx.sym.BlockGrad(rpn_cls_score),
+                                  bbox_pred=mx.sym.BlockGrad(rpn_bbox_loss), op_type='rpn_sparse_label', name='rpn_sparse_label')
             # RPN classification loss
             rpn_cls_output = mx.sym.SoftmaxOutput(data=rpn_cls_score, label=rpn_label, multi_output=True, normalization='valid',
                                                   use_ignore=True, ignore_label=-1, name='rpn_cls_prob')
             # bounding box regression
             rpn_bbox_loss = rpn_bbox_weight * mx.sym.smooth_l1(name='rpn_bbox_loss_l1', scalar=3.0, data=(rpn_bbox_loss - rpn_bbox_target))
-            rpn_bbox_loss = mx.sym.MakeLoss(name='rpn_bbox_loss', data=rpn_bbox_loss, grad_scale=1.0 / cfg.TRAIN.RPN_BATCH_SIZE)
+            # RPN_BATCH_SIZE anchors are sampled from every image
+            rpn_bbox_loss = mx.sym.MakeLoss(name='rpn_bbox_loss', data=rpn_bbox_loss,
+                                            grad_scale=1.0 / (cfg.TRAIN.RPN_BATCH_SIZE * cfg.TRAIN.BATCH_IMAGES))
 
             aux_dict = {
-                'op_type': 'pyramid_proposal', 'name': 'rois',
+                'op_type': 'pyramid_proposal_nd' if cfg.TRAIN.RPN_PROPOSAL_ND else 'pyramid_proposal', 'name': 'rois',
                 'im_info': im_info, 'feat_stride': tuple(cfg.network.RPN_FEAT_STRIDE),
                 'scales': tuple(cfg.network.ANCHOR_SCALES), 'ratios': tuple(cfg.network.ANCHOR_RATIOS),
                 'rpn_pre_nms_top_n': cfg.TRAIN.RPN_PRE_NMS_TOP_N, 'rpn_post_nms_top_n': cfg.TRAIN.RPN_POST_NMS_TOP_N,
-                'threshold': cfg.TRAIN.RPN_NMS_THRESH, 'rpn_min_size': cfg.TRAIN.RPN_MIN_SIZE
+                'threshold': cfg.TRAIN.RPN_NMS_THRESH, 'rpn_min_size': cfg.TRAIN.RPN_MIN_SIZE,
+                'nms_backend': cfg.TRAIN.RPN_NMS_BACKEND, 'pre_nms_per_level': cfg.TRAIN.RPN_PRE_NMS_PER_LEVEL
             }
 
             # ROI proposal
@@ -877,11 +901,13 @@ class resnet_v1_101_fpn_rcnn_l2_focal(Symbol):
                                 batch_rois=cfg.TRAIN.BATCH_ROIS, cfg=cPickle.dumps(cfg), fg_fraction=cfg.TRAIN.FG_FRACTION)
         else:
             aux_dict = {
-                'op_type': 'pyramid_proposal', 'name': 'rois',
+                'op_type': 'pyramid_proposal_nd' if cfg.TEST.RPN_PROPOSAL_ND else 'pyramid_proposal', 'name': 'rois',
                 'im_info': im_info, 'feat_stride': tuple(cfg.network.RPN_FEAT_STRIDE),
                 'scales': tuple(cfg.network.ANCHOR_SCALES), 'ratios': tuple(cfg.network.ANCHOR_RATIOS),
                 'rpn_pre_nms_top_n': cfg.TEST.RPN_PRE_NMS_TOP_N, 'rpn_post_nms_top_n': cfg.TEST.RPN_POST_NMS_TOP_N,
-                'threshold': cfg.TEST.RPN_NMS_THRESH, 'rpn_min_size': cfg.TEST.RPN_MIN_SIZE
+                'threshold': cfg.TEST.RPN_NMS_THRESH, 'rpn_min_size': cfg.TEST.RPN_MIN_SIZE,
+                'nms_backend': cfg.TEST.RPN_NMS_BACKEND, 'pre_nms_per_level': cfg.TEST.RPN_PRE_NMS_PER_LEVEL,
+                'prewarm_shapes': tuple(tuple(shape) for shape in cfg.TEST.RPN_PREWARM_SHAPES)
             }
             # ROI proposal
             rois = mx.sym.Custom(**dict(arg_dict.items() + aux_dict.items()))
@@ -53,7 +53,9 @@ from utils.create_logger import create_logger
 from utils.load_data import load_gt_roidb, merge_roidb, filter_roidb
 from utils.load_model import load_param
 from utils.PrefetchingIter import PrefetchingIter
+from utils.ProcessPrefetchingIter import ProcessPrefetchingIter
 from utils.lr_scheduler import WarmupMultiFactorScheduler
+from rpn.anchor_grid import set_anchor_cache_bytes
 
 
 def train_net(args, ctx, pretrained, epoch, prefix, begin_epoch, end_epoch, lr, lr_step):
@@ -63,6 +65,7 @@ def train_net(args, ctx, pretrained, epoch, prefix, begin_epoch, end_epoch, lr,
         os.mkdir(config.output_path)
     logger, final_output_path = create_logger(config.output_path, args.cfg, config.dataset.image_set)
     prefix = os.path.join(final_output_path, prefix)
+    set_anchor_cache_bytes(config.ANCHOR_CACHE_BYTES)
 
     # load symbol
     shutil.copy2(os.path.join(curr_path, 'symbols', config.symbol + '.py'), final_output_path)
@@ -136,9 +139,9 @@ def train_net(args, ctx, pretrained, epoch, prefix, begin_epoch, end_epoch, lr,
 
     # decide training params
     # metric
-    rpn_eval_metric = metric.RPNAccMetric()
-    rpn_cls_metric = metric.RPNLogLossMetric()
-    rpn_bbox_metric = metric.RPNL1LossMetric()
+    rpn_eval_metric = metric.RPNAccMetric(config.TRAIN.RPN_SPARSE_LABEL)
+    rpn_cls_metric = metric.RPNLogLossMetric(config.TRAIN.RPN_SPARSE_LABEL)
+    rpn_bbox_metric = metric.RPNL1LossMetric(config.TRAIN.RPN_SPARSE_LABEL)
     rpn_fg_metric = metric.RPNFGFraction(config)
     eval_metric = metric.RCNNAccMetric(config)
     eval_fg_metric = metric.RCNNFGAccuracy(config)
@@ -170,8 +173,11 @@ def train_net(args, ctx, pretrained, epoch, prefix, begin_epoch, end_epoch, lr,
                         'lr_scheduler': lr_scheduler,
                         'clip_gradient': None}
     #
-    if not isinstance(train_data, PrefetchingIter):
-        train_data = PrefetchingIter(train_data)
+    if config.TRAIN.LOADER_WORKERS > 0:
+        train_data = ProcessPrefetchingIter(train_data, num_workers=config.TRAIN.LOADER_WORKERS,
+                                            depth=config.TRAIN.LOADER_DEPTH)
+    elif not isinstance(train_data, PrefetchingIter):
+        train_data = PrefetchingIter(train_data, depth=config.TRAIN.LOADER_DEPTH)
 
     # train
     mod.fit(train_data, eval_metric=eval_metrics, epoch_end_callback=epoch_end_callback,
@@ -55,3 +55,107 @@ def bbox_overlaps_cython(
                     )
                     overlaps[n, k] = iw * ih / ua
     return overlaps
+
+
+ctypedef fused box_t:
+    float
+    double
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def bbox_overlaps_sorted_cython(const box_t[:, ::1] boxes, const box_t[:, ::1] query_boxes, bint sparse=False):
+    """
+    overlaps of bbox_overlaps_cython, skipping pairs that cannot intersect along x
+    boxes are visited in x1 order: with the +1 of the widths, only boxes with
+    query x1 - max box width - 1 <= x1 < query x2 + 1 can overlap a query box
+    Parameters
+    ----------
+    boxes: (N, 4) C contiguous float32 or float64 ndarray, may be read only
+    query_boxes: (K, 4) ndarray of the same dtype
+    sparse: return the nonzero overlaps only
+    Returns
+    -------
+    overlaps: (N, K) ndarray of the input dtype, or
+    (rows, cols, ious) of the nonzero overlaps when sparse, ordered by col
+    """
+    cdef Py_ssize_t N = boxes.shape[0]
+    cdef Py_ssize_t K = query_boxes.shape[0]
+    dtype = np.float32 if box_t is float else np.float64
+    boxes_arr = np.asarray(boxes)
+    # anchors come in nearly sorted runs, which mergesort handles in about linear time
+    order_arr = np.argsort(boxes_arr[:, 0], kind='mergesort')
+    cdef np.intp_t[::1] order = order_arr
+    cdef box_t[:, ::1] sorted_boxes = np.ascontiguousarray(boxes_arr[order_arr])
+    cdef box_t[:, ::1] dense
+    cdef np.intp_t[::1] rows
+    cdef np.intp_t[::1] cols
+    cdef box_t[::1] ious
+    cdef Py_ssize_t count = 0, capacity = 0
+    cdef box_t max_width = 0, width, iw, ih, box_area, ua, iou
+    cdef Py_ssize_t k, i, n, lo, hi
+
+    if sparse:
+        capacity = max(N, 16)
+        rows_arr = np.empty(capacity, dtype=np.intp)
+        cols_arr = np.empty(capacity, dtype=np.intp)
+        ious_arr = np.empty(capacity, dtype=dtype)
+        rows, cols, ious = rows_arr, cols_arr, ious_arr
+    else:
+        dense_arr = np.zeros((N, K), dtype=dtype)
+        dense = dense_arr
+
+    for i in range(N):
+        width = sorted_boxes[i, 2] - sorted_boxes[i, 0]
+        if width > max_width:
+            max_width = width
+
+    for k in range(K):
+        box_area = (
+            (query_boxes[k, 2] - query_boxes[k, 0] + 1) *
+            (query_boxes[k, 3] - query_boxes[k, 1] + 1)
+        )
+        # binary search the span of candidate x1
+        lo, hi = 0, N
+        while lo < hi:
+            i = (lo + hi) // 2
+            if sorted_boxes[i, 0] < query_boxes[k, 0] - max_width - 1:
+                lo = i + 1
+            else:
+                hi = i
+        for i in range(lo, N):
+            if sorted_boxes[i, 0] >= query_boxes[k, 2] + 1:
+                break
+            iw = (
+                min(sorted_boxes[i, 2], query_boxes[k, 2]) -
+                max(sorted_boxes[i, 0], query_boxes[k, 0]) + 1
+            )
+            if iw > 0:
+                ih = (
+                    min(sorted_boxes[i, 3], query_boxes[k, 3]) -
+                    max(sorted_boxes[i, 1], query_boxes[k, 1]) + 1
+                )
+                if ih > 0:
+                    ua = (
+                        (sorted_boxes[i, 2] - sorted_boxes[i, 0] + 1) *
+                        (sorted_boxes[i, 3] - sorted_boxes[i, 1] + 1) +
+                        box_area - iw * ih
+                    )
+                    iou = iw * ih / ua
+                    n = order[i]
+                    if not sparse:
+                        dense[n, k] = iou
+                        continue
+                    if count == capacity:
+                        capacity *= 2
+                        rows_arr = np.resize(rows_arr, capacity)
+                        cols_arr = np.resize(cols_arr, capacity)
+                        ious_arr = np.resize(ious_arr, capacity)
+                        rows, cols, ious = rows_arr, cols_arr, ious_arr
+                    rows[count] = n
+                    cols[count] = k
+                    ious[count] = iou
+                    count += 1
+    if sparse:
+        return rows_arr[:count], cols_arr[:count], ious_arr[:count]
+    return dense_arr
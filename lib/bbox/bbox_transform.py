@@ -12,13 +12,39 @@
 # --------------------------------------------------------
 
 import numpy as np
-from bbox import bbox_overlaps_cython
+from bbox import bbox_overlaps_cython, bbox_overlaps_sorted_cython
 np.set_printoptions(threshold=np.nan)
 
-def bbox_overlaps(boxes, query_boxes):
+def bbox_overlaps(boxes, query_boxes, kernel='dense'):
+    """
+    determine overlaps between boxes and query_boxes
+    :param kernel: 'dense' visits every pair, 'sorted' sorts boxes by x1 and skips pairs apart along x,
+    which pays off when boxes are many and small compared to the image, e.g. anchors
+    :return: overlaps: n * k overlaps, float64 for 'dense', the input dtype (float32 or float64) for 'sorted'
+    """
+    if kernel == 'sorted':
+        boxes, query_boxes = _kernel_inputs(boxes, query_boxes)
+        return bbox_overlaps_sorted_cython(boxes, query_boxes)
+    assert kernel == 'dense', 'unknown bbox_overlaps kernel {}'.format(kernel)
     return bbox_overlaps_cython(boxes, query_boxes)
 
 
+def bbox_overlaps_sparse(boxes, query_boxes):
+    """
+    nonzero overlaps between boxes and query_boxes
+    :param boxes: n * 4 bounding boxes
+    :param query_boxes: k * 4 bounding boxes
+    :return: (rows, cols, ious) ordered by col
+    """
+    boxes, query_boxes = _kernel_inputs(boxes, query_boxes)
+    return bbox_overlaps_sorted_cython(boxes, query_boxes, True)
+
+
+def _kernel_inputs(boxes, query_boxes):
+    dtype = np.float32 if boxes.dtype == np.float32 and query_boxes.dtype == np.float32 else np.float64
+    return np.ascontiguousarray(boxes[:, :4], dtype=dtype), np.ascontiguousarray(query_boxes[:, :4], dtype=dtype)
+
+
 def bbox_overlaps_py(boxes, query_boxes):
     """
     determine overlaps between boxes and query_boxes
@@ -1,7 +1,16 @@
 import numpy as np
 
-from cpu_nms import cpu_nms
-from gpu_nms import gpu_nms
+# the compiled kernels are optional, nms_wrapper falls back to the numpy path without them
+try:
+    from cpu_nms import cpu_nms
+except ImportError:
+    cpu_nms = None
+try:
+    from gpu_nms import gpu_nms
+except ImportError:
+    gpu_nms = None
+
+NMS_BACKENDS = ('auto', 'gpu', 'cpu', 'numpy')
 
 
 def py_nms_wrapper(thresh):
@@ -28,6 +37,151 @@ def gpu_nms_wrapper(thresh, device_id):
     return _nms
 
 
+def numpy_nms_wrapper(thresh, max_keep=-1):
+    def _nms(dets):
+        return vectorized_nms(dets, thresh, max_keep)
+    return _nms
+
+
+def _resolve_backend(backend, device_id):
+    """ the backend nms_wrapper runs: 'gpu', 'cpu' or 'numpy' """
+    assert backend in NMS_BACKENDS, 'unknown nms backend {}, use one of {}'.format(backend, NMS_BACKENDS)
+    if backend == 'auto':
+        backend = 'gpu' if device_id is not None else 'numpy'
+    if backend == 'gpu':
+        assert device_id is not None, 'gpu nms needs the data on a gpu'
+        if gpu_nms is None:
+            backend = 'cpu'
+    if backend == 'cpu' and cpu_nms is None:
+        backend = 'numpy'
+    return backend
+
+
+def nms_wrapper(backend, thresh, device_id=None, max_keep=-1):
+    """
+    nms function of a backend
+    :param backend: 'gpu' gpu_nms, 'cpu' Cython cpu_nms, 'numpy' vectorized_nms, or 'auto' to pick gpu_nms
+    for a gpu device and vectorized_nms otherwise, it beats cpu_nms; a kernel that is not built falls back to 'numpy'
+    :param thresh: retain overlap < thresh
+    :param device_id: gpu of the data, None for cpu data
+    :param max_keep: only the first max_keep indexes are needed, all of them if max_keep <= 0
+    :return: function dets -> indexes to keep, at most max_keep of them
+    """
+    backend = _resolve_backend(backend, device_id)
+    if backend == 'numpy':
+        return numpy_nms_wrapper(thresh, max_keep)
+    _nms = gpu_nms_wrapper(thresh, device_id) if backend == 'gpu' else cpu_nms_wrapper(thresh)
+    if max_keep <= 0:
+        return _nms
+    return lambda dets: _nms(dets)[:max_keep]
+
+
+def batched_nms_wrapper(backend, thresh, device_id=None, max_keep=-1):
+    """
+    nms of boxes in groups (crop channels, classes) in one call, a box only suppresses boxes of its own group
+    vectorized_nms sorts once and runs every group on its own, the compiled kernels run once per group:
+    moving the groups apart along x instead would round the float32 coordinates and flip boxes near thresh
+    :param backend: see nms_wrapper
+    :param max_keep: only the first max_keep indexes of every group are needed, all of them if max_keep <= 0
+    :return: function (dets, groups) -> indexes to keep, the same as nms on the dets of every group,
+    one group after another in ascending group order, in score order within a group
+    """
+    backend = _resolve_backend(backend, device_id)
+    if backend == 'numpy':
+        def _nms(dets, groups):
+            return vectorized_nms(dets, thresh, max_keep, groups=groups)
+        return _nms
+    _nms = nms_wrapper(backend, thresh, device_id, max_keep)
+
+    def _batched_nms(dets, groups):
+        if dets.shape[0] == 0:
+            return []
+        groups = np.asarray(groups).ravel()
+        order = np.argsort(groups, kind='mergesort')
+        bounds = np.flatnonzero(np.diff(groups[order])) + 1
+        keep = []
+        for group_inds in np.split(order, bounds):
+            keep.extend(group_inds[np.asarray(_nms(dets[group_inds, :]), dtype=int)])
+        return keep
+    return _batched_nms
+
+
+def vectorized_nms(dets, thresh, max_keep=-1, groups=None, block_size=512):
+    """
+    the greedy selection of nms, computed a block (up to block_size boxes) at a time in score order:
+    a block is first checked against all kept boxes at once, then against itself with one overlap matrix,
+    so the python loop only does a vector or of a block row per kept box; stops once max_keep boxes are kept
+    :param dets: [[x1, y1, x2, y2 score]]
+    :param thresh: retain overlap <= thresh
+    :param max_keep: stop after this many boxes (of every group), never if max_keep <= 0
+    :param groups: optional [len(dets)] group of every box, boxes only suppress boxes of their own group
+    :return: indexes to keep, the same as nms(dets, thresh)[:max_keep] on the dets of every group,
+    one group after another in ascending group order
+    """
+    if dets.shape[0] == 0:
+        return []
+
+    x1 = dets[:, 0]
+    y1 = dets[:, 1]
+    x2 = dets[:, 2]
+    y2 = dets[:, 3]
+    scores = dets[:, 4]
+
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+    if groups is None:
+        order = scores.argsort()[::-1]
+        return _greedy_nms(x1, y1, x2, y2, areas, order, thresh, max_keep, block_size)
+
+    # score order within every group, the groups one after another
+    groups = np.asarray(groups).ravel()
+    order = np.lexsort((-scores, groups))
+    bounds = np.flatnonzero(np.diff(groups[order])) + 1
+    keep = []
+    for group_order in np.split(order, bounds):
+        keep.extend(_greedy_nms(x1, y1, x2, y2, areas, group_order, thresh, max_keep, block_size))
+    return keep
+
+
+def _greedy_nms(x1, y1, x2, y2, areas, order, thresh, max_keep, block_size):
+    """ kept indexes of order, see vectorized_nms """
+    if max_keep <= 0:
+        max_keep = order.size
+
+    keep = []
+    start = 0
+    # blocks grow from a few times the boxes still wanted, a small max_keep rarely needs a full block
+    size = min(block_size, max(64, 2 * max_keep))
+    while start < order.size:
+        block = order[start:start + size]
+        start += size
+        size = min(block_size, 2 * size)
+        suppressed = np.zeros((len(block),), dtype=bool)
+        if keep:
+            suppressed = (_overlaps(x1, y1, x2, y2, areas, np.array(keep), block) > thresh).any(axis=0)
+        block_suppress = _overlaps(x1, y1, x2, y2, areas, block, block) > thresh
+        for j in range(len(block)):
+            if suppressed[j]:
+                continue
+            keep.append(block[j])
+            if len(keep) == max_keep:
+                return keep
+            suppressed |= block_suppress[j]
+    return keep
+
+
+def _overlaps(x1, y1, x2, y2, areas, rows, cols):
+    """ [len(rows), len(cols)] overlaps of nms, with its arithmetic """
+    xx1 = np.maximum(x1[rows, np.newaxis], x1[cols])
+    yy1 = np.maximum(y1[rows, np.newaxis], y1[cols])
+    xx2 = np.minimum(x2[rows, np.newaxis], x2[cols])
+    yy2 = np.minimum(y2[rows, np.newaxis], y2[cols])
+
+    w = np.maximum(0.0, xx2 - xx1 + 1)
+    h = np.maximum(0.0, yy2 - yy1 + 1)
+    inter = w * h
+    return inter / (areas[rows, np.newaxis] + areas[cols] - inter)
+
+
 def nms(dets, thresh):
     """
     greedily select boxes with high confidence and overlap with current maximum <= thresh
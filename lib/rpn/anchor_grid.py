@@ -0,0 +1,149 @@
+# --------------------------------------------------------
+# Deformable Convolutional Networks
+# Copyright (c) 2017 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""
+Shifted anchors of a feature map, replicated for every crop, memoized.
+The grid of a level only depends on (feat_height, feat_width, stride, scales, ratios, crop_nums),
+so the anchor loader and the proposal operator share one cache of them, bounded in bytes
+by set_anchor_cache_bytes (config.ANCHOR_CACHE_BYTES). Returned arrays are read only.
+"""
+
+import threading
+from collections import OrderedDict
+import numpy as np
+
+from generate_anchor import generate_anchors
+
+# byte budget of every anchor cache, see set_anchor_cache_bytes
+_anchor_cache_bytes = 256 * 1024 * 1024
+
+
+def set_anchor_cache_bytes(max_bytes):
+    """
+    byte budget of each anchor cache (anchor grids, inside indices, zero bbox target maps and the
+    anchors of the proposal operators), caches already filled shrink on their next put
+    :param max_bytes: config.ANCHOR_CACHE_BYTES
+    """
+    global _anchor_cache_bytes
+    _anchor_cache_bytes = int(max_bytes)
+
+
+def _nbytes(value):
+    """ bytes of an array, an NDArray or a tuple of them """
+    if isinstance(value, (tuple, list)):
+        return sum([_nbytes(x) for x in value])
+    if hasattr(value, 'nbytes'):
+        return value.nbytes
+    return value.size * np.dtype(value.dtype).itemsize
+
+
+class _LRUCache(object):
+    """
+    LRU cache bounded by the bytes of its values
+    :param max_bytes: byte budget, None follows set_anchor_cache_bytes
+    """
+    def __init__(self, max_bytes=None):
+        self._max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def max_bytes(self):
+        return _anchor_cache_bytes if self._max_bytes is None else self._max_bytes
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            self._entries[key] = entry
+            return entry[0]
+
+    def put(self, key, value):
+        nbytes = _nbytes(value)
+        max_bytes = self.max_bytes
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[1]
+            if nbytes > max_bytes:
+                return
+            while self._entries and self.nbytes + nbytes > max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= evicted[1]
+            self._entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+
+_anchor_grids = _LRUCache()
+_inside_inds = _LRUCache()
+
+
+def _grid_key(feat_height, feat_width, stride, scales, ratios, crop_nums):
+    scales = np.asarray(scales, dtype=np.float64)
+    ratios = np.asarray(ratios, dtype=np.float64)
+    return (int(feat_height), int(feat_width), int(stride), scales.shape, tuple(scales.ravel()),
+            ratios.shape, tuple(ratios.ravel()), int(crop_nums))
+
+
+def get_anchor_grid(feat_height, feat_width, stride, scales, ratios, crop_nums=1):
+    """
+    anchors of a feature map for every crop
+    :param stride: feature stride, also the anchor base size
+    :param scales: anchor scales
+    :param ratios: anchor aspect ratios
+    :param crop_nums: number of crops the grid is replicated for
+    :return: (crop_nums * feat_height * feat_width * A, 4) anchors ordered by (crop, h, w, a)
+    """
+    key = _grid_key(feat_height, feat_width, stride, scales, ratios, crop_nums)
+    anchors = _anchor_grids.get(key)
+    if anchors is not None:
+        return anchors
+    base_anchors = generate_anchors(base_size=stride, ratios=ratios, scales=scales)
+    shift_x = np.arange(0, feat_width) * stride
+    shift_y = np.arange(0, feat_height) * stride
+    shift_x, shift_y = np.meshgrid(shift_x, shift_y)
+    shifts = np.vstack((shift_x.ravel(), shift_y.ravel(), shift_x.ravel(), shift_y.ravel())).transpose()
+    # add A anchors (1, A, 4) to cell K shifts (K, 1, 4) to get shift anchors (K, A, 4)
+    A = base_anchors.shape[0]
+    K = shifts.shape[0]
+    grid = base_anchors.reshape((1, A, 4)) + shifts.reshape((1, K, 4)).transpose((1, 0, 2))
+    anchors = np.tile(grid.reshape((K * A, 4)), (int(crop_nums), 1))
+    anchors.flags.writeable = False
+    _anchor_grids.put(key, anchors)
+    return anchors
+
+
+def get_inds_inside(feat_height, feat_width, stride, scales, ratios, crop_nums, im_height, im_width,
+                    allowed_border=0):
+    """
+    indices into get_anchor_grid(...) of the anchors inside an image
+    :param im_height: image height from im_info
+    :param im_width: image width from im_info
+    :param allowed_border: anchors may cross the image border by this much
+    :return: sorted int64 indices
+    """
+    key = _grid_key(feat_height, feat_width, stride, scales, ratios, crop_nums) + \
+        (float(im_height), float(im_width), float(allowed_border))
+    inds_inside = _inside_inds.get(key)
+    if inds_inside is not None:
+        return inds_inside
+    anchors = get_anchor_grid(feat_height, feat_width, stride, scales, ratios, 1)
+    inds = np.where((anchors[:, 0] >= -allowed_border) &
+                    (anchors[:, 1] >= -allowed_border) &
+                    (anchors[:, 2] < im_width + allowed_border) &
+                    (anchors[:, 3] < im_height + allowed_border))[0]
+    # every crop repeats the same grid
+    inds_inside = (inds[np.newaxis, :] + np.arange(int(crop_nums))[:, np.newaxis] * anchors.shape[0]).ravel()
+    inds_inside.flags.writeable = False
+    _inside_inds.put(key, inds_inside)
+    return inds_inside
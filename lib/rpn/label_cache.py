@@ -0,0 +1,77 @@
+# --------------------------------------------------------
+# Deformable Convolutional Networks
+# Copyright (c) 2017 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""
+Disk cache of the anchor labels assign_pyramid_anchor computes before fg/bg subsampling.
+Matching anchors to gt boxes only depends on the gt boxes, im_info, the feature shapes and
+the anchor settings, so an entry is addressed by a hash of those. Entries live in
+<cache path>/<hash of the anchor settings>/, changing any anchor setting starts a new directory.
+An entry keeps the pre-sampling labels sparse: the indices of positive anchors with their gt
+box and the indices of ignored anchors, every other inside anchor is negative.
+"""
+
+import os
+import hashlib
+import numpy as np
+
+
+def _settings_hash(cfg, feat_strides, scales, ratios, allowed_border):
+    settings = (tuple(np.asarray(feat_strides).ravel()), np.asarray(scales).shape, tuple(np.asarray(scales).ravel()),
+                np.asarray(ratios).shape, tuple(np.asarray(ratios).ravel()), float(allowed_border), cfg.CROP_NUM,
+                tuple(np.asarray(cfg.network.ANCHOR_SCALES).ravel()), tuple(np.asarray(cfg.network.ANCHOR_RATIOS).ravel()),
+                tuple(np.asarray(cfg.network.RPN_FEAT_STRIDE).ravel()),
+                cfg.TRAIN.RPN_POSITIVE_OVERLAP, cfg.TRAIN.RPN_NEGATIVE_OVERLAP, cfg.TRAIN.RPN_CLOBBER_POSITIVES)
+    return hashlib.md5(repr(settings).encode('utf-8')).hexdigest()[:16]
+
+
+def anchor_label_path(cfg, feat_shapes, gt_boxes, im_info, feat_strides, scales, ratios, allowed_border):
+    """
+    :return: cache file of these inputs, or None when cfg.TRAIN.RPN_LABEL_CACHE is not set
+    """
+    if not cfg.TRAIN.RPN_LABEL_CACHE:
+        return None
+    content = hashlib.md5()
+    content.update(np.ascontiguousarray(gt_boxes, dtype=np.float64).tostring())
+    content.update(np.asarray(im_info, dtype=np.float64)[:2].tostring())
+    content.update(repr([tuple(shape[0][-2:]) for shape in feat_shapes]).encode('utf-8'))
+    return os.path.join(cfg.TRAIN.RPN_LABEL_CACHE,
+                        _settings_hash(cfg, feat_strides, scales, ratios, allowed_border),
+                        content.hexdigest() + '.npz')
+
+
+def load_anchor_labels(path, num_anchors):
+    """
+    :return: pre-sampling labels [num_anchors] float32 and argmax_overlaps [num_anchors] (valid for positives),
+    or None if there is no entry
+    """
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as entry:
+        fg_inds, fg_gt, ignore_inds = entry['fg_inds'], entry['fg_gt'], entry['ignore_inds']
+    labels = np.zeros((num_anchors,), dtype=np.float32)
+    labels[ignore_inds] = -1
+    labels[fg_inds] = 1
+    argmax_overlaps = np.zeros((num_anchors,), dtype=int)
+    argmax_overlaps[fg_inds] = fg_gt
+    return labels, argmax_overlaps
+
+
+def save_anchor_labels(path, labels, argmax_overlaps):
+    """ store labels, all of them 1, 0 or -1, written through a temporary file so readers never see a partial entry """
+    fg_inds = np.where(labels >= 1)[0]
+    entry = {'fg_inds': fg_inds.astype(np.int32), 'fg_gt': argmax_overlaps[fg_inds].astype(np.int32),
+             'ignore_inds': np.where(labels < 0)[0].astype(np.int32)}
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # made by another loader process meanwhile
+            pass
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as fid:
+        np.savez(fid, **entry)
+    os.rename(tmp_path, path)
@@ -27,8 +27,13 @@ import numpy.random as npr
 
 from utils.image import get_image, tensor_vstack,get_crop_image
 from generate_anchor import generate_anchors
+from anchor_grid import _LRUCache, get_anchor_grid, get_inds_inside
+from label_cache import anchor_label_path, load_anchor_labels, save_anchor_labels
 from bbox.bbox_transform import bbox_overlaps, bbox_transform
 
+# all zero (1, A * 4, crops * H * W) bbox_target / bbox_weight maps of labels without positives, read only
+_zero_bbox_maps = _LRUCache()
+
 
 def get_rpn_testbatch(roidb, cfg):
     """
@@ -51,27 +56,30 @@ def get_rpn_testbatch(roidb, cfg):
 def get_rpn_batch(roidb, cfg):
     """
     prototype for rpn batch: data, im_info, gt_boxes
-    :param roidb: ['image', 'flipped'] + ['gt_boxes', 'boxes', 'gt_classes']
+    :param roidb: ['image', 'flipped'] + ['gt_boxes', 'boxes', 'gt_classes'], one entry per image
     :return: data, label
+    'data': images padded to the largest one by tensor_vstack, 'im_info': [num_images, 3]
+    'gt_boxes': list of [num_boxes, 6] (x1, y1, x2, y2, cls, channel) per image
     """
-    assert len(roidb) == 1, 'Single batch only'
     imgs, roidb = get_crop_image(roidb, cfg)
-    im_array = imgs[0]
-    im_info = np.array([roidb[0]['im_info']], dtype=np.float32)
-
-    # change gt boxes: (x1, y1, x2, y2, cls) to (x1,y1,x2,y2,channel,cls)
-    if roidb[0]['gt_classes'].size > 0:
-        gt_inds = np.where(roidb[0]['gt_classes'] != 0)[0]
-        gt_boxes = np.empty((roidb[0]['boxes'].shape[0], 6), dtype=np.float32)
-        gt_boxes[:, 0:4] = roidb[0]['boxes'][gt_inds, :]
-        gt_boxes[:, 4] = roidb[0]['gt_classes'][gt_inds]
-        gt_boxes[:, 5] = roidb[0]['box_channels'][gt_inds] #add channel_index to the gt_boxes
-    else:
-        gt_boxes = np.empty((0, 6), dtype=np.float32) #
-    #print "gt_boxes:"+str(gt_boxes.shape)
+    im_array = tensor_vstack(imgs)
+    im_info = np.array([rec['im_info'] for rec in roidb], dtype=np.float32)
+
+    gt_boxes_list = []
+    for rec in roidb:
+        # change gt boxes: (x1, y1, x2, y2, cls) to (x1,y1,x2,y2,cls,channel)
+        if rec['gt_classes'].size > 0:
+            gt_inds = np.where(rec['gt_classes'] != 0)[0]
+            gt_boxes = np.empty((len(gt_inds), 6), dtype=np.float32)
+            gt_boxes[:, 0:4] = rec['boxes'][gt_inds, :]
+            gt_boxes[:, 4] = rec['gt_classes'][gt_inds]
+            gt_boxes[:, 5] = rec['box_channels'][gt_inds] #add channel_index to the gt_boxes
+        else:
+            gt_boxes = np.empty((0, 6), dtype=np.float32)
+        gt_boxes_list.append(gt_boxes)
     data = {'data': im_array,
             'im_info': im_info}
-    label = {'gt_boxes': gt_boxes}
+    label = {'gt_boxes': gt_boxes_list}
 
     return data, label
 
@@ -242,6 +250,188 @@ def assign_anchor(feat_shape, gt_boxes, im_info, cfg, feat_stride=16,
     return label
 
 
+def _crop_block_overlaps(anchors, gt_boxes, blocks, kernel='dense'):
+    """
+    match anchors against the ground truth boxes of their own crop
+    the overlap matrix is block sparse: anchor rows of a (level, crop) block only meet the
+    gt boxes whose channel (gt_boxes[:, 5]) is that crop, every other entry is 0
+    :param anchors: [N, 4] inside anchors of all levels
+    :param gt_boxes: [G, 6] x1, y1, x2, y2, class, crop channel
+    :param blocks: per level, per crop (start, end) rows of anchors
+    :param kernel: bbox_overlaps kernel
+    :return: argmax_overlaps [N] gt index, max_overlaps [N], gt_argmax_overlaps anchors with the highest overlap of some gt
+    """
+    gt_crops = gt_boxes[:, 5].astype(int)
+    crop_gt_inds = [np.where(gt_crops == j)[0] for j in range(len(blocks[0]))] if blocks else []
+    argmax_overlaps = np.zeros((len(anchors),), dtype=int)
+    max_overlaps = np.zeros((len(anchors),))
+    gt_max_overlaps = np.zeros((gt_boxes.shape[0],))
+    block_overlaps = []
+    for level_blocks in blocks:
+        for (start, end), gt_inds in zip(level_blocks, crop_gt_inds):
+            if start == end or len(gt_inds) == 0:
+                continue
+            overlaps = bbox_overlaps(anchors[start:end, :].astype(np.float), gt_boxes[gt_inds, :4].astype(np.float),
+                                     kernel=kernel)
+            block_argmax = overlaps.argmax(axis=1)
+            argmax_overlaps[start:end] = gt_inds[block_argmax]
+            max_overlaps[start:end] = overlaps[np.arange(end - start), block_argmax]
+            gt_max_overlaps[gt_inds] = np.maximum(gt_max_overlaps[gt_inds], overlaps.max(axis=0))
+            block_overlaps.append((start, gt_inds, overlaps))
+    gt_argmax_overlaps = []
+    for start, gt_inds, overlaps in block_overlaps:
+        # a gt no anchor overlaps has no best anchor
+        gt_max = gt_max_overlaps[gt_inds]
+        rows = np.where((overlaps == gt_max) & (gt_max > 0))[0]
+        gt_argmax_overlaps.append(start + rows)
+    gt_argmax_overlaps = np.unique(np.concatenate(gt_argmax_overlaps)) if gt_argmax_overlaps else np.zeros((0,), dtype=int)
+    return argmax_overlaps, max_overlaps, gt_argmax_overlaps
+
+
+def _pyramid_label_index(fpn_inds_inside, fpn_args, rows):
+    """
+    where inside anchors go in the label maps of assign_pyramid_anchor
+    :param fpn_inds_inside: inside anchors of every level, (crop, h, w, a) ordered indices into the level
+    :param fpn_args: [feat_height, feat_width, A, total_anchors] of every level
+    :param rows: indices into the inside anchors of all levels, concatenated
+    :return: A, number of (crop, h, w) cells of all levels,
+    flat indices [len(rows)] into the (A * crops * H * W) label,
+    flat indices [len(rows), 4] into the (A * 4, crops * H * W) bbox_target and bbox_weight
+    """
+    A = fpn_args[0][2]
+    # (crop, h, w) cells of every level, the maps hold the levels one after another
+    level_cells = np.array([total_anchors // A for _, _, _, total_anchors in fpn_args])
+    num_cells = int(level_cells.sum())
+    cell_starts = np.hstack((0, level_cells.cumsum()))[:-1]
+
+    # look the rows up level by level instead of concatenating all inside anchors
+    row_starts = np.hstack((0, np.cumsum([len(inds) for inds in fpn_inds_inside])))
+    level = np.searchsorted(row_starts, rows, side='right') - 1
+    anchor = np.empty((len(rows),), dtype=int)
+    for feat_id, inds_inside in enumerate(fpn_inds_inside):
+        in_level = level == feat_id
+        anchor[in_level] = inds_inside[rows[in_level] - row_starts[feat_id]]
+    a, cell = anchor % A, anchor // A
+    label_ind = A * cell_starts[level] + a * level_cells[level] + cell
+    bbox_ind = (4 * a[:, np.newaxis] + np.arange(4)) * num_cells + (cell_starts[level] + cell)[:, np.newaxis]
+    return A, num_cells, label_ind, bbox_ind
+
+
+def _sample_rows(num_rows, num_samples):
+    """
+    num_samples distinct rows of range(num_rows), uniformly at random
+    npr.choice without replacement shuffles all num_rows, this draws about num_samples numbers when they are few
+    :return: sorted int indices
+    """
+    if num_samples >= num_rows:
+        return np.arange(num_rows)
+    if 4 * num_samples > num_rows:
+        return np.sort(npr.choice(num_rows, size=num_samples, replace=False))
+    rows = np.zeros((0,), dtype=int)
+    while len(rows) < num_samples:
+        rows = np.union1d(rows, npr.randint(0, num_rows, size=num_samples - len(rows) + 16))
+    # every subset of one size is equally likely, so is a random subset of it
+    return np.sort(rows[npr.permutation(len(rows))[:num_samples]])
+
+
+def _get_zero_bbox_maps(A, num_cells):
+    zero_maps = _zero_bbox_maps.get((A, num_cells))
+    if zero_maps is None:
+        zero_maps = np.zeros((1, A * 4, num_cells), dtype=np.float32)
+        zero_maps.flags.writeable = False
+        _zero_bbox_maps.put((A, num_cells), zero_maps)
+    return zero_maps
+
+
+def _pyramid_label(rows, row_labels, fpn_bbox_targets, fpn_inds_inside, fpn_args, cfg):
+    """
+    label maps of assign_pyramid_anchor from its sampled anchors
+    :param rows: indices into the inside anchors of all levels, concatenated, of the sampled anchors
+    :param row_labels: [len(rows)] 1 or 0
+    :param fpn_bbox_targets: [num fg, 4] targets of the positive rows, in order
+    :return: dict of label, see assign_pyramid_anchor, or _sparse_pyramid_label with cfg.TRAIN.RPN_SPARSE_LABEL
+    """
+    if cfg.TRAIN.RPN_SPARSE_LABEL:
+        return _sparse_pyramid_label(rows, row_labels, fpn_bbox_targets, fpn_inds_inside, fpn_args, cfg)
+
+    # write the sampled anchors straight into the (1, A * crops * H * W) label and
+    # (1, A * 4, crops * H * W) target maps, levels concatenated along the last axis
+    A, num_cells, label_ind, bbox_ind = _pyramid_label_index(fpn_inds_inside, fpn_args, rows)
+    labels = np.empty((1, A * num_cells), dtype=np.float32)
+    labels.fill(-1)
+    labels[0, label_ind] = row_labels
+    fg_bbox_ind = bbox_ind[row_labels >= 1]
+    if len(fg_bbox_ind) == 0:
+        # nothing to regress, all the targets of a shape share one zero template
+        bbox_targets = bbox_weights = _get_zero_bbox_maps(A, num_cells)
+    else:
+        bbox_targets = np.zeros((1, A * 4, num_cells), dtype=np.float32)
+        bbox_weights = np.zeros((1, A * 4, num_cells), dtype=np.float32)
+        bbox_targets.reshape(-1)[fg_bbox_ind] = fpn_bbox_targets
+        bbox_weights.reshape(-1)[fg_bbox_ind] = np.array(cfg.TRAIN.RPN_BBOX_WEIGHTS, dtype=np.float32)
+
+    label = {
+        'label': labels,
+        'bbox_target': bbox_targets,
+        'bbox_weight': bbox_weights
+    }
+    return label
+
+
+def _background_pyramid_label(fpn_inds_inside, fpn_args, cfg, balance_scale_bg=False):
+    """
+    labels of assign_pyramid_anchor for an image without gt boxes: every inside anchor is background,
+    so the anchors are sampled directly, without matching, and there are no targets
+    """
+    level_inside = [len(inds) for inds in fpn_inds_inside]
+    if cfg.TRAIN.RPN_BATCH_SIZE == -1:
+        rows = np.arange(sum(level_inside))
+    elif balance_scale_bg:
+        num_bg_scale = cfg.TRAIN.RPN_BATCH_SIZE // len(fpn_inds_inside)
+        row_starts = np.hstack((0, np.cumsum(level_inside)))
+        rows = np.concatenate([row_starts[feat_id] + _sample_rows(num_inside, num_bg_scale)
+                               for feat_id, num_inside in enumerate(level_inside)])
+    else:
+        rows = _sample_rows(sum(level_inside), cfg.TRAIN.RPN_BATCH_SIZE)
+    return _pyramid_label(rows, np.zeros((len(rows),), dtype=np.float32), np.zeros((0, 4), dtype=np.float32),
+                          fpn_inds_inside, fpn_args, cfg)
+
+
+def _sparse_pyramid_label(rows, row_labels, fpn_bbox_targets, fpn_inds_inside, fpn_args, cfg):
+    """
+    the sampled anchors of assign_pyramid_anchor as fixed size lists instead of dense label maps
+    rpn_sparse_label scatters them back into the maps of assign_pyramid_anchor on the device
+    :param fpn_bbox_targets: [num fg, 4] targets of the positive rows, in order
+    :return: dict of label, K = cfg.TRAIN.RPN_BATCH_SIZE entries padded with label -1
+    'label': (1, K) labels
+    'bbox_target', 'bbox_weight': (1, K, 4)
+    'label_ind': (1, K) int32 indices into the dense (1, A * crops * H * W) label, padding points one past the end
+    'bbox_ind': (1, K, 4) int32 flat indices into the dense (1, A * 4, crops * H * W) bbox_target and bbox_weight,
+    padding points one past the end
+    """
+    num_entries = cfg.TRAIN.RPN_BATCH_SIZE
+    assert num_entries > 0, 'sparse rpn labels need a fixed TRAIN.RPN_BATCH_SIZE'
+    assert len(rows) <= num_entries, '{} sampled anchors, RPN_BATCH_SIZE is {}'.format(len(rows), num_entries)
+    A, num_cells, label_ind, bbox_ind = _pyramid_label_index(fpn_inds_inside, fpn_args, rows)
+    assert 4 * A * num_cells < 2 ** 31
+
+    label = {
+        'label': np.full((1, num_entries), -1, dtype=np.float32),
+        'bbox_target': np.zeros((1, num_entries, 4), dtype=np.float32),
+        'bbox_weight': np.zeros((1, num_entries, 4), dtype=np.float32),
+        'label_ind': np.full((1, num_entries), A * num_cells, dtype=np.int32),
+        'bbox_ind': np.full((1, num_entries, 4), 4 * A * num_cells, dtype=np.int32)
+    }
+    num_rows = len(rows)
+    label['label'][0, :num_rows] = row_labels
+    label['label_ind'][0, :num_rows] = label_ind
+    label['bbox_ind'][0, :num_rows] = bbox_ind
+    fg = np.where(row_labels >= 1)[0]
+    label['bbox_target'][0, fg] = fpn_bbox_targets
+    label['bbox_weight'][0, fg] = np.array(cfg.TRAIN.RPN_BBOX_WEIGHTS)
+    return label
+
+
 def assign_pyramid_anchor(feat_shapes, gt_boxes, im_info, cfg, feat_strides=(4, 8, 16, 32, 64),
                           scales=(8,), ratios=(0.5, 1, 2), allowed_border=0, balance_scale_bg=False,):
     """
@@ -260,18 +450,6 @@ def assign_pyramid_anchor(feat_shapes, gt_boxes, im_info, cfg, feat_strides=(4,
     'bbox_inside_weight': *todo* mark the assigned anchors
     'bbox_outside_weight': used to normalize the bbox_loss, all weights sums to RPN_POSITIVE_WEIGHT
     """
-    def _unmap(data, count, inds, fill=0):
-        """" unmap a subset inds of data into original data of size count """
-        if len(data.shape) == 1:
-            ret = np.empty((count,), dtype=np.float32)
-            ret.fill(fill)
-            ret[inds] = data
-        else:
-            ret = np.empty((count,) + data.shape[1:], dtype=np.float32)
-            ret.fill(fill)
-            ret[inds, :] = data
-        return ret
-
     DEBUG = False
     im_info = im_info[0]
     scales = np.array(scales, dtype=np.float32)
@@ -280,81 +458,65 @@ def assign_pyramid_anchor(feat_shapes, gt_boxes, im_info, cfg, feat_strides=(4,
 
     fpn_args = []
     fpn_anchors_fid = np.zeros(0).astype(int)
-    fpn_anchors = np.zeros([0, 4])
-    fpn_labels = np.zeros(0)
+    fpn_anchors = []
     fpn_inds_inside = []
+    fpn_crop_bounds = []
 
     crop_nums = cfg.CROP_NUM*cfg.CROP_NUM
 
     for feat_id in range(len(feat_strides)):
         # len(scales.shape) == 1 just for backward compatibility, will remove in the future
         if len(scales.shape) == 1:
-            base_anchors = generate_anchors(base_size=feat_strides[feat_id], ratios=ratios, scales=scales)
+            level_scales, level_ratios = scales, ratios
         else:
             assert len(scales.shape) == len(ratios.shape) == 2
-            base_anchors = generate_anchors(base_size=feat_strides[feat_id], ratios=ratios[feat_id], scales=scales[feat_id])
-        num_anchors = base_anchors.shape[0]
+            level_scales, level_ratios = scales[feat_id], ratios[feat_id]
         feat_height, feat_width = feat_shapes[feat_id][0][-2:]
 
-        # 1. generate proposals from bbox deltas and shifted anchors
-        shift_x = np.arange(0, feat_width) * feat_strides[feat_id]
-        shift_y = np.arange(0, feat_height) * feat_strides[feat_id]
-        shift_x, shift_y = np.meshgrid(shift_x, shift_y)
-        shifts = np.vstack((shift_x.ravel(), shift_y.ravel(), shift_x.ravel(), shift_y.ravel())).transpose()
-        # add A anchors (1, A, 4) to
-        # cell K shifts (K, 1, 4) to get
-        # shift anchors (K, A, 4)
-        # reshape to (K*A, 4) shifted anchors
-        A = num_anchors
-        K = shifts.shape[0]
-
-        #print K,feat_width,feat_height,feat_strides[feat_id]
-
-        all_anchors = base_anchors.reshape((1, A, 4)) + shifts.reshape((1, K, 4)).transpose((1, 0, 2))
-        all_anchors = all_anchors.reshape((K * A, 4))
-        total_anchors = int(K * A * crop_nums)
-
-        temp_all_anchors = all_anchors.copy()
-        all_anchors=np.zeros((0,all_anchors.shape[1]))
-        for channel in range(crop_nums):
-            all_anchors = np.vstack((all_anchors,temp_all_anchors))
-        # only keep anchors inside the image
-        inds_inside = np.where((all_anchors[:, 0] >= -allowed_border) &
-                               (all_anchors[:, 1] >= -allowed_border) &
-                               (all_anchors[:, 2] < im_info[1] + allowed_border) &
-                               (all_anchors[:, 3] < im_info[0] + allowed_border))[0]
-        
+        # 1. shifted anchors of every crop, (crop, h, w, a) ordered, and those inside the image
+        all_anchors = get_anchor_grid(feat_height, feat_width, feat_strides[feat_id], level_scales, level_ratios,
+                                      crop_nums)
+        inds_inside = get_inds_inside(feat_height, feat_width, feat_strides[feat_id], level_scales, level_ratios,
+                                      crop_nums, im_info[0], im_info[1], allowed_border)
+        A = len(level_scales) * len(level_ratios)
+        total_anchors = all_anchors.shape[0]
+
+        fpn_inds_inside.append(inds_inside)
+        fpn_args.append([feat_height, feat_width, A, total_anchors])
+        if gt_boxes.size == 0:
+            continue
+
         # keep only inside anchors
         anchors = all_anchors[inds_inside, :]
 
-        # label: 1 is positive, 0 is negative, -1 is dont care
-        # for sigmoid classifier, ignore the 'background' class
-        labels = np.empty((len(inds_inside),), dtype=np.float32)
-        labels.fill(-1)
-
         fpn_anchors_fid = np.hstack((fpn_anchors_fid, len(inds_inside)))
-        fpn_anchors = np.vstack((fpn_anchors, anchors))
-        fpn_labels = np.hstack((fpn_labels, labels))
-        fpn_inds_inside.append(inds_inside)
-        fpn_args.append([feat_height, feat_width, A, total_anchors])
+        fpn_anchors.append(anchors)
+        # inside anchors of crop j are anchors[crop_bounds[j]:crop_bounds[j + 1]]
+        fpn_crop_bounds.append(np.searchsorted(inds_inside, np.arange(crop_nums + 1) * (total_anchors // crop_nums)))
 
-    if gt_boxes.size > 0:
-        # overlap between the anchors and the gt boxes
-        # overlaps (ex, gt)
-        overlaps = np.zeros((0,int(gt_boxes.shape[0])))
-        for i in range(0, len(feat_strides)):
-            feat_height, feat_width, A, total_anchors = fpn_args[i]
-            for j in range(crop_nums):
-                temp_gt_boxes = np.zeros(gt_boxes.shape)
-                temp_gt_boxes[np.where(gt_boxes[:,5]==j),:]=gt_boxes[np.where(gt_boxes[:,5]==j),:]
-                overlaps = np.vstack((overlaps,
-                        bbox_overlaps(fpn_anchors[j*total_anchors/crop_nums:(j+1)*total_anchors/crop_nums,:].astype(np.float),
-                                        temp_gt_boxes.astype(np.float))))
-        argmax_overlaps = overlaps.argmax(axis=1)
-        max_overlaps = overlaps[np.arange(len(fpn_anchors)), argmax_overlaps]
-        gt_argmax_overlaps = overlaps.argmax(axis=0)
-        gt_max_overlaps = overlaps[gt_argmax_overlaps, np.arange(overlaps.shape[1])]
-        gt_argmax_overlaps = np.where(overlaps == gt_max_overlaps)[0]
+    if gt_boxes.size == 0:
+        # no gt: all inside anchors are background, skip matching and sample them directly
+        return _background_pyramid_label(fpn_inds_inside, fpn_args, cfg, balance_scale_bg)
+
+    fpn_anchors = np.concatenate(fpn_anchors, axis=0)
+    # label: 1 is positive, 0 is negative, -1 is dont care
+    # for sigmoid classifier, ignore the 'background' class
+    fpn_labels = np.empty((len(fpn_anchors),), dtype=np.float32)
+    fpn_labels.fill(-1)
+    # (start, end) rows of fpn_anchors of every (level, crop) block
+    level_starts = np.hstack((0, fpn_anchors_fid.cumsum()))[:-1]
+    fpn_blocks = [[(level_start + bounds[j], level_start + bounds[j + 1]) for j in range(crop_nums)]
+                  for level_start, bounds in zip(level_starts, fpn_crop_bounds)]
+
+    # matching is deterministic, only the subsampling below is random
+    label_path = anchor_label_path(cfg, feat_shapes, gt_boxes, im_info, feat_strides, scales, ratios, allowed_border)
+    cached = load_anchor_labels(label_path, len(fpn_anchors)) if label_path is not None else None
+    if cached is not None:
+        fpn_labels, argmax_overlaps = cached
+    else:
+        # overlap between the anchors and the gt boxes of the same crop only
+        argmax_overlaps, max_overlaps, gt_argmax_overlaps = _crop_block_overlaps(fpn_anchors, gt_boxes, fpn_blocks,
+                                                                                 kernel=cfg.TRAIN.RPN_OVERLAPS_KERNEL)
 
         if not cfg.TRAIN.RPN_CLOBBER_POSITIVES:
             # assign bg labels first so that positive labels can clobber them
@@ -366,8 +528,8 @@ def assign_pyramid_anchor(feat_shapes, gt_boxes, im_info, cfg, feat_strides=(4,
         if cfg.TRAIN.RPN_CLOBBER_POSITIVES:
             # assign bg labels last so that negative labels can clobber positives
             fpn_labels[max_overlaps < cfg.TRAIN.RPN_NEGATIVE_OVERLAP] = 0
-    else:
-        fpn_labels[:] = 0
+        if label_path is not None:
+            save_anchor_labels(label_path, fpn_labels, argmax_overlaps)
 
     # subsample positive labels if we have too many
     num_fg = fpn_labels.shape[0] if cfg.TRAIN.RPN_BATCH_SIZE == -1 else int(cfg.TRAIN.RPN_FG_FRACTION * cfg.TRAIN.RPN_BATCH_SIZE)
@@ -397,59 +559,10 @@ def assign_pyramid_anchor(feat_shapes, gt_boxes, im_info, cfg, feat_strides=(4,
                 disable_inds = bg_inds[:(len(bg_inds) - num_bg)]
             fpn_labels[disable_inds] = -1
 
-    fpn_bbox_targets = np.zeros((0, 4), dtype=np.float32)
-    if gt_boxes.size > 0:
-        for i in range(0, len(feat_strides)):
-            feat_height, feat_width, A, total_anchors = fpn_args[i]
-            for j in range(crop_nums):
-                temp_fpn_anchors = fpn_anchors[j*total_anchors/crop_nums:(j+1)*total_anchors/crop_nums,:]
-                temp_gt_boxes = np.zeros(gt_boxes.shape)
-                temp_gt_boxes[np.where(gt_boxes[:,5]==j),:]=gt_boxes[np.where(gt_boxes[:,5]==j),:]
-                temp_argmax_overlaps = argmax_overlaps[j*total_anchors/crop_nums:(j+1)*total_anchors/crop_nums]
-                temp_fpn_labels = fpn_labels[j*total_anchors/crop_nums:(j+1)*total_anchors/crop_nums]
-                temp_fpn_bbox_targets = np.zeros((total_anchors/crop_nums, 4), dtype=np.float32)
-                temp_fpn_bbox_targets[temp_fpn_labels >= 1, :] = bbox_transform(temp_fpn_anchors[temp_fpn_labels >= 1, :], temp_gt_boxes[temp_argmax_overlaps[temp_fpn_labels >= 1], :4])
-                fpn_bbox_targets = np.vstack((fpn_bbox_targets,temp_fpn_bbox_targets))
-        # fpn_bbox_targets[:] = bbox_transform(fpn_anchors, gt_boxes[argmax_overlaps, :4])
+    # targets of the positive anchors only
+    keep = np.where(fpn_labels != -1)[0]
+    fg_inds = keep[fpn_labels[keep] >= 1]
+    fpn_bbox_targets = bbox_transform(fpn_anchors[fg_inds, :], gt_boxes[argmax_overlaps[fg_inds], :4])
     # fpn_bbox_targets = (fpn_bbox_targets - np.array(cfg.TRAIN.BBOX_MEANS)) / np.array(cfg.TRAIN.BBOX_STDS)
-    else:
-        fpn_bbox_targets = np.zeros((len(fpn_anchors), 4), dtype=np.float32)
-    #print "fpn_bbox_targets.shape:"
-    #print fpn_bbox_targets.shape
-    #print fpn_anchors.shape
-    fpn_bbox_weights = np.zeros((len(fpn_anchors), 4), dtype=np.float32)
-
-    fpn_bbox_weights[fpn_labels >= 1, :] = np.array(cfg.TRAIN.RPN_BBOX_WEIGHTS)
-
-    label_list = []
-    bbox_target_list = []
-    bbox_weight_list = []
-    for feat_id in range(0, len(feat_strides)):
-        feat_height, feat_width, A, total_anchors = fpn_args[feat_id]
-        # map up to original set of anchors
-        labels = _unmap(fpn_labels[fpn_anchors_fid[feat_id]:fpn_anchors_fid[feat_id+1]], total_anchors, fpn_inds_inside[feat_id], fill=-1)
-        bbox_targets = _unmap(fpn_bbox_targets[fpn_anchors_fid[feat_id]:fpn_anchors_fid[feat_id+1]], total_anchors, fpn_inds_inside[feat_id], fill=0)
-        bbox_weights = _unmap(fpn_bbox_weights[fpn_anchors_fid[feat_id]:fpn_anchors_fid[feat_id+1]], total_anchors, fpn_inds_inside[feat_id], fill=0)
-
-        labels = labels.reshape((1, crop_nums, feat_height, feat_width, A)).transpose(0, 4, 1, 2, 3)
-        labels = labels.reshape((1, A *crop_nums* feat_height * feat_width))
-
-        bbox_targets = bbox_targets.reshape((1, crop_nums, feat_height, feat_width, A * 4)).transpose(0, 4, 1, 2,3)
-        bbox_targets = bbox_targets.reshape((1, A * 4, -1))
-        bbox_weights = bbox_weights.reshape((1, crop_nums, feat_height, feat_width, A * 4)).transpose((0, 4, 1, 2,3))
-        bbox_weights = bbox_weights.reshape((1, A * 4, -1))
-
-        label_list.append(labels)
-        bbox_target_list.append(bbox_targets)
-        bbox_weight_list.append(bbox_weights)
-        # label.update({'label_p' + str(feat_id + feat_id_start): labels,
-        #               'bbox_target_p' + str(feat_id + feat_id_start): bbox_targets,
-        #               'bbox_weight_p' + str(feat_id + feat_id_start): bbox_weights})
 
-    label = {
-        'label': np.concatenate(label_list, axis=1),
-        'bbox_target': np.concatenate(bbox_target_list, axis=2),
-        'bbox_weight': np.concatenate(bbox_weight_list, axis=2)
-    }
-
-    return label
+    return _pyramid_label(keep, fpn_labels[keep], fpn_bbox_targets, fpn_inds_inside, fpn_args, cfg)
@@ -14,116 +14,149 @@
 import mxnet as mx
 from mxnet.io import DataDesc, DataBatch
 import threading
+import logging
+import Queue
+import time
+import traceback
+
+
+class _PrefetchError(object):
+    """Traceback of an exception in the producer thread, queued for the consumer to raise"""
+    def __init__(self, trace):
+        self.trace = trace
 
 
 class PrefetchingIter(mx.io.DataIter):
-    """Base class for prefetching iterators. Takes one or more DataIters (
-    or any class with "reset" and "next" methods) and combine them with
-    prefetching. For example:
+    """Prefetching iterator. Takes one DataIter (or any class with "reset"
+    and "next" methods) and runs its next() in a producer thread. For example:
 
     Parameters
     ----------
-    iters : DataIter or list of DataIter
-        one or more DataIters (or any class with "reset" and "next" methods)
-    rename_data : None or list of dict
-        i-th element is a renaming map for i-th iter, in the form of
-        {'original_name' : 'new_name'}. Should have one entry for each entry
-        in iter[i].provide_data
-    rename_label : None or list of dict
+    iters : DataIter or list of one DataIter
+        the DataIter (or any class with "reset" and "next" methods) to prefetch from
+    rename_data : None or list of one dict
+        renaming map in the form of {'original_name' : 'new_name'}. Should have
+        one entry for each entry in iters[0].provide_data
+    rename_label : None or list of one dict
         Similar to rename_data
+    depth : int
+        number of batches prefetched ahead of the consumer
 
     Examples
     --------
-    iter = PrefetchingIter([NDArrayIter({'data': X1}), NDArrayIter({'data': X2})],
-                           rename_data=[{'data': 'data1'}, {'data': 'data2'}])
+    iter = PrefetchingIter(NDArrayIter({'data': X}), rename_data=[{'data': 'data1'}])
     """
-    def __init__(self, iters, rename_data=None, rename_label=None):
+    def __init__(self, iters, rename_data=None, rename_label=None, depth=1):
         super(PrefetchingIter, self).__init__()
         if not isinstance(iters, list):
             iters = [iters]
         self.n_iter = len(iters)
-        assert self.n_iter ==1, "Our prefetching iter only support 1 DataIter"
+        assert self.n_iter == 1, "Our prefetching iter only support 1 DataIter"
+        assert rename_data is None or len(rename_data) == 1, "rename_data needs one dict for the DataIter"
+        assert rename_label is None or len(rename_label) == 1, "rename_label needs one dict for the DataIter"
         self.iters = iters
         self.rename_data = rename_data
         self.rename_label = rename_label
         self.batch_size = len(self.provide_data) * self.provide_data[0][0][1][0]
-        self.data_ready = [threading.Event() for i in range(self.n_iter)]
-        self.data_taken = [threading.Event() for i in range(self.n_iter)]
-        for e in self.data_taken:
-            e.set()
-        self.started = True
-        self.current_batch = [None for _ in range(self.n_iter)]
-        self.next_batch = [None for _ in range(self.n_iter)]
-        def prefetch_func(self, i):
+        self.depth = max(depth, 1)
+        self.current_batch = None
+        self.prefetch_thread = None
+        self.reset_wait_stats()
+        self._start()
+
+    def _start(self):
+        """Start a producer thread filling a queue of at most depth batches"""
+        self.batch_queue = Queue.Queue(maxsize=self.depth)
+        self.stopped = threading.Event()
+        self.exhausted = False
+        def prefetch_func(self, batch_queue, stopped):
             """Thread entry"""
-            while True:
-                self.data_taken[i].wait()
-                if not self.started:
-                    break
+            while not stopped.is_set():
                 try:
-                    self.next_batch[i] = self.iters[i].next()
+                    batch = self.iters[0].next()
                 except StopIteration:
-                    self.next_batch[i] = None
-                self.data_taken[i].clear()
-                self.data_ready[i].set()
-        self.prefetch_threads = [threading.Thread(target=prefetch_func, args=[self, i]) \
-                                 for i in range(self.n_iter)]
-        for thread in self.prefetch_threads:
-            thread.setDaemon(True)
-            thread.start()
+                    batch = None
+                except Exception:
+                    batch = _PrefetchError(traceback.format_exc())
+                while not stopped.is_set():
+                    try:
+                        batch_queue.put(batch, timeout=0.1)
+                        break
+                    except Queue.Full:
+                        pass
+                if batch is None or isinstance(batch, _PrefetchError):
+                    break
+        self.prefetch_thread = threading.Thread(target=prefetch_func, args=[self, self.batch_queue, self.stopped])
+        self.prefetch_thread.setDaemon(True)
+        self.prefetch_thread.start()
+
+    def close(self):
+        """Stop the producer thread, prefetched batches are dropped"""
+        if self.prefetch_thread is None:
+            return
+        self.stopped.set()
+        self.prefetch_thread.join()
+        self.prefetch_thread = None
 
     def __del__(self):
-        self.started = False
-        for e in self.data_taken:
-            e.set()
-        for thread in self.prefetch_threads:
-            thread.join()
+        self.close()
+
+    def reset_wait_stats(self):
+        self.num_batches = 0
+        self.num_waits = 0
+        self.wait_time = 0.0
+
+    def wait_stats(self):
+        """How often and how long the consumer waited for the producer since the last reset"""
+        return {'batches': self.num_batches, 'waits': self.num_waits, 'wait_time': self.wait_time}
 
     @property
     def provide_data(self):
         """The name and shape of data provided by this iterator"""
         if self.rename_data is None:
-            return sum([i.provide_data for i in self.iters], [])
+            return self.iters[0].provide_data
         else:
-            return sum([[
-                DataDesc(r[x.name], x.shape, x.dtype)
-                if isinstance(x, DataDesc) else DataDesc(*x)
-                for x in i.provide_data
-            ] for r, i in zip(self.rename_data, self.iters)], [])
+            return [DataDesc(self.rename_data[0][x.name], x.shape, x.dtype)
+                    if isinstance(x, DataDesc) else DataDesc(*x)
+                    for x in self.iters[0].provide_data]
 
     @property
     def provide_label(self):
         """The name and shape of label provided by this iterator"""
         if self.rename_label is None:
-            return sum([i.provide_label for i in self.iters], [])
+            return self.iters[0].provide_label
         else:
-            return sum([[
-                DataDesc(r[x.name], x.shape, x.dtype)
-                if isinstance(x, DataDesc) else DataDesc(*x)
-                for x in i.provide_label
-            ] for r, i in zip(self.rename_label, self.iters)], [])
+            return [DataDesc(self.rename_label[0][x.name], x.shape, x.dtype)
+                    if isinstance(x, DataDesc) else DataDesc(*x)
+                    for x in self.iters[0].provide_label]
 
     def reset(self):
-        for e in self.data_ready:
-            e.wait()
-        for i in self.iters:
-            i.reset()
-        for e in self.data_ready:
-            e.clear()
-        for e in self.data_taken:
-            e.set()
+        if self.num_batches > 0:
+            logging.info('prefetch: waited for {waits} of {batches} batches, {wait_time:.1f}s'.format(**self.wait_stats()))
+        self.close()
+        self.iters[0].reset()
+        self.reset_wait_stats()
+        self._start()
 
     def iter_next(self):
-        for e in self.data_ready:
-            e.wait()
-        if self.next_batch[0] is None:
+        if self.exhausted:
+            return False
+        try:
+            batch = self.batch_queue.get_nowait()
+        except Queue.Empty:
+            self.num_waits += 1
+            tic = time.time()
+            batch = self.batch_queue.get()
+            self.wait_time += time.time() - tic
+        if isinstance(batch, _PrefetchError):
+            self.exhausted = True
+            raise RuntimeError('prefetch thread failed:\n' + batch.trace)
+        if batch is None:
+            self.exhausted = True
             return False
         else:
-            self.current_batch = self.next_batch[0]
-            for e in self.data_ready:
-                e.clear()
-            for e in self.data_taken:
-                e.set()
+            self.num_batches += 1
+            self.current_batch = batch
             return True
 
     def next(self):
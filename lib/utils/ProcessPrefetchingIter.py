@@ -0,0 +1,216 @@
+# --------------------------------------------------------
+# Deformable Convolutional Networks
+# Copyright (c) 2017 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+import os
+import Queue
+import time
+import random
+import cPickle
+import logging
+import traceback
+import multiprocessing
+import numpy as np
+import mxnet as mx
+
+from utils.shared_slots import pack_batch, unpack_batch
+from utils.tile_cache import get_tile_cache, merge_stats, format_stats
+
+
+def _cache_stats(data_iter):
+    """ stats of the tile cache of this process, None without one """
+    cfg = getattr(data_iter, 'cfg', None)
+    tile_cache = get_tile_cache(cfg) if cfg is not None else None
+    return tile_cache.stats() if tile_cache is not None else None
+
+
+def _worker(data_iter, slots, task_queue, result_queue):
+    """Process entry"""
+    import cv2
+    cv2.setNumThreads(0)
+    pid = os.getpid()
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        seq, slot, index, seed = task
+        try:
+            random.seed(seed)
+            np.random.seed(seed)
+            batch = data_iter.load_batch(index)
+            result_queue.put((seq, slot, pack_batch(batch, slots[slot]), None, (pid, _cache_stats(data_iter))))
+        except Exception:
+            result_queue.put((seq, slot, None, traceback.format_exc(), (pid, None)))
+
+
+class ProcessPrefetchingIter(mx.io.DataIter):
+    """Prefetching iterator that assembles batches in worker processes.
+    Wraps one DataIter providing has_batch(cur), batch_index(cur), load_batch(index)
+    and feed_batch(batch), i.e. PyramidAnchorIterator or TestLoader; next() returns what
+    the wrapped iterator's next() would.
+
+    Workers are forked once and kept across resets, so what they cache (tile stacks,
+    anchor grids) carries over from epoch to epoch; the tile cache budget holds per worker,
+    and reset logs the merged cache stats of the workers. They are forked again only when
+    the wrapped iterator's cfg changed, e.g. pred_eval moving to the next test scale.
+    Workers get the roidb indexes of a batch from batch_index, run load_batch on numpy data
+    and write the arrays into shared memory slots; only the batch layout is pickled.
+    Batches are handed out in order, and every batch seeds random and np.random from a
+    per epoch seed and its position, so the result does not depend on which worker made it.
+    Arrays that do not fit the slot are pickled.
+
+    Parameters
+    ----------
+    data_iter : DataIter
+        the iterator to prefetch from
+    num_workers : int
+        number of worker processes
+    depth : int
+        number of batches in flight, also the number of shared memory slots
+    slot_bytes : int
+        bytes per slot, defaults to twice the size of the wrapped iterator's current batch
+    """
+    def __init__(self, data_iter, num_workers=4, depth=4, slot_bytes=None):
+        super(ProcessPrefetchingIter, self).__init__()
+        self.workers = []
+        self.num_batches = 0
+        self.data_iter = data_iter
+        self.num_workers = num_workers
+        self.depth = max(depth, 1)
+        self.batch_size = len(self.provide_data) * self.provide_data[0][0][1][0]
+        if slot_bytes is None:
+            arrays = sum(data_iter.data, []) + sum(data_iter.label or [], [])
+            slot_bytes = 2 * sum([x.size * np.dtype(x.dtype).itemsize for x in arrays])
+        self.slots = [multiprocessing.RawArray('c', int(slot_bytes)) for _ in range(self.depth)]
+        self.task_queue = None
+        self.result_queue = None
+        self.worker_cfg = None
+        self.worker_stats = {}
+        self.current_batch = None
+        self.next_seq = 0
+        self.take_seq = 0
+        self.pending = {}
+        self.reset()
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """ stop the worker processes, batches in flight are dropped """
+        for _ in self.workers:
+            self.task_queue.put(None)
+        # keep draining results so no worker blocks on a full pipe while exiting
+        while any([worker.is_alive() for worker in self.workers]):
+            try:
+                self.result_queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        self.worker_stats = {}
+
+    def _start(self):
+        """ fork the workers, they see the wrapped iterator as it is now """
+        self.worker_cfg = self._cfg_state()
+        self.task_queue = multiprocessing.Queue()
+        self.result_queue = multiprocessing.Queue()
+        self.workers = [multiprocessing.Process(target=_worker, args=(self.data_iter, self.slots,
+                                                                      self.task_queue, self.result_queue))
+                        for _ in range(self.num_workers)]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def _cfg_state(self):
+        return cPickle.dumps(getattr(self.data_iter, 'cfg', None), cPickle.HIGHEST_PROTOCOL)
+
+    def _drain(self):
+        """ wait for the batches still in flight, their slots are written until they arrive """
+        for _ in range(self.next_seq - self.take_seq - len(self.pending)):
+            self._receive()
+        self.pending = {}
+
+    @property
+    def provide_data(self):
+        return self.data_iter.provide_data
+
+    @property
+    def provide_label(self):
+        return self.data_iter.provide_label
+
+    def reset_wait_stats(self):
+        self.num_batches = 0
+        self.num_waits = 0
+        self.wait_time = 0.0
+
+    def wait_stats(self):
+        """How often and how long the consumer waited for the workers since the last reset"""
+        return {'batches': self.num_batches, 'waits': self.num_waits, 'wait_time': self.wait_time}
+
+    def reset(self):
+        if self.num_batches > 0:
+            logging.info('prefetch: waited for {waits} of {batches} batches, {wait_time:.1f}s'.format(**self.wait_stats()))
+        worker_stats = [stats for stats in self.worker_stats.values() if stats is not None]
+        if worker_stats:
+            logging.info('prefetch workers ' + format_stats(merge_stats(worker_stats)))
+        self.reset_wait_stats()
+        if self.workers:
+            self._drain()
+            if self._cfg_state() != self.worker_cfg:
+                self.close()
+        if not self.workers:
+            self._start()
+        self.data_iter.reset()
+        self.seed = np.random.randint(0, 2 ** 31 - 1)
+        self.next_cur = self.data_iter.cur
+        self.next_seq = 0
+        self.take_seq = 0
+        self.free_slots = list(range(self.depth))
+        self.pending = {}
+        self._submit()
+
+    def _submit(self):
+        while self.free_slots and self.data_iter.has_batch(self.next_cur):
+            slot = self.free_slots.pop()
+            index = self.data_iter.batch_index(self.next_cur)
+            self.task_queue.put((self.next_seq, slot, index, (self.seed + self.next_seq) % (2 ** 31 - 1)))
+            self.next_cur += self.data_iter.batch_size
+            self.next_seq += 1
+
+    def _receive(self):
+        done_seq, slot, layout, error, (pid, stats) = self.result_queue.get()
+        self.worker_stats[pid] = stats
+        return done_seq, slot, layout, error
+
+    def _take(self, seq):
+        if seq not in self.pending and self.result_queue.empty():
+            self.num_waits += 1
+        tic = time.time()
+        while seq not in self.pending:
+            done_seq, slot, layout, error = self._receive()
+            self.pending[done_seq] = (slot, layout, error)
+        self.wait_time += time.time() - tic
+        slot, layout, error = self.pending.pop(seq)
+        # a failed batch is raised in its turn, the batches before it are handed out first
+        if error is not None:
+            self.close()
+            raise RuntimeError('batch assembly failed in a worker process:\n' + error)
+        self.num_batches += 1
+        return slot, layout
+
+    def iter_next(self):
+        return self.data_iter.iter_next()
+
+    def next(self):
+        if not self.iter_next():
+            raise StopIteration
+        slot, layout = self._take(self.take_seq)
+        self.take_seq += 1
+        self.current_batch = self.data_iter.feed_batch(unpack_batch(layout, self.slots[slot]))
+        # feed_batch copied the batch into NDArrays, the slot can take the next one
+        self.free_slots.append(slot)
+        self._submit()
+        return self.current_batch
@@ -11,6 +11,8 @@ import cv2
 import random
 from PIL import Image
 from bbox.bbox_transform import clip_boxes
+from utils.tile_cache import get_tile_cache
+from utils.tile_shards import get_tile_shards
 from math import floor
 
 # TODO: This two functions should be merged with individual data loader
@@ -46,106 +48,197 @@ def get_image(roidb, config):
         processed_roidb.append(new_rec)
     return processed_ims, processed_roidb
 
-def compute_iou(rec1, rec2):
-	"""
-	computing IoU
-	:param rec1: (y0, x0, y1, x1), which reflects
-			(top, left, bottom, right)
-	:param rec2: (y0, x0, y1, x1)
-	:return: scala value of IoU
-	"""
-	# computing area of each rectangles
-	S_rec1 = (rec1[2] - rec1[0]) * (rec1[3] - rec1[1])
-	S_rec2 = (rec2[2] - rec2[0]) * (rec2[3] - rec2[1])
-
-	# computing the sum_area
-	sum_area = S_rec1 + S_rec2
-
-	# find the each edge of intersect rectangle
-	left_line = max(rec1[1], rec2[1])
-	right_line = min(rec1[3], rec2[3])
-	top_line = max(rec1[0], rec2[0])
-	bottom_line = min(rec1[2], rec2[2])
-	# judge if there is an intersect
-	if left_line >= right_line or top_line >= bottom_line:
-		return 0
-	else:
-
-		intersect = float(right_line - left_line) * float(bottom_line - top_line)
-		#return intersect / float(sum_area - intersect)
-		return intersect / float(S_rec1)
-
-def crop_image(img,n):
-    height, width, channel= img.shape[:]
-    grid_h = floor(height*1.0/(n-1))
-    grid_w = floor(width*1.0/(n-1))
-    step_h = floor(height*float(n-2)/float(pow((n-1),2)))
-    step_w = floor(width*float(n-2)/float(pow((n-1),2)))
-    croped_image = np.zeros((int(grid_h),int(grid_w),pow(n,2)*channel),dtype=int)
-    for i in range(n):
-        for j in range(n):
-            rect = [i*step_h,j*step_w,i*step_h+grid_h,j*step_w+grid_w]
-            #print rect
-            croped_img = img[int(rect[0]):int(rect[2]),int(rect[1]):int(rect[3]),:]
-            croped_image[:,:,(i*n+j)*channel:(i*n+j+1)*channel] = croped_img[:,:,:]
-    return croped_image
-
-def filtBox(croped_rect,box):
-	t_box = box[:]
-
-	if t_box[0]<croped_rect[0]:
-		t_box[0] = croped_rect[0]
-	if t_box[1]<croped_rect[1]:
-		t_box[1] = croped_rect[1]
-	if t_box[2]>croped_rect[2]:
-		t_box[2] = croped_rect[2]
-	if t_box[3]>croped_rect[3]:
-		t_box[3] = croped_rect[3]
-	
-	t_box[0] = t_box[0]-croped_rect[0]
-	t_box[2] = t_box[2]-croped_rect[0]
-	t_box[1] = t_box[1]-croped_rect[1]
-	t_box[3] = t_box[3]-croped_rect[1]
-
-	return t_box
-
-def remap_boxes(temp_new_rec,n,im_size):
-    #box [x1, y1, x2, y2]
-    boxes = []
-    box_channels = []
-    gt_classes =  []
-    gt_overlaps = []
-    max_classes = []
-    max_overlaps = []
-    height = im_size[0]
-    width = im_size[1]
-    grid_h = floor(height*1.0/(n-1))
-    grid_w = floor(width*1.0/(n-1))
-    step_h = floor(height*float(n-2)/float(pow((n-1),2)))
-    step_w = floor(width*float(n-2)/float(pow((n-1),2)))
-    for i in range(temp_new_rec['boxes'].shape[0]):
-        for j in range(n):
-            for k in range(n):
-                region = [step_w*k,step_h*j,step_w*k+grid_w,step_h*j+grid_h]
-                box = temp_new_rec['boxes'][i].tolist()
-                iou = compute_iou(box,region)
-                if iou>0.8:
-                    t_box = filtBox(region,box)
-                    boxes.append(t_box)
-                    box_channels.append(i*n+k)
-                    gt_classes.append(temp_new_rec['gt_classes'][i])
-                    gt_overlaps.append(temp_new_rec['gt_overlaps'][i].tolist())
-                    max_classes.append(temp_new_rec['max_classes'][i])
-                    max_overlaps.append(temp_new_rec['max_overlaps'][i])
-                    
-    temp_new_rec['boxes'] = np.asarray(boxes,dtype=np.uint16)
-    temp_new_rec['box_channels'] = np.asarray(box_channels,dtype=np.uint16)
-    temp_new_rec['gt_classes'] = np.asarray(gt_classes)
-    temp_new_rec['gt_overlaps'] = np.asarray(gt_overlaps,dtype=np.float32)
-    temp_new_rec['max_classes'] = np.asarray(max_classes)
-    temp_new_rec['max_overlaps'] = np.asarray(max_overlaps)
+def get_crop_grid(height, width, n):
+    """
+    geometry of the n x n overlapping tiles cut from an image
+    :param height: image height
+    :param width: image width
+    :param n: number of tiles along each side
+    :return: (grid_h, grid_w, step_h, step_w) tile size and tile offset step
+    """
+    grid_h = int(floor(height * 1.0 / (n - 1)))
+    grid_w = int(floor(width * 1.0 / (n - 1)))
+    step_h = int(floor(height * float(n - 2) / float(pow((n - 1), 2))))
+    step_w = int(floor(width * float(n - 2) / float(pow((n - 1), 2))))
+    return grid_h, grid_w, step_h, step_w
+
+def crop_image(img, n, out=None, grid=None):
+    """
+    cut img into n x n overlapping tiles stacked along the channel axis
+    tile (i, j) starts at (i * step_h, j * step_w) and occupies channels
+    [(i * n + j) * channel, (i * n + j + 1) * channel)
+    :param img: [height, width, channel]
+    :param n: number of tiles along each side
+    :param out: optional [grid_h, grid_w, n * n * channel] buffer (or window of one) to fill, used when shape and dtype match
+    :param grid: optional (grid_h, grid_w, step_h, step_w), defaults to get_crop_grid of img
+    :return: [grid_h, grid_w, n * n * channel] with the dtype of img
+    """
+    height, width, channel = img.shape[:]
+    if grid is None:
+        grid = get_crop_grid(height, width, n)
+    grid_h, grid_w, step_h, step_w = grid
+    shape = (grid_h, grid_w, n * n * channel)
+    if out is None or out.shape != shape or out.dtype != img.dtype:
+        out = np.empty(shape, dtype=img.dtype)
+    # every tile is a window of img, so all of them are one strided view
+    # [n, n, grid_h, grid_w, channel]; a single copy lays it out as [grid_h, grid_w, n, n, channel]
+    s_h, s_w, s_c = img.strides
+    tiles = np.lib.stride_tricks.as_strided(img, shape=(n, n, grid_h, grid_w, channel),
+                                            strides=(step_h * s_h, step_w * s_w, s_h, s_w, s_c))
+    dst = out.view()
+    dst.shape = (grid_h, grid_w, n, n, channel)
+    dst[:] = tiles.transpose((2, 3, 0, 1, 4))
+    return out
+
+def remap_boxes(temp_new_rec,n,im_size,grid=None):
+    """
+    assign ground truth boxes to the n x n tiles of crop_image
+    a box goes to every tile that covers more than 80% of its area, clipped to
+    the tile and shifted to tile coordinates; box_channels holds the tile index
+    :param temp_new_rec: roidb record, 'boxes' [x1, y1, x2, y2] and per box fields are replaced in place
+    :param n: number of tiles along each side
+    :param im_size: (height, width) of the image the tiles are cut from
+    :param grid: optional (grid_h, grid_w, step_h, step_w), defaults to get_crop_grid of im_size
+    :return:
+    """
+    if grid is None:
+        grid = get_crop_grid(im_size[0], im_size[1], n)
+    grid_h, grid_w, step_h, step_w = grid
+    # tile t = j * n + k spans [step_w * k, step_h * j, step_w * k + grid_w, step_h * j + grid_h]
+    tile_x1 = np.tile(np.arange(n) * step_w, n)
+    tile_y1 = np.repeat(np.arange(n) * step_h, n)
+
+    boxes = temp_new_rec['boxes'].astype(np.float64).reshape((-1, 4))
+    if len(boxes) == 0:
+        # no lesions: nothing to intersect, every tile is empty
+        box_inds = tile_inds = np.zeros((0,), dtype=int)
+        remapped = np.zeros((0, 4))
+    else:
+        # [num_boxes, num_tiles] intersection of every box with every tile
+        left = np.maximum(boxes[:, 0:1], tile_x1)
+        top = np.maximum(boxes[:, 1:2], tile_y1)
+        right = np.minimum(boxes[:, 2:3], tile_x1 + grid_w)
+        bottom = np.minimum(boxes[:, 3:4], tile_y1 + grid_h)
+        inside = (left < right) & (top < bottom)
+        area = (boxes[:, 2:3] - boxes[:, 0:1]) * (boxes[:, 3:4] - boxes[:, 1:2])
+        coverage = np.zeros(inside.shape)
+        np.divide((right - left) * (bottom - top), area, out=coverage, where=inside)
+
+        box_inds, tile_inds = np.nonzero(coverage > 0.8)
+        remapped = np.vstack((left[box_inds, tile_inds] - tile_x1[tile_inds],
+                              top[box_inds, tile_inds] - tile_y1[tile_inds],
+                              right[box_inds, tile_inds] - tile_x1[tile_inds],
+                              bottom[box_inds, tile_inds] - tile_y1[tile_inds])).transpose()
+
+    temp_new_rec['boxes'] = remapped.astype(np.uint16)
+    temp_new_rec['box_channels'] = tile_inds.astype(np.uint16)
+    temp_new_rec['gt_classes'] = temp_new_rec['gt_classes'][box_inds]
+    temp_new_rec['gt_overlaps'] = np.asarray(temp_new_rec['gt_overlaps'][box_inds], dtype=np.float32)
+    temp_new_rec['max_classes'] = temp_new_rec['max_classes'][box_inds]
+    temp_new_rec['max_overlaps'] = temp_new_rec['max_overlaps'][box_inds]
     return
 
+def resize_then_crop(im, n, target_size, max_size, stride=0, interpolation=cv2.INTER_LINEAR):
+    """
+    resize the image once and cut the n x n tiles from the resized image
+    tiles have the size and scale resize_crop(crop_image(im, n), ...) would give them,
+    offsets are rounded in the resized space
+    :param im: BGR image input by opencv
+    :param n: number of tiles along each side
+    :param target_size: one dimensional size (the short side of a tile)
+    :param max_size: one dimensional max size (the long side of a tile)
+    :param stride: if given, pad the tiles to designated stride
+    :param interpolation: if given, using given interpolation method to resize image
+    :return: padded tile stack, im_scale, tile geometry (grid_h, grid_w, step_h, step_w) in the resized space
+    """
+    grid_h, grid_w, step_h, step_w = get_crop_grid(im.shape[0], im.shape[1], n)
+    im_size_min = min(grid_h, grid_w)
+    im_size_max = max(grid_h, grid_w)
+    im_scale = float(target_size) / float(im_size_min)
+    # prevent bigger axis from being more than max_size:
+    if np.round(im_scale * im_size_max) > max_size:
+        im_scale = float(max_size) / float(im_size_max)
+    grid = (int(np.round(grid_h * im_scale)), int(np.round(grid_w * im_scale)),
+            int(np.round(step_h * im_scale)), int(np.round(step_w * im_scale)))
+
+    # only the area covered by tiles is resized, onto exactly the tiles' extent
+    covered = im[:(n - 1) * step_h + grid_h, :(n - 1) * step_w + grid_w, :]
+    covered = cv2.resize(covered, ((n - 1) * grid[3] + grid[1], (n - 1) * grid[2] + grid[0]),
+                         interpolation=interpolation)
+
+    if stride == 0:
+        padded_height, padded_width = grid[0], grid[1]
+    else:
+        padded_height = int(np.ceil(grid[0] / float(stride)) * stride)
+        padded_width = int(np.ceil(grid[1] / float(stride)) * stride)
+    padded_im = np.zeros((padded_height, padded_width, n * n * im.shape[2]), dtype=im.dtype)
+    crop_image(covered, n, out=padded_im[:grid[0], :grid[1], :], grid=grid)
+    return padded_im, im_scale, grid
+
+def load_crop_image(roi_rec, scale_ind, config):
+    """
+    decode, flip, crop and resize one image
+    :param roi_rec: roidb record with 'image' and 'flipped'
+    :param scale_ind: index into config.SCALES
+    :return: padded uint8 tile stack [height, width, 3 * CROP_NUM * CROP_NUM], im_scale,
+    tile geometry (grid_h, grid_w, step_h, step_w) the boxes are remapped with
+    """
+    assert os.path.exists(roi_rec['image']), '%s does not exist'.format(roi_rec['image'])
+    im = cv2.imread(roi_rec['image'], cv2.IMREAD_COLOR|cv2.IMREAD_IGNORE_ORIENTATION)
+    ori_shape = im.shape
+    if roi_rec['flipped']:
+        im = im[:, ::-1, :]
+    target_size = config.SCALES[scale_ind][0]
+    max_size = config.SCALES[scale_ind][1]
+    if config.CROP_PIPELINE == 'resize_first':
+        im, im_scale, grid = resize_then_crop(im, config.CROP_NUM, target_size, max_size,
+                                              stride=config.network.IMAGE_STRIDE)
+    else:
+        grid = get_crop_grid(ori_shape[0], ori_shape[1], config.CROP_NUM)
+        croped_im = crop_image(im, config.CROP_NUM, grid=grid)
+        im, im_scale = resize_crop(croped_im, target_size, max_size, stride=config.network.IMAGE_STRIDE)
+    return im, im_scale, grid
+
+def get_crop_rec(roi_rec, im_shape, im_scale, grid, config):
+    """
+    remap the boxes of roi_rec onto the tiles made by load_crop_image
+    :param roi_rec: roidb record, not modified
+    :param im_shape: shape of the padded tile stack
+    :return: new record with boxes in tile coordinates, box_channels and im_info
+    """
+    new_rec = roi_rec.copy()
+    if config.CROP_PIPELINE == 'resize_first':
+        # remap in the resized space, where the tile offsets were rounded
+        new_rec['boxes'] = np.round(roi_rec['boxes'] * im_scale)
+        remap_boxes(new_rec, config.CROP_NUM, None, grid=grid)
+        box_scale = 1.0
+    else:
+        remap_boxes(new_rec, config.CROP_NUM, None, grid=grid)
+        box_scale = im_scale
+    im_info = [im_shape[0], im_shape[1], im_scale]
+    new_rec['boxes'] = clip_boxes(np.round(new_rec['boxes'].copy()* box_scale), im_info[:2])
+    new_rec['im_info'] = im_info
+    return new_rec
+
+def get_crop_shape(height, width, scale, config):
+    """
+    shape of the tile stack load_crop_image makes, without decoding the image
+    :param height: image height
+    :param width: image width
+    :param scale: (target_size, max_size), e.g. an entry of config.SCALES or config.TEST_SCALES
+    :return: padded (height, width) of the tile stack
+    """
+    grid_h, grid_w = get_crop_grid(height, width, config.CROP_NUM)[:2]
+    target_size, max_size = scale[:2]
+    im_scale = float(target_size) / float(min(grid_h, grid_w))
+    if np.round(im_scale * max(grid_h, grid_w)) > max_size:
+        im_scale = float(max_size) / float(max(grid_h, grid_w))
+    stride = config.network.IMAGE_STRIDE
+    shape = [int(np.round(grid_h * im_scale)), int(np.round(grid_w * im_scale))]
+    if stride != 0:
+        shape = [int(np.ceil(x / float(stride)) * stride) for x in shape]
+    return tuple(shape)
+
 def get_crop_image(roidb, config):
     """
     preprocess image and return processed roidb
@@ -155,29 +248,41 @@ def get_crop_image(roidb, config):
     0 --- x (width, second dim of im)
     |
     y (height, first dim of im)
+    config.CROP_PIPELINE selects how tiles are made:
+    'crop_first' cuts tiles at full resolution and resizes the stack,
+    'resize_first' resizes the image once and cuts tiles from it
+    with config.TILE_SHARD_PATH set, tiles and records are read from the shards written by
+    write_tile_shards; with config.TILE_CACHE_BYTES > 0 the resized tile stacks are kept in an LRU cache
     """
     num_images = len(roidb)
     processed_ims = []
     processed_roidb = []
+    tile_shards = get_tile_shards(config)
+    tile_cache = get_tile_cache(config)
     for i in range(num_images):
         roi_rec = roidb[i]
-        assert os.path.exists(roi_rec['image']), '%s does not exist'.format(roi_rec['image'])
-        im = cv2.imread(roi_rec['image'], cv2.IMREAD_COLOR|cv2.IMREAD_IGNORE_ORIENTATION)
-        ori_shape = im.shape
-        if roidb[i]['flipped']:
-            im = im[:, ::-1, :]
         scale_ind = random.randrange(len(config.SCALES))
-        target_size = config.SCALES[scale_ind][0]
-        max_size = config.SCALES[scale_ind][1]
-        croped_im = crop_image(im,config.CROP_NUM)
-        im, im_scale = resize_crop(croped_im, target_size, max_size, stride=config.network.IMAGE_STRIDE)
-        im_tensor = transform_crop(im, config.network.PIXEL_MEANS)
+        scale = tuple(config.SCALES[scale_ind])
+        sharded = tile_shards.get(roi_rec, scale) if tile_shards is not None else None
+        if sharded is not None:
+            im, new_rec = sharded
+        else:
+            # keyed on the scale itself, pred_eval swaps config.SCALES for every test scale
+            key = (roi_rec['image'], roi_rec['flipped'], scale, config.CROP_NUM, config.CROP_PIPELINE)
+            cached = tile_cache.get(key) if tile_cache is not None else None
+            if cached is not None:
+                im, im_scale, grid = cached
+            else:
+                im, im_scale, grid = load_crop_image(roi_rec, scale_ind, config)
+                if tile_cache is not None:
+                    tile_cache.put(key, im, im_scale, grid)
+            new_rec = get_crop_rec(roi_rec, im.shape, im_scale, grid, config)
+        if config.network.DEVICE_NORMALIZE:
+            # ship the raw BGR tiles, the symbol swaps channels and subtracts the means
+            im_tensor = np.ascontiguousarray(im.transpose((2, 0, 1))[np.newaxis])
+        else:
+            im_tensor = transform_crop(im, config.network.PIXEL_MEANS)
         processed_ims.append(im_tensor)
-        im_info = [im_tensor.shape[2], im_tensor.shape[3], im_scale]
-        remap_boxes(roi_rec,config.CROP_NUM,ori_shape)
-        new_rec = roi_rec.copy()
-        new_rec['boxes'] = clip_boxes(np.round(roi_rec['boxes'].copy()* im_scale), im_info[:2])
-        new_rec['im_info'] = im_info
         processed_roidb.append(new_rec)
     #print "processed_ims.shape:"
     #print processed_ims[0].shape
@@ -220,14 +325,17 @@ def get_segmentation_image(segdb, config):
 
     return processed_ims, processed_seg_cls_gt, processed_segdb
 
-def resize_crop(im, target_size, max_size, stride=0, interpolation = cv2.INTER_LINEAR):
+def resize_crop(im, target_size, max_size, stride=0, interpolation = cv2.INTER_LINEAR, out=None):
     """
     only resize input image to target size and return scale
+    the whole tile stack is resized at once and written straight into the
+    stride padded output, keeping the dtype of im (uint8 from crop_image)
     :param im: BGR image input by opencv
     :param target_size: one dimensional size (the short side)
     :param max_size: one dimensional max size (the long side)
     :param stride: if given, pad the image to designated stride
     :param interpolation: if given, using given interpolation method to resize image
+    :param out: optional buffer of the padded shape and dtype of im to write into
     :return:
     """
     im_shape = im.shape
@@ -237,43 +345,62 @@ def resize_crop(im, target_size, max_size, stride=0, interpolation = cv2.INTER_L
     # prevent bigger axis from being more than max_size:
     if np.round(im_scale * im_size_max) > max_size:
         im_scale = float(max_size) / float(im_size_max)
-    channel = im.shape[2]
-
-    t_im = cv2.resize(im[:,:,0].astype(np.float32), None, None, fx=im_scale, fy=im_scale, interpolation=interpolation)
-
-    n_im = np.zeros((t_im.shape[0],t_im.shape[1],channel),dtype = int)
-
-    for i in range(channel/3):
-         
-        n_im[:,:,i*3:(i+1)*3] = cv2.resize(im[:,:,i*3:(i+1)*3].astype(np.float32), None, None, fx=im_scale, fy=im_scale, interpolation=interpolation)
+    # output size cv2.resize derives from fx, fy
+    im_height = int(np.round(im_shape[0] * im_scale))
+    im_width = int(np.round(im_shape[1] * im_scale))
+    im_channel = im_shape[2]
 
-    im = n_im
-
-    if stride == 0:
-        return im, im_scale
-    else:
+    if stride != 0:
         # pad to product of stride
-        im_height = int(np.ceil(im.shape[0] / float(stride)) * stride)
-        im_width = int(np.ceil(im.shape[1] / float(stride)) * stride)
-        im_channel = im.shape[2]
-        padded_im = np.zeros((im_height, im_width, im_channel))
-        padded_im[:im.shape[0], :im.shape[1], :] = im
-        del im
-        return padded_im, im_scale
+        padded_height = int(np.ceil(im_height / float(stride)) * stride)
+        padded_width = int(np.ceil(im_width / float(stride)) * stride)
+    else:
+        padded_height, padded_width = im_height, im_width
+    padded_shape = (padded_height, padded_width, im_channel)
+    if out is None or out.shape != padded_shape or out.dtype != im.dtype:
+        out = np.zeros(padded_shape, dtype=im.dtype)
+    else:
+        out[im_height:, :, :] = 0
+        out[:im_height, im_width:, :] = 0
+
+    # the python bindings map at most CV_CN_MAX channels onto one Mat
+    # (512 in older opencv, 128 in newer), so wider stacks go in groups
+    group = 126
+    dst = out[:im_height, :im_width, :]
+    if im_channel <= group:
+        resized = cv2.resize(im, None, dst=dst, fx=im_scale, fy=im_scale, interpolation=interpolation)
+        if resized is not dst:
+            # older bindings do not write into a non contiguous dst
+            dst[:] = resized.reshape(dst.shape)
+    else:
+        for c in range(0, im_channel, group):
+            dst[:, :, c:c + group] = cv2.resize(np.ascontiguousarray(im[:, :, c:c + group]), None, None,
+                                                fx=im_scale, fy=im_scale, interpolation=interpolation)
+
+    return out, im_scale
 
-def transform_crop(im, pixel_means):
+def transform_crop(im, pixel_means, im_tensor=None):
     """
     transform into mxnet tensor
     substract pixel size and transform to correct format
+    every 3 channel group of the tile stack is swapped to RGB
     :param im: [height, width, channel] in BGR
     :param pixel_means: [B, G, R pixel means]
+    :param im_tensor: optional C contiguous float32 [1, channel, height, width] buffer to write into
     :return: [batch, channel, height, width]
     """
-    channel = im.shape[2]
-    im_tensor = np.zeros((1, channel, im.shape[0], im.shape[1]))
-    for i in range(channel/3):
-        for j in range(3):
-            im_tensor[0, i*3+j, :, :] = im[:, :,i*3+ 2 - j] - pixel_means[2 - j]
+    height, width, channel = im.shape
+    if im_tensor is None:
+        im_tensor = np.empty((1, channel, height, width), dtype=np.float32)
+    # a reshape of any other buffer is a copy, the result would be dropped
+    assert im_tensor.dtype == np.float32 and im_tensor.flags['C_CONTIGUOUS'], 'im_tensor must be C contiguous float32'
+    assert im_tensor.shape == (1, channel, height, width), 'im_tensor must be [1, channel, height, width]'
+    # read [height, width, group, BGR] as [group, RGB, height, width] and subtract in one pass,
+    # walking the output in memory order
+    src = im.transpose((2, 0, 1)).reshape((channel // 3, 3, height, width))[:, ::-1, :, :]
+    dst = im_tensor.reshape((channel // 3, 3, height, width))
+    means = np.asarray(pixel_means, dtype=np.float32)[::-1].reshape((1, 3, 1, 1))
+    np.subtract(src, means, out=dst, casting='unsafe')
     return im_tensor
 
 def resize(im, target_size, max_size, stride=0, interpolation = cv2.INTER_LINEAR):
@@ -306,18 +433,16 @@ def resize(im, target_size, max_size, stride=0, interpolation = cv2.INTER_LINEAR
         padded_im[:im.shape[0], :im.shape[1], :] = im
         return padded_im, im_scale
 
-def transform(im, pixel_means):
+def transform(im, pixel_means, im_tensor=None):
     """
     transform into mxnet tensor
     substract pixel size and transform to correct format
     :param im: [height, width, channel] in BGR
     :param pixel_means: [B, G, R pixel means]
+    :param im_tensor: optional float32 [1, 3, height, width] buffer to write into
     :return: [batch, channel, height, width]
     """
-    im_tensor = np.zeros((1, 3, im.shape[0], im.shape[1]))
-    for i in range(3):
-        im_tensor[0, i, :, :] = im[:, :, 2 - i] - pixel_means[2 - i]
-    return im_tensor
+    return transform_crop(im[:, :, :3], pixel_means, im_tensor=im_tensor)
 
 def transform_seg_gt(gt):
     """
@@ -0,0 +1,62 @@
+# --------------------------------------------------------
+# Deformable Convolutional Networks
+# Copyright (c) 2017 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""
+Hand numpy batches from worker processes to the parent through shared memory.
+A worker writes the arrays of a nested list/tuple/dict batch into a multiprocessing.RawArray slot
+and only pickles the layout, the parent rebuilds the batch from the layout and the same slot.
+"""
+
+import numpy as np
+
+# arrays smaller than this are copied out of the slot, larger ones are handed over as views
+_MIN_VIEW_BYTES = 1 << 16
+
+
+def _pack(obj, buf, offset):
+    """ replace the arrays of a nested list/tuple/dict batch by references into buf """
+    if isinstance(obj, np.ndarray):
+        nbytes = obj.nbytes
+        if offset + nbytes > len(buf):
+            return obj, offset
+        np.frombuffer(buf, dtype=obj.dtype, count=obj.size, offset=offset).reshape(obj.shape)[...] = obj
+        return ('__slot__', offset, obj.shape, obj.dtype.str), offset + (nbytes + 63) // 64 * 64
+    if isinstance(obj, dict):
+        packed = {}
+        for k, v in obj.items():
+            packed[k], offset = _pack(v, buf, offset)
+        return packed, offset
+    if isinstance(obj, (list, tuple)):
+        packed = []
+        for v in obj:
+            v, offset = _pack(v, buf, offset)
+            packed.append(v)
+        return type(obj)(packed), offset
+    return obj, offset
+
+
+def pack_batch(batch, buf):
+    """
+    write the arrays of batch into buf, arrays that do not fit stay in the layout and get pickled
+    :return: layout to send to unpack_batch
+    """
+    return _pack(batch, buf, 0)[0]
+
+
+def unpack_batch(layout, buf):
+    """
+    rebuild a batch of pack_batch, large arrays are views of buf and valid until buf is written again
+    """
+    if isinstance(layout, tuple) and len(layout) == 4 and layout[0] == '__slot__':
+        _, offset, shape, dtype = layout
+        dtype = np.dtype(dtype)
+        array = np.frombuffer(buf, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+        return array.copy() if array.nbytes < _MIN_VIEW_BYTES else array
+    if isinstance(layout, dict):
+        return dict((k, unpack_batch(v, buf)) for k, v in layout.items())
+    if isinstance(layout, (list, tuple)):
+        return type(layout)([unpack_batch(v, buf) for v in layout])
+    return layout
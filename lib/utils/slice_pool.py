@@ -0,0 +1,124 @@
+# --------------------------------------------------------
+# Deformable Convolutional Networks
+# Copyright (c) 2017 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+import os
+import random
+import traceback
+import multiprocessing
+import numpy as np
+
+from utils.shared_slots import pack_batch, unpack_batch
+
+
+def _worker(fn, slots, task_queue, result_queue):
+    """Process entry"""
+    import cv2
+    cv2.setNumThreads(0)
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        slot, args, seed = task
+        try:
+            random.seed(seed)
+            np.random.seed(seed)
+            result_queue.put((slot, pack_batch(fn(*args), slots[slot]), None))
+        except Exception:
+            result_queue.put((slot, None, traceback.format_exc()))
+
+
+def _call_seeds(num_calls):
+    """ one seed per call of a map, drawn from the caller's np.random """
+    return [np.random.randint(0, 2 ** 31 - 1) for _ in range(num_calls)]
+
+
+def map_serial(fn, args_list):
+    """
+    what SlicePool(fn, ...).map(args_list) returns, run in this process: every call is seeded the
+    same way, and the caller's random and np.random go on as after a pooled map
+    :return: [fn(*args) for args in args_list]
+    """
+    seeds = _call_seeds(len(args_list))
+    random_state = random.getstate()
+    np_random_state = np.random.get_state()
+    try:
+        results = []
+        for args, seed in zip(args_list, seeds):
+            random.seed(seed)
+            np.random.seed(seed)
+            results.append(fn(*args))
+        return results
+    finally:
+        random.setstate(random_state)
+        np.random.set_state(np_random_state)
+
+
+class SlicePool(object):
+    """
+    worker processes running fn(*args) on numpy data, e.g. the per device slices of a batch
+    fn and the state it reads are inherited when the workers are forked, only args and the
+    result layout are pickled; result arrays come back through one shared memory slot per call
+    of a map, so they stay valid until the next map. Every call seeds random and np.random
+    from the caller's np.random, so results do not depend on which worker ran them and
+    equal those of map_serial.
+
+    Parameters
+    ----------
+    fn : callable
+        function to run, returns a nested list/tuple/dict of arrays
+    num_workers : int
+        number of worker processes
+    num_slots : int
+        most calls of one map
+    slot_bytes : int
+        bytes per slot, arrays that do not fit are pickled
+    """
+    def __init__(self, fn, num_workers, num_slots, slot_bytes):
+        self.owner = os.getpid()
+        self.slots = [multiprocessing.RawArray('c', int(slot_bytes)) for _ in range(num_slots)]
+        self.task_queue = multiprocessing.Queue()
+        self.result_queue = multiprocessing.Queue()
+        self.workers = [multiprocessing.Process(target=_worker, args=(fn, self.slots, self.task_queue, self.result_queue))
+                        for _ in range(num_workers)]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def __del__(self):
+        self.close()
+
+    def usable(self):
+        """ only the process that made the pool can use it, forked copies run fn themselves """
+        return bool(self.workers) and os.getpid() == self.owner
+
+    def close(self):
+        if not self.usable():
+            return
+        for _ in self.workers:
+            self.task_queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def map(self, args_list):
+        """
+        :param args_list: list of argument tuples, at most num_slots
+        :return: [fn(*args) for args in args_list]
+        """
+        assert len(args_list) <= len(self.slots), '{} calls, pool has {} slots'.format(len(args_list), len(self.slots))
+        for slot, (args, seed) in enumerate(zip(args_list, _call_seeds(len(args_list)))):
+            self.task_queue.put((slot, args, seed))
+        results = [None] * len(args_list)
+        error = None
+        for _ in range(len(args_list)):
+            slot, layout, trace = self.result_queue.get()
+            if trace is not None:
+                error = trace
+            else:
+                results[slot] = unpack_batch(layout, self.slots[slot])
+        if error is not None:
+            raise RuntimeError('slice assembly failed in a worker process:\n' + error)
+        return results
@@ -0,0 +1,98 @@
+# --------------------------------------------------------
+# Deformable Convolutional Networks
+# Copyright (c) 2017 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+import threading
+from collections import OrderedDict
+
+
+class TileCache(object):
+    """
+    LRU cache of preprocessed tile stacks bounded by a byte budget
+    an entry is (tiles, im_scale, grid) as produced by get_crop_image before
+    normalization; tiles are stored read only and must not be written by callers
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries[key] = entry
+            self.hits += 1
+            return entry
+
+    def put(self, key, tiles, im_scale, grid):
+        if tiles.nbytes > self.max_bytes:
+            return
+        tiles.flags.writeable = False
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[0].nbytes
+            while self._entries and self.nbytes + tiles.nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= evicted[0].nbytes
+                self.evictions += 1
+            self._entries[key] = (tiles, im_scale, grid)
+            self.nbytes += tiles.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'entries': len(self._entries), 'bytes': self.nbytes, 'max_bytes': self.max_bytes,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'hit_rate': self.hits / float(lookups) if lookups else 0.0}
+
+    def __str__(self):
+        return format_stats(self.stats())
+
+
+def merge_stats(stats_list):
+    """
+    stats of the tile caches of several processes added up, e.g. the loader workers
+    :param stats_list: list of TileCache.stats()
+    :return: stats dict of the total
+    """
+    total = dict((k, sum(stats[k] for stats in stats_list))
+                 for k in ('entries', 'bytes', 'max_bytes', 'hits', 'misses', 'evictions'))
+    lookups = total['hits'] + total['misses']
+    total['hit_rate'] = total['hits'] / float(lookups) if lookups else 0.0
+    return total
+
+
+def format_stats(stats):
+    return 'tile cache: %(entries)d entries, %(bytes)d/%(max_bytes)d bytes, ' \
+           '%(hits)d hits, %(misses)d misses (%(hit_rate).3f), %(evictions)d evictions' % stats
+
+
+_tile_cache = None
+
+
+def get_tile_cache(config):
+    """
+    process wide tile cache sized by config.TILE_CACHE_BYTES
+    :return: TileCache, or None when the budget is 0
+    """
+    global _tile_cache
+    max_bytes = int(config.TILE_CACHE_BYTES)
+    if max_bytes <= 0:
+        return None
+    if _tile_cache is None or _tile_cache.max_bytes != max_bytes:
+        _tile_cache = TileCache(max_bytes)
+    return _tile_cache
@@ -0,0 +1,120 @@
+# --------------------------------------------------------
+# Deformable Convolutional Networks
+# Copyright (c) 2017 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""
+Tile shards: the uint8 tile stacks of get_crop_image packed into large raw files.
+A shard directory holds shard_00000.bin, shard_00001.bin, ... and index.pkl, which maps
+(image, flipped, (target size, max size)) to (shard, offset, shape, record fields) and records the
+preprocessing settings the shards were made with.
+"""
+
+import os
+import cPickle
+import numpy as np
+
+# record fields written by get_crop_rec
+SHARD_REC_FIELDS = ('boxes', 'box_channels', 'gt_classes', 'gt_overlaps', 'max_classes', 'max_overlaps', 'im_info')
+
+
+def _shard_settings(config):
+    return {'CROP_NUM': config.CROP_NUM, 'CROP_PIPELINE': config.CROP_PIPELINE,
+            'IMAGE_STRIDE': config.network.IMAGE_STRIDE}
+
+
+def _shard_name(shard_id):
+    return 'shard_%05d.bin' % shard_id
+
+
+def write_tile_shards(roidb, config, output_path, shard_bytes=1 << 30):
+    """
+    run the crop pipeline over roidb for every scale in config.SCALES and pack the results
+    :param roidb: roidb to preprocess, flipped entries included
+    :param output_path: shard directory
+    :param shard_bytes: a new shard is started once a shard reaches this size
+    :return: number of shards written
+    """
+    from utils.image import load_crop_image, get_crop_rec
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+    entries = {}
+    shard_id = 0
+    offset = 0
+    fid = open(os.path.join(output_path, _shard_name(shard_id)), 'wb')
+    for i, roi_rec in enumerate(roidb):
+        for scale_ind in range(len(config.SCALES)):
+            im, im_scale, grid = load_crop_image(roi_rec, scale_ind, config)
+            new_rec = get_crop_rec(roi_rec, im.shape, im_scale, grid, config)
+            if offset > 0 and offset + im.nbytes > shard_bytes:
+                fid.close()
+                shard_id += 1
+                offset = 0
+                fid = open(os.path.join(output_path, _shard_name(shard_id)), 'wb')
+            np.ascontiguousarray(im, dtype=np.uint8).tofile(fid)
+            entries[(roi_rec['image'], roi_rec['flipped'], tuple(config.SCALES[scale_ind]))] = \
+                (shard_id, offset, im.shape, dict((k, new_rec[k]) for k in SHARD_REC_FIELDS))
+            offset += im.nbytes
+        if (i + 1) % 1000 == 0:
+            print 'packed %d/%d images into %d shards' % (i + 1, len(roidb), shard_id + 1)
+    fid.close()
+    with open(os.path.join(output_path, 'index.pkl'), 'wb') as fid:
+        cPickle.dump({'settings': _shard_settings(config), 'num_shards': shard_id + 1, 'entries': entries},
+                     fid, cPickle.HIGHEST_PROTOCOL)
+    print 'wrote %d images into %d shards in %s' % (len(roidb), shard_id + 1, output_path)
+    return shard_id + 1
+
+
+class TileShardReader(object):
+    """
+    read tile stacks out of a shard directory through np.memmap
+    returned tile stacks are read only views of the shards
+    """
+    def __init__(self, path, config):
+        self.path = path
+        with open(os.path.join(path, 'index.pkl'), 'rb') as fid:
+            index = cPickle.load(fid)
+        self.settings = _shard_settings(config)
+        assert index['settings'] == self.settings, \
+            'tile shards in {} were made with {}, config has {}'.format(path, index['settings'], self.settings)
+        self.entries = index['entries']
+        self._shards = [None] * index['num_shards']
+
+    def _shard(self, shard_id):
+        if self._shards[shard_id] is None:
+            self._shards[shard_id] = np.memmap(os.path.join(self.path, _shard_name(shard_id)), dtype=np.uint8, mode='r')
+        return self._shards[shard_id]
+
+    def get(self, roi_rec, scale):
+        """
+        :param scale: (target size, max size) as in config.SCALES
+        :return: (tile stack, record) as get_crop_image makes them, or None if the image is not in the shards
+        """
+        entry = self.entries.get((roi_rec['image'], roi_rec['flipped'], tuple(scale)))
+        if entry is None:
+            return None
+        shard_id, offset, shape, fields = entry
+        size = int(np.prod(shape))
+        im = self._shard(shard_id)[offset:offset + size].reshape(shape)
+        new_rec = roi_rec.copy()
+        for k in SHARD_REC_FIELDS:
+            new_rec[k] = fields[k].copy() if isinstance(fields[k], np.ndarray) else list(fields[k])
+        return im, new_rec
+
+
+_tile_shards = None
+
+
+def get_tile_shards(config):
+    """
+    process wide reader of config.TILE_SHARD_PATH
+    :return: TileShardReader, or None when no shard path is set
+    """
+    global _tile_shards
+    if not config.TILE_SHARD_PATH:
+        return None
+    if _tile_shards is None or _tile_shards.path != config.TILE_SHARD_PATH or \
+            _tile_shards.settings != _shard_settings(config):
+        _tile_shards = TileShardReader(config.TILE_SHARD_PATH, config)
+    return _tile_shards
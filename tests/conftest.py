@@ -0,0 +1,19 @@
+# --------------------------------------------------------
+# Deformable Convolutional Networks
+# Copyright (c) 2017 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""
+Tests import lib/ and fpn/ modules the way fpn/_init_paths.py sets them up.
+Build the Cython kernels first (init.sh or make -C lib), then run python -m pytest tests
+"""
+
+import os.path as osp
+import sys
+
+this_dir = osp.dirname(__file__)
+
+for path in (osp.join(this_dir, '..', 'lib'), osp.join(this_dir, '..', 'fpn')):
+    if path not in sys.path:
+        sys.path.insert(0, path)
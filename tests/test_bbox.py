@@ -0,0 +1,67 @@
+# --------------------------------------------------------
+# Deformable Convolutional Networks
+# Copyright (c) 2017 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+import numpy as np
+
+from bbox.bbox_transform import bbox_overlaps, bbox_overlaps_sparse
+
+
+def _random_boxes(rng, num, size, max_side, integer):
+    """ boxes inside a size x size image, integer corners make many boxes touch edge to edge """
+    x1 = rng.uniform(0, size, num)
+    y1 = rng.uniform(0, size, num)
+    w = rng.uniform(0, max_side, num)
+    h = rng.uniform(0, max_side, num)
+    boxes = np.stack([x1, y1, x1 + w, y1 + h], axis=1)
+    if integer:
+        boxes = np.round(boxes)
+    return boxes
+
+
+def _sparse_to_dense(sparse, shape):
+    rows, cols, ious = sparse
+    dense = np.zeros(shape, dtype=ious.dtype)
+    dense[rows, cols] = ious
+    return dense
+
+
+def test_sorted_matches_dense_at_the_pixel_edge():
+    # iw is 0.5 with the +1 of the widths, though the boxes are 0.5 apart along x
+    boxes = np.array([[0.5, 0, 10.5, 10]])
+    query_boxes = np.array([[11., 0, 20, 10]])
+    dense = bbox_overlaps(boxes, query_boxes)
+    assert dense[0, 0] > 0
+    np.testing.assert_allclose(bbox_overlaps(boxes, query_boxes, kernel='sorted'), dense)
+    np.testing.assert_allclose(bbox_overlaps(query_boxes, boxes, kernel='sorted'), dense.T)
+
+
+def test_sorted_matches_dense():
+    rng = np.random.RandomState(3)
+    for case in range(200):
+        integer = case % 2 == 0
+        size = rng.choice([20, 100, 600])
+        boxes = _random_boxes(rng, rng.randint(1, 60), size, rng.uniform(1, size / 2.0), integer)
+        query_boxes = _random_boxes(rng, rng.randint(1, 20), size, rng.uniform(1, size / 2.0), integer)
+        dense = bbox_overlaps(boxes, query_boxes)
+
+        np.testing.assert_allclose(bbox_overlaps(boxes, query_boxes, kernel='sorted'), dense, rtol=0, atol=1e-12)
+        np.testing.assert_allclose(_sparse_to_dense(bbox_overlaps_sparse(boxes, query_boxes), dense.shape),
+                                   dense, rtol=0, atol=1e-12)
+        # float32 keeps the same pairs, up to rounding
+        sorted32 = bbox_overlaps(boxes.astype(np.float32), query_boxes.astype(np.float32), kernel='sorted')
+        assert sorted32.dtype == np.float32
+        np.testing.assert_allclose(sorted32, dense, rtol=0, atol=1e-5)
+
+
+def test_sparse_is_ordered_by_query_box():
+    rng = np.random.RandomState(5)
+    boxes = _random_boxes(rng, 200, 100, 30, True)
+    query_boxes = _random_boxes(rng, 30, 100, 30, True)
+    # cached anchor grids are read only
+    boxes.flags.writeable = False
+    rows, cols, ious = bbox_overlaps_sparse(boxes, query_boxes)
+    assert np.all(np.diff(cols) >= 0)
+    assert np.all(ious > 0)
@@ -0,0 +1,278 @@
+# --------------------------------------------------------
+# Deformable Convolutional Networks
+# Copyright (c) 2017 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+import cv2
+import numpy as np
+import pytest
+from math import floor
+from easydict import EasyDict as edict
+
+from utils.image import crop_image, get_crop_grid, remap_boxes, load_crop_image, get_crop_rec, transform_crop, \
+    get_crop_image
+from utils.tile_cache import get_tile_cache
+
+
+def _loop_crop_image(img, n):
+    """ crop_image before it used a strided view: one copy per tile into an int array """
+    height, width, channel = img.shape[:]
+    grid_h = floor(height * 1.0 / (n - 1))
+    grid_w = floor(width * 1.0 / (n - 1))
+    step_h = floor(height * float(n - 2) / float(pow((n - 1), 2)))
+    step_w = floor(width * float(n - 2) / float(pow((n - 1), 2)))
+    croped_image = np.zeros((int(grid_h), int(grid_w), pow(n, 2) * channel), dtype=int)
+    for i in range(n):
+        for j in range(n):
+            rect = [i * step_h, j * step_w, i * step_h + grid_h, j * step_w + grid_w]
+            croped_img = img[int(rect[0]):int(rect[2]), int(rect[1]):int(rect[3]), :]
+            croped_image[:, :, (i * n + j) * channel:(i * n + j + 1) * channel] = croped_img[:, :, :]
+    return croped_image
+
+
+
+def _loop_coverage(box, region):
+    """ compute_iou of the former remap_boxes: share of box inside region """
+    area = (box[2] - box[0]) * (box[3] - box[1])
+    left, right = max(box[1], region[1]), min(box[3], region[3])
+    top, bottom = max(box[0], region[0]), min(box[2], region[2])
+    if left >= right or top >= bottom:
+        return 0
+    return float(right - left) * float(bottom - top) / float(area)
+
+
+def _loop_remap_boxes(rec, n, im_size):
+    """
+    remap_boxes before it was vectorized, a box goes to every tile covering more than 80% of it;
+    box_channels is the tile index, the loop stored box index * n + column instead
+    """
+    height, width = im_size[:2]
+    grid_h = floor(height * 1.0 / (n - 1))
+    grid_w = floor(width * 1.0 / (n - 1))
+    step_h = floor(height * float(n - 2) / float(pow((n - 1), 2)))
+    step_w = floor(width * float(n - 2) / float(pow((n - 1), 2)))
+    boxes, box_channels, box_inds = [], [], []
+    for i in range(rec['boxes'].shape[0]):
+        for j in range(n):
+            for k in range(n):
+                region = [step_w * k, step_h * j, step_w * k + grid_w, step_h * j + grid_h]
+                box = rec['boxes'][i].tolist()
+                if _loop_coverage(box, region) > 0.8:
+                    t_box = [max(box[0], region[0]) - region[0], max(box[1], region[1]) - region[1],
+                             min(box[2], region[2]) - region[0], min(box[3], region[3]) - region[1]]
+                    boxes.append(t_box)
+                    box_channels.append(j * n + k)
+                    box_inds.append(i)
+    return np.asarray(boxes, dtype=np.uint16).reshape((-1, 4)), np.asarray(box_channels, dtype=np.uint16), box_inds
+
+def _random_rec(rng, height, width, num_boxes):
+    x1 = rng.randint(0, width - 1, num_boxes)
+    y1 = rng.randint(0, height - 1, num_boxes)
+    x2 = np.minimum(x1 + rng.randint(1, width // 2 + 2, num_boxes), width - 1)
+    y2 = np.minimum(y1 + rng.randint(1, height // 2 + 2, num_boxes), height - 1)
+    gt_classes = rng.randint(1, 5, num_boxes)
+    gt_overlaps = np.zeros((num_boxes, 5), dtype=np.float32)
+    gt_overlaps[np.arange(num_boxes), gt_classes] = 1
+    return {'boxes': np.vstack((x1, y1, x2, y2)).transpose().astype(np.uint16), 'gt_classes': gt_classes,
+            'gt_overlaps': gt_overlaps, 'max_classes': gt_classes, 'max_overlaps': np.ones(num_boxes)}
+
+
+def test_crop_image_matches_loop():
+    rng = np.random.RandomState(0)
+    for _ in range(50):
+        n = rng.randint(2, 6)
+        img = rng.randint(0, 256, (rng.randint(n, 300), rng.randint(n, 300), 3)).astype(np.uint8)
+        if rng.rand() < 0.5:
+            img = img[:, ::-1, :]
+        expected = _loop_crop_image(img, n)
+        tiles = crop_image(img, n)
+        assert tiles.dtype == np.uint8
+        assert tiles.shape == expected.shape
+        assert np.array_equal(tiles, expected)
+
+
+def test_crop_image_reuses_out():
+    rng = np.random.RandomState(1)
+    img = rng.randint(0, 256, (120, 170, 3)).astype(np.uint8)
+    first = crop_image(img, 3)
+    out = np.empty_like(first)
+    assert crop_image(img, 3, out=out) is out
+    assert np.array_equal(out, first)
+    # a mismatching buffer is not written
+    wrong = np.zeros(first.shape, dtype=np.float32)
+    assert crop_image(img, 3, out=wrong) is not wrong
+    assert not wrong.any()
+
+
+def test_remapped_boxes_cover_the_same_pixels():
+    """ the pixels under a remapped box in its tile are the pixels under the box in the image """
+    rng = np.random.RandomState(2)
+    for _ in range(50):
+        n = rng.randint(2, 5)
+        height, width = rng.randint(40, 200, 2)
+        img = rng.randint(0, 256, (height, width, 3)).astype(np.uint8)
+        rec = _random_rec(rng, height, width, rng.randint(0, 20))
+        tiles = crop_image(img, n)
+        remap_boxes(rec, n, img.shape)
+        grid_h, grid_w, step_h, step_w = get_crop_grid(height, width, n)
+        for (x1, y1, x2, y2), tile in zip(rec['boxes'].astype(int), rec['box_channels'].astype(int)):
+            ox, oy = tile % n * step_w, tile // n * step_h
+            assert 0 <= x1 <= x2 <= grid_w and 0 <= y1 <= y2 <= grid_h
+            assert np.array_equal(tiles[y1:y2, x1:x2, 3 * tile:3 * tile + 3], img[y1 + oy:y2 + oy, x1 + ox:x2 + ox, :])
+        assert len(rec['gt_classes']) == len(rec['boxes']) == len(rec['box_channels'])
+
+
+def _crop_config(pipeline, n, scale):
+    return edict({'CROP_NUM': n, 'CROP_PIPELINE': pipeline, 'SCALES': [scale], 'network': {'IMAGE_STRIDE': 32}})
+
+
+def _tile_coverage(boxes, height, width, n):
+    """ [num_boxes, n * n] share of every box inside every tile, as remap_boxes computes it """
+    grid_h, grid_w, step_h, step_w = get_crop_grid(height, width, n)
+    tile_x1 = np.tile(np.arange(n) * step_w, n)
+    tile_y1 = np.repeat(np.arange(n) * step_h, n)
+    w = np.maximum(np.minimum(boxes[:, 2:3], tile_x1 + grid_w) - np.maximum(boxes[:, 0:1], tile_x1), 0)
+    h = np.maximum(np.minimum(boxes[:, 3:4], tile_y1 + grid_h) - np.maximum(boxes[:, 1:2], tile_y1), 0)
+    return w * h / ((boxes[:, 2:3] - boxes[:, 0:1]) * (boxes[:, 3:4] - boxes[:, 1:2])).astype(float)
+
+
+def test_resize_first_matches_crop_first(tmpdir):
+    """
+    resize_first rounds the tile offsets in the resized space: same shapes and im_scale,
+    pixels within 2 grey levels, the same remapped boxes within 1 pixel plus the rounding
+    of their tile's offset, at most (n - 1) / 2 pixels
+    """
+    rng = np.random.RandomState(3)
+    height, width = 1944, 2592
+    # fundus like smooth content, resampling differences stay small
+    img = cv2.resize(rng.randint(0, 256, (12, 16, 3)).astype(np.uint8), (width, height), interpolation=cv2.INTER_CUBIC)
+    path = str(tmpdir.join('im.png'))
+    cv2.imwrite(path, img)
+
+    rec = _random_rec(rng, height, width, 80)
+    for n in (3, 4):
+        # boxes covered by a tile close to the 0.8 threshold may go either way after rounding
+        coverage = _tile_coverage(rec['boxes'].astype(int), height, width, n)
+        clear = np.where(np.all(np.abs(coverage - 0.8) > 0.05, axis=1))[0]
+        assert len(clear) > 40
+        for flipped in (False, True):
+            roi_rec = dict((k, v[clear]) for k, v in rec.items())
+            # max_overlaps identifies the source box of every remapped box
+            roi_rec['max_overlaps'] = np.arange(len(clear), dtype=float)
+            roi_rec.update({'image': path, 'flipped': flipped})
+            if flipped:
+                boxes = roi_rec['boxes'].astype(int)
+                roi_rec['boxes'] = np.vstack((width - boxes[:, 2] - 1, boxes[:, 1],
+                                              width - boxes[:, 0] - 1, boxes[:, 3])).transpose().astype(np.uint16)
+            for scale in ((600, 1000), (1120, 2000)):
+                results = []
+                for pipeline in ('crop_first', 'resize_first'):
+                    config = _crop_config(pipeline, n, scale)
+                    im, im_scale, grid = load_crop_image(roi_rec, 0, config)
+                    results.append((im, im_scale, grid, get_crop_rec(roi_rec, im.shape, im_scale, grid, config)))
+                (im_a, scale_a, grid_a, rec_a), (im_b, scale_b, grid_b, rec_b) = results
+                assert im_a.shape == im_b.shape and im_a.dtype == im_b.dtype
+                assert scale_a == scale_b
+                assert rec_a['im_info'] == rec_b['im_info']
+                diff = np.abs(im_a.astype(int) - im_b.astype(int))
+                assert diff.max() <= 2 and diff.mean() < 0.2
+
+                order_a = np.lexsort((rec_a['box_channels'], rec_a['max_overlaps']))
+                order_b = np.lexsort((rec_b['box_channels'], rec_b['max_overlaps']))
+                assert np.array_equal(rec_a['max_overlaps'][order_a], rec_b['max_overlaps'][order_b])
+                assert np.array_equal(rec_a['box_channels'][order_a], rec_b['box_channels'][order_b])
+                # tile offsets of crop_first scaled, of resize_first rounded in the resized space
+                tiles = rec_a['box_channels'][order_a].astype(int)
+                offset_x = np.abs(tiles % n * (grid_a[3] * scale_a - grid_b[3]))
+                offset_y = np.abs(tiles // n * (grid_a[2] * scale_a - grid_b[2]))
+                assert max(offset_x.max(), offset_y.max()) <= (n - 1) / 2.0
+                tolerance = 1 + np.vstack((offset_x, offset_y, offset_x, offset_y)).transpose()
+                assert np.all(np.abs(rec_a['boxes'][order_a] - rec_b['boxes'][order_b]) <= tolerance + 1e-6)
+
+
+def test_remap_boxes_matches_loop():
+    rng = np.random.RandomState(4)
+    for _ in range(500):
+        n = rng.randint(2, 6)
+        height, width = rng.randint(20, 400, 2)
+        rec = _random_rec(rng, height, width, rng.randint(0, 30))
+        boxes, box_channels, box_inds = _loop_remap_boxes(rec, n, (height, width))
+        new_rec = dict(rec)
+        remap_boxes(new_rec, n, (height, width))
+        assert new_rec['boxes'].dtype == np.uint16 and new_rec['box_channels'].dtype == np.uint16
+        assert new_rec['boxes'].shape == (len(box_inds), 4)
+        assert np.array_equal(new_rec['boxes'], boxes)
+        assert np.array_equal(new_rec['box_channels'], box_channels)
+        for key in ('gt_classes', 'max_classes', 'max_overlaps'):
+            assert np.array_equal(new_rec[key], rec[key][box_inds])
+        assert new_rec['gt_overlaps'].dtype == np.float32
+        assert np.array_equal(new_rec['gt_overlaps'], rec['gt_overlaps'][box_inds])
+
+
+def test_remap_boxes_channel_is_tile_index():
+    """ box_channels is row * n + column of the tile, the channel group crop_image stores it in """
+    rec = _random_rec(np.random.RandomState(5), 100, 100, 0)
+    # 3x3 tiles of 50x50 every 25 px: the box fits in tile (row 1, column 2) and (row 2, column 2) only,
+    # the former box index * n + column gave 2 for both
+    rec.update({'boxes': np.array([[80, 55, 90, 70]], dtype=np.uint16), 'gt_classes': np.array([3]),
+                'gt_overlaps': np.zeros((1, 5), dtype=np.float32), 'max_classes': np.array([3]),
+                'max_overlaps': np.ones(1)})
+    remap_boxes(rec, 3, (100, 100))
+    assert rec['box_channels'].tolist() == [1 * 3 + 2, 2 * 3 + 2]
+    assert rec['boxes'].tolist() == [[30, 30, 40, 45], [30, 5, 40, 20]]
+    assert rec['gt_classes'].tolist() == [3, 3]
+
+
+def _loop_transform_crop(im, pixel_means):
+    """ transform_crop before it was vectorized: one subtraction per channel """
+    channel = im.shape[2]
+    im_tensor = np.zeros((1, channel, im.shape[0], im.shape[1]))
+    for i in range(channel / 3):
+        for j in range(3):
+            im_tensor[0, i * 3 + j, :, :] = im[:, :, i * 3 + 2 - j] - pixel_means[2 - j]
+    return im_tensor
+
+
+def test_transform_crop_matches_loop():
+    rng = np.random.RandomState(6)
+    pixel_means = np.array([103.06, 115.90, 123.15])
+    for channel in (3, 27):
+        im = rng.randint(0, 256, (37, 53, channel)).astype(np.uint8)
+        expected = _loop_transform_crop(im, pixel_means)
+        im_tensor = transform_crop(im, pixel_means)
+        assert im_tensor.dtype == np.float32 and im_tensor.shape == expected.shape
+        np.testing.assert_allclose(im_tensor, expected, rtol=0, atol=1e-4)
+        out = np.empty(expected.shape, dtype=np.float32)
+        assert transform_crop(im, pixel_means, im_tensor=out) is out
+        assert np.array_equal(out, im_tensor)
+
+
+def test_transform_crop_rejects_buffers_it_cannot_fill():
+    im = np.zeros((8, 10, 6), dtype=np.uint8)
+    pixel_means = np.array([103.06, 115.90, 123.15])
+    for im_tensor in (np.empty((1, 6, 10, 8), dtype=np.float32).transpose((0, 1, 3, 2)),
+                      np.empty((1, 6, 8, 10), dtype=np.float64),
+                      np.empty((1, 6, 8, 12), dtype=np.float32)):
+        with pytest.raises(AssertionError):
+            transform_crop(im, pixel_means, im_tensor=im_tensor)
+
+
+def test_tile_cache_follows_the_scales(tmpdir):
+    """ pred_eval swaps config.SCALES for every test scale, the cached tiles of one must not serve the next """
+    rng = np.random.RandomState(7)
+    path = str(tmpdir.join('im.png'))
+    cv2.imwrite(path, rng.randint(0, 256, (300, 400, 3)).astype(np.uint8))
+    roidb = [dict(_random_rec(rng, 300, 400, 3), image=path, flipped=False)]
+    cached = _crop_config('crop_first', 3, (600, 1000))
+    cached.update({'TILE_CACHE_BYTES': 1 << 26, 'TILE_SHARD_PATH': '',
+                   'network': {'IMAGE_STRIDE': 32, 'DEVICE_NORMALIZE': True, 'PIXEL_MEANS': np.zeros(3)}})
+    uncached = edict(cached, TILE_CACHE_BYTES=0)
+    for scale in ((600, 1000), (300, 500), (600, 1000)):
+        cached.SCALES = uncached.SCALES = [scale]
+        ims, recs = get_crop_image(roidb, cached)
+        expected_ims, expected_recs = get_crop_image(roidb, uncached)
+        assert ims[0].shape == expected_ims[0].shape
+        assert np.array_equal(ims[0], expected_ims[0])
+        assert recs[0]['im_info'] == expected_recs[0]['im_info']
+    assert get_tile_cache(cached).hits == 1
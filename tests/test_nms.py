@@ -0,0 +1,93 @@
+# --------------------------------------------------------
+# Deformable Convolutional Networks
+# Copyright (c) 2017 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+import numpy as np
+import pytest
+
+from nms.nms import nms, vectorized_nms, batched_nms_wrapper, nms_wrapper, cpu_nms, gpu_nms
+
+BACKENDS = ['numpy',
+            pytest.param('cpu', marks=pytest.mark.skipif(cpu_nms is None, reason='cpu_nms is not built')),
+            pytest.param('gpu', marks=pytest.mark.skipif(gpu_nms is None, reason='gpu_nms is not built'))]
+
+
+def _random_dets(rng, num, size=1000):
+    """ clustered float32 boxes with fractional corners and distinct scores """
+    centers = rng.uniform(0, size, (max(num // 20, 1), 2))
+    xy = centers[rng.randint(0, len(centers), num)] + rng.normal(0, 20, (num, 2))
+    wh = rng.uniform(4, 200, (num, 2))
+    scores = rng.permutation(num) / float(num)
+    return np.hstack((xy, xy + wh, scores[:, np.newaxis])).astype(np.float32)
+
+
+def _edge_dets(rng, thresh, num_groups):
+    """ per group a pair of boxes whose overlap is within 1e-5 of thresh """
+    dets = []
+    for _ in range(num_groups):
+        x, y = rng.uniform(0, 800, 2)
+        w, h = rng.uniform(10, 200, 2)
+        # shifted by d along x: overlap = (w + 1 - d) * (h + 1) / (2 * area - (w + 1 - d) * (h + 1))
+        d = (w + 1) - 2 * thresh * (w + 1) / (1 + thresh)
+        d *= 1 + rng.uniform(-1e-5, 1e-5)
+        dets += [[x, y, x + w, y + h, 0.9], [x + d, y, x + d + w, y + h, 0.8]]
+    return np.array(dets, dtype=np.float32)
+
+
+def _group_nms(dets, groups, thresh, max_keep):
+    keep = []
+    for group in np.unique(groups):
+        inds = np.where(groups == group)[0]
+        group_keep = inds[nms(dets[inds], thresh)]
+        keep.extend(group_keep[:max_keep] if max_keep > 0 else group_keep)
+    return keep
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_nms_wrapper_matches_nms(backend):
+    rng = np.random.RandomState(0)
+    device_id = 0 if backend == 'gpu' else None
+    for case in range(100):
+        dets = _random_dets(rng, rng.randint(1, 800))
+        thresh = [0.3, 0.5, 0.7][case % 3]
+        max_keep = [-1, 1, 33][case % 3]
+        expected = nms(dets, thresh)
+        keep = nms_wrapper(backend, thresh, device_id, max_keep)(dets)
+        assert list(keep) == (expected[:max_keep] if max_keep > 0 else expected)
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_batched_nms_matches_nms_per_group(backend):
+    rng = np.random.RandomState(1)
+    device_id = 0 if backend == 'gpu' else None
+    for case in range(100):
+        num = rng.randint(1, 800)
+        # crop channels of the proposal layer, coordinates of every crop overlap the others
+        dets = _random_dets(rng, num)
+        groups = rng.randint(0, 9, num)
+        thresh = [0.3, 0.5, 0.7][case % 3]
+        max_keep = [-1, 5, 222][case % 3]
+        keep = batched_nms_wrapper(backend, thresh, device_id, max_keep)(dets, groups)
+        assert list(keep) == _group_nms(dets, groups, thresh, max_keep)
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_batched_nms_keeps_edge_pairs(backend):
+    # moving the groups apart along x in float32 rounds the corners, which flips these pairs
+    rng = np.random.RandomState(2)
+    device_id = 0 if backend == 'gpu' else None
+    for _ in range(50):
+        dets = _edge_dets(rng, 0.7, 9)
+        groups = np.repeat(np.arange(9), 2)
+        keep = batched_nms_wrapper(backend, 0.7, device_id)(dets, groups)
+        assert list(keep) == _group_nms(dets, groups, 0.7, -1)
+
+
+def test_vectorized_nms_blocks():
+    rng = np.random.RandomState(3)
+    dets = _random_dets(rng, 3000)
+    expected = nms(dets, 0.7)
+    for block_size in (1, 7, 512, 4096):
+        assert list(vectorized_nms(dets, 0.7, block_size=block_size)) == expected
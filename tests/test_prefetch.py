@@ -0,0 +1,209 @@
+# --------------------------------------------------------
+# Deformable Convolutional Networks
+# Copyright (c) 2017 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+import cPickle
+import threading
+import cv2
+import numpy as np
+import pytest
+from easydict import EasyDict as edict
+
+mx = pytest.importorskip('mxnet')
+from core import loader
+from mxnet.io import DataDesc
+from utils.PrefetchingIter import PrefetchingIter
+from utils.ProcessPrefetchingIter import ProcessPrefetchingIter
+from utils.shared_slots import pack_batch, unpack_batch
+
+
+def _loader_config():
+    return edict({'SCALES': [(160, 240)], 'CROP_NUM': 3, 'CROP_PIPELINE': 'crop_first', 'TILE_CACHE_BYTES': 0,
+                  'TILE_SHARD_PATH': '', 'network': {'IMAGE_STRIDE': 32, 'DEVICE_NORMALIZE': True,
+                                                     'PIXEL_MEANS': np.array([103.06, 115.90, 123.15])}})
+
+
+def _roidb(tmpdir, num_images=7):
+    rng = np.random.RandomState(0)
+    roidb = []
+    for i in range(num_images):
+        path = str(tmpdir.join('im%d.png' % i))
+        cv2.imwrite(path, rng.randint(0, 256, (rng.randint(120, 200), rng.randint(150, 260), 3)).astype(np.uint8))
+        roidb.append({'image': path, 'flipped': bool(i % 2), 'boxes': np.zeros((0, 4), dtype=np.uint16),
+                      'gt_classes': np.zeros(0, dtype=int), 'gt_overlaps': np.zeros((0, 2), dtype=np.float32),
+                      'max_classes': np.zeros(0, dtype=int), 'max_overlaps': np.zeros(0)})
+    return roidb
+
+
+def _epoch(data_iter, test_loader, seed):
+    """ (im_info, data) of every batch of one epoch, the shuffle of test_loader drawn from seed """
+    # TestLoader shuffles its index in place, start every epoch from the same order
+    test_loader.index = np.arange(test_loader.size)
+    np.random.seed(seed)
+    data_iter.reset()
+    batches = []
+    for im_info, batch in data_iter:
+        batches.append(([x.copy() for x in im_info], [[x.asnumpy() for x in data] for data in batch.data]))
+    return batches
+
+
+def _assert_same_batches(batches, expected):
+    assert len(batches) == len(expected)
+    for (im_info, data), (expected_im_info, expected_data) in zip(batches, expected):
+        assert len(im_info) == len(expected_im_info) and len(data) == len(expected_data)
+        for x, y in zip(im_info, expected_im_info):
+            assert np.array_equal(x, y)
+        for x, y in zip(sum(data, []), sum(expected_data, [])):
+            assert x.dtype == y.dtype and np.array_equal(x, y)
+
+
+def test_process_prefetch_matches_loader(tmpdir):
+    roidb = _roidb(tmpdir)
+    serial = loader.TestLoader(roidb, _loader_config(), batch_size=2, shuffle=True, has_rpn=True)
+    cfg = _loader_config()
+    prefetch = ProcessPrefetchingIter(loader.TestLoader(roidb, cfg, batch_size=2, shuffle=True, has_rpn=True),
+                                      num_workers=2, depth=3)
+    try:
+        workers = [worker.pid for worker in prefetch.workers]
+        for seed in (1, 2):
+            _assert_same_batches(_epoch(prefetch, prefetch.data_iter, seed), _epoch(serial, serial, seed))
+        # workers are kept across resets
+        assert [worker.pid for worker in prefetch.workers] == workers
+
+        # a cfg change forks the workers again, they see the new scale
+        cfg.SCALES = serial.cfg.SCALES = [(320, 480)]
+        batches = _epoch(prefetch, prefetch.data_iter, 3)
+        assert [worker.pid for worker in prefetch.workers] != workers
+        expected = _epoch(serial, serial, 3)
+        assert expected[0][1][0][0].shape[2] > 160
+        _assert_same_batches(batches, expected)
+    finally:
+        prefetch.close()
+    assert not prefetch.workers
+
+
+class _FailingLoader(loader.TestLoader):
+    def load_batch(self, index):
+        if 3 in index:
+            raise ValueError('no image %d' % 3)
+        return super(_FailingLoader, self).load_batch(index)
+
+
+def test_process_prefetch_raises_worker_errors(tmpdir):
+    prefetch = ProcessPrefetchingIter(_FailingLoader(_roidb(tmpdir), _loader_config(), batch_size=2, has_rpn=True),
+                                      num_workers=2, depth=2)
+    prefetch.next()
+    with pytest.raises(RuntimeError) as error:
+        prefetch.next()
+    assert 'ValueError: no image 3' in str(error.value)
+    assert 'load_batch' in str(error.value)
+    # the workers were stopped
+    assert not prefetch.workers
+
+
+def _assert_same_layout(x, y):
+    if isinstance(y, np.ndarray):
+        assert isinstance(x, np.ndarray) and x.dtype == y.dtype and np.array_equal(x, y)
+    elif isinstance(y, dict):
+        assert sorted(x) == sorted(y)
+        for k in y:
+            _assert_same_layout(x[k], y[k])
+    elif isinstance(y, (list, tuple)):
+        assert type(x) == type(y) and len(x) == len(y)
+        for a, b in zip(x, y):
+            _assert_same_layout(a, b)
+    else:
+        assert x == y
+
+
+def test_pack_batch_round_trip():
+    rng = np.random.RandomState(0)
+    batch = ([{'data': rng.randint(0, 256, (1, 27, 64, 96)).astype(np.uint8),
+               'im_info': np.array([[64, 96, 0.5]], dtype=np.float32)}],
+             {'label': rng.randint(-1, 2, (1, 5000)).astype(np.float32), 'gt_boxes': [np.zeros((0, 6))],
+              'names': ('a', 3, None)})
+    buf = bytearray(1 << 20)
+    # the layout goes through the result queue pickled
+    layout = cPickle.loads(cPickle.dumps(pack_batch(batch, buf), cPickle.HIGHEST_PROTOCOL))
+    unpacked = unpack_batch(layout, buf)
+    _assert_same_layout(unpacked, batch)
+    # large arrays are views of the slot, small ones copies
+    data = unpacked[0][0]['data']
+    assert not data.flags.owndata and data.ctypes.data >= np.frombuffer(buf, dtype=np.uint8).ctypes.data
+    assert unpacked[0][0]['im_info'].flags.owndata
+
+
+def test_pack_batch_pickles_arrays_over_the_slot():
+    rng = np.random.RandomState(1)
+    small = rng.rand(100)
+    large = rng.rand(1000)
+    buf = bytearray(4096)
+    layout = pack_batch({'small': small, 'large': large, 'after': small[:10]}, buf)
+    # what does not fit stays in the layout, the rest still goes into the slot
+    assert isinstance(layout['large'], np.ndarray)
+    assert layout['small'][0] == '__slot__' and layout['after'][0] == '__slot__'
+    unpacked = unpack_batch(cPickle.loads(cPickle.dumps(layout, cPickle.HIGHEST_PROTOCOL)), buf)
+    _assert_same_layout(unpacked, {'small': small, 'large': large, 'after': small[:10]})
+
+
+class _CountingIter(object):
+    """ stand-in DataIter, an epoch is 0 .. size - 1; next() raises ValueError at fail_at """
+    def __init__(self, size, fail_at=None):
+        self.size = size
+        self.fail_at = fail_at
+        self.cur = 0
+        self.provide_data = [[DataDesc('data', (2, 3))]]
+        self.provide_label = [[DataDesc('label', (2,))]]
+
+    def reset(self):
+        self.cur = 0
+
+    def next(self):
+        if self.cur == self.fail_at:
+            raise ValueError('batch %d is broken' % self.cur)
+        if self.cur >= self.size:
+            raise StopIteration
+        self.cur += 1
+        return self.cur - 1
+
+
+def test_prefetch_keeps_order_across_resets():
+    prefetch = PrefetchingIter(_CountingIter(20), depth=3)
+    assert prefetch.batch_size == 2
+    assert [prefetch.next() for _ in range(7)] == list(range(7))
+    for _ in range(3):
+        # batches prefetched before the reset are dropped
+        prefetch.reset()
+        assert list(prefetch) == list(range(20))
+        assert not prefetch.iter_next()
+    assert prefetch.wait_stats()['batches'] == 20
+    prefetch.close()
+
+
+def test_prefetch_raises_producer_errors():
+    prefetch = PrefetchingIter(_CountingIter(20, fail_at=5), depth=2)
+    assert [prefetch.next() for _ in range(5)] == list(range(5))
+    with pytest.raises(RuntimeError) as error:
+        prefetch.next()
+    assert 'ValueError: batch 5 is broken' in str(error.value)
+    # the producer stopped, the epoch is over until the next reset
+    with pytest.raises(StopIteration):
+        prefetch.next()
+    prefetch.iters[0].fail_at = None
+    prefetch.reset()
+    assert list(prefetch) == list(range(20))
+    prefetch.close()
+
+
+def test_prefetch_close_joins_the_producer():
+    prefetch = PrefetchingIter(_CountingIter(100), depth=2)
+    prefetch.next()
+    # the producer is blocked on the full queue
+    thread = prefetch.prefetch_thread
+    assert thread.is_alive()
+    prefetch.close()
+    assert not thread.is_alive() and prefetch.prefetch_thread is None
+    assert thread not in threading.enumerate()
+    prefetch.close()
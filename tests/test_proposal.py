@@ -0,0 +1,88 @@
+# --------------------------------------------------------
+# Deformable Convolutional Networks
+# Copyright (c) 2017 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+import numpy as np
+import numpy.random as npr
+import pytest
+
+pytest.importorskip('mxnet')
+from operator_py.pyramid_proposal import PyramidProposalOperator
+
+
+def _loop_channel_keeps(keep, channels, per_channel):
+    """ the per channel loop of the proposal layer before the batched nms """
+    keep = np.asarray(keep, dtype=int)
+    keep = keep[np.argsort(channels[keep], kind='mergesort')]
+    keeps = []
+    for channel in np.unique(channels[keep]):
+        channel_keep = keep[channels[keep] == channel]
+        keeps.extend(channel_keep[:per_channel])
+        if len(channel_keep) < per_channel:
+            keeps.extend(npr.choice(channel_keep, size=per_channel - len(channel_keep)))
+    return np.array(keeps, dtype=int)
+
+
+def test_channel_keeps_matches_loop():
+    rng = np.random.RandomState(0)
+    for _ in range(100):
+        channels = rng.randint(0, 9, rng.randint(1, 300))
+        keep = rng.permutation(len(channels))[:rng.randint(1, len(channels) + 1)]
+        per_channel = rng.randint(1, 40)
+        npr.seed(1)
+        expected = _loop_channel_keeps(keep, channels, per_channel)
+        npr.seed(1)
+        np.testing.assert_array_equal(PyramidProposalOperator._channel_keeps(keep, channels, per_channel), expected)
+
+
+STRIDES = (4, 8, 16, 32, 64)
+
+
+def _proposal_inputs(rng, batch, height, width, num_anchors=3, crops=9):
+    """ rpn outputs of every level with scores distinct over all levels """
+    shapes = [(batch, 2 * num_anchors * crops, height // s, width // s) for s in STRIDES]
+    sizes = [int(np.prod(shape)) for shape in shapes]
+    values = ((rng.permutation(sum(sizes)) + 1) / float(sum(sizes))).astype(np.float32)
+    cls_prob = [v.reshape(shape) for v, shape in zip(np.split(values, np.cumsum(sizes)[:-1]), shapes)]
+    bbox_pred = [(rng.randn(batch, 4 * num_anchors * crops, height // s, width // s) * 0.1).astype(np.float32)
+                 for s in STRIDES]
+    im_info = np.tile(np.array([[height, width, 1.]], dtype=np.float32), (batch, 1))
+    return cls_prob + bbox_pred + [im_info]
+
+
+def _run_proposal(op_type, inputs, pre_nms_top_n, post_nms_top_n, min_size):
+    import mxnet as mx
+    import operator_py.pyramid_proposal_nd
+    outputs = mx.nd.Custom(*[mx.nd.array(x) for x in inputs], op_type=op_type, feat_stride=str(STRIDES),
+                           scales='(8)', ratios='(0.5, 1, 2)', output_score='True',
+                           rpn_pre_nms_top_n=pre_nms_top_n, rpn_post_nms_top_n=post_nms_top_n, threshold=0.7,
+                           rpn_min_size=min_size, nms_backend='numpy')
+    return [x.asnumpy() for x in outputs]
+
+
+@pytest.mark.parametrize('pre_nms_top_n, post_nms_top_n, min_size', [(2000, 450, 0), (2000, 450, 16),
+                                                                     (5, 90, 0), (2000, 90, 100000)])
+def test_nd_proposal_matches_numpy_proposal(pre_nms_top_n, post_nms_top_n, min_size):
+    # (5, 90): most channels keep nothing, (.., 100000): no proposal passes the size filter
+    rng = np.random.RandomState(0)
+    batch, height, width = 2, 128, 256
+    inputs = _proposal_inputs(rng, batch, height, width)
+    rois, scores = _run_proposal('pyramid_proposal', inputs, pre_nms_top_n, post_nms_top_n, min_size)
+    nd_rois, nd_scores = _run_proposal('pyramid_proposal_nd', inputs, pre_nms_top_n, post_nms_top_n, min_size)
+    assert rois.shape == nd_rois.shape == (batch * post_nms_top_n, 5)
+    assert scores.shape == nd_scores.shape == (batch * post_nms_top_n, 1)
+    np.testing.assert_array_equal(rois[:, 0], nd_rois[:, 0])
+    # padding picks differ, every channel block holds the same distinct proposals
+    per_channel = post_nms_top_n // 9
+    for start in range(0, batch * post_nms_top_n, per_channel):
+        block = slice(start, start + per_channel)
+        expected = dict(zip(scores[block, 0], map(tuple, rois[block, 1:])))
+        actual = dict(zip(nd_scores[block, 0], map(tuple, nd_rois[block, 1:])))
+        assert sorted(expected) == sorted(actual)
+        for score in expected:
+            np.testing.assert_allclose(actual[score], expected[score], atol=1e-3)
+    if min_size > max(height, width):
+        np.testing.assert_array_equal(nd_rois[:, 1:], np.tile([0, 0, width - 1, height - 1], (len(nd_rois), 1)))
+        assert np.all(nd_scores == 0)
@@ -0,0 +1,228 @@
+# --------------------------------------------------------
+# Deformable Convolutional Networks
+# Copyright (c) 2017 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+import os
+import numpy as np
+import numpy.random as npr
+import pytest
+from easydict import EasyDict as edict
+
+from bbox.bbox_transform import bbox_transform
+from rpn.generate_anchor import generate_anchors
+from rpn import rpn
+from rpn.rpn import assign_pyramid_anchor, _sample_rows
+from rpn.label_cache import anchor_label_path
+
+STRIDES = (4, 8, 16)
+SCALES = (4,)
+RATIOS = (0.5, 1, 2)
+
+
+def _rpn_config(batch_size=-1, kernel='dense', sparse=False, n=2, label_cache=''):
+    return edict({'CROP_NUM': n, 'network': {'ANCHOR_SCALES': SCALES, 'ANCHOR_RATIOS': RATIOS,
+                                             'RPN_FEAT_STRIDE': STRIDES}, 'TRAIN': {
+        'RPN_BATCH_SIZE': batch_size, 'RPN_FG_FRACTION': 0.5, 'RPN_POSITIVE_OVERLAP': 0.5,
+        'RPN_NEGATIVE_OVERLAP': 0.3, 'RPN_CLOBBER_POSITIVES': False, 'RPN_BBOX_WEIGHTS': (1.0, 1.0, 1.0, 1.0),
+        'RPN_OVERLAPS_KERNEL': kernel, 'RPN_LABEL_CACHE': label_cache, 'RPN_SPARSE_LABEL': sparse}})
+
+
+def _iou(box, gt):
+    """ bbox_overlaps of one pair, +1 pixel widths """
+    iw = min(box[2], gt[2]) - max(box[0], gt[0]) + 1
+    ih = min(box[3], gt[3]) - max(box[1], gt[1]) + 1
+    if iw <= 0 or ih <= 0:
+        return 0.0
+    ua = float((box[2] - box[0] + 1) * (box[3] - box[1] + 1) + (gt[2] - gt[0] + 1) * (gt[3] - gt[1] + 1) - iw * ih)
+    return iw * ih / ua
+
+
+def _reference_label(feat_shapes, gt_boxes, im_info, cfg, allowed_border):
+    """
+    assign_pyramid_anchor without subsampling, one anchor at a time: an anchor is matched against the gt
+    boxes of its own crop only, the best anchor of a gt is searched over all levels; the label of a level
+    is (A, crops, H, W), its targets (A * 4, crops, H, W), the levels follow each other
+    """
+    crops = cfg.CROP_NUM ** 2
+    train = cfg.TRAIN
+    levels = []
+    for stride, shape in zip(STRIDES, feat_shapes):
+        height, width = shape[0][-2:]
+        base_anchors = generate_anchors(base_size=stride, ratios=np.array(RATIOS), scales=np.array(SCALES))
+        for crop in range(crops):
+            for h in range(height):
+                for w in range(width):
+                    for a, base in enumerate(base_anchors):
+                        anchor = base + [w * stride, h * stride, w * stride, h * stride]
+                        if anchor[0] < -allowed_border or anchor[1] < -allowed_border or \
+                                anchor[2] >= im_info[1] + allowed_border or anchor[3] >= im_info[0] + allowed_border:
+                            continue
+                        ious = [_iou(anchor, gt) if int(gt[5]) == crop else 0.0 for gt in gt_boxes]
+                        levels.append((len(levels), (stride, a, crop, h, w), anchor, ious))
+    overlaps = np.array([ious for _, _, _, ious in levels]).reshape((len(levels), len(gt_boxes)))
+    gt_max = overlaps.max(axis=0) if len(levels) else np.zeros(len(gt_boxes))
+
+    label = dict((s, -np.ones((len(RATIOS), crops) + tuple(shape[0][-2:]), dtype=np.float32))
+                 for s, shape in zip(STRIDES, feat_shapes))
+    target = dict((s, np.zeros((4 * len(RATIOS), crops) + tuple(shape[0][-2:]), dtype=np.float32))
+                  for s, shape in zip(STRIDES, feat_shapes))
+    weight = dict((s, np.zeros((4 * len(RATIOS), crops) + tuple(shape[0][-2:]), dtype=np.float32))
+                  for s, shape in zip(STRIDES, feat_shapes))
+    for row, (stride, a, crop, h, w), anchor, ious in levels:
+        max_overlap = max(ious)
+        value = -1
+        if max_overlap < train.RPN_NEGATIVE_OVERLAP:
+            value = 0
+        if any(iou == gt_max[g] and gt_max[g] > 0 for g, iou in enumerate(ious)) or \
+                max_overlap >= train.RPN_POSITIVE_OVERLAP:
+            value = 1
+        label[stride][a, crop, h, w] = value
+        if value == 1:
+            gt = gt_boxes[int(np.argmax(ious))]
+            target[stride][4 * a:4 * a + 4, crop, h, w] = bbox_transform(anchor[np.newaxis], gt[np.newaxis, :4])[0]
+            weight[stride][4 * a:4 * a + 4, crop, h, w] = train.RPN_BBOX_WEIGHTS
+    return {'label': np.hstack([label[s].reshape(-1) for s in STRIDES])[np.newaxis],
+            'bbox_target': np.hstack([target[s].reshape((4 * len(RATIOS), -1)) for s in STRIDES])[np.newaxis],
+            'bbox_weight': np.hstack([weight[s].reshape((4 * len(RATIOS), -1)) for s in STRIDES])[np.newaxis]}
+
+
+def _label_inputs(rng, num_gt, crops=4, height=64, width=96):
+    feat_shapes = [[(1, 1, height // s, width // s)] for s in STRIDES]
+    im_info = np.array([[height, width, 1.0]], dtype=np.float32)
+    x1 = rng.randint(0, width - 12, num_gt)
+    y1 = rng.randint(0, height - 12, num_gt)
+    x2 = np.minimum(x1 + rng.randint(8, 48, num_gt), width - 1)
+    y2 = np.minimum(y1 + rng.randint(8, 48, num_gt), height - 1)
+    # the last crop has no gt box
+    gt_boxes = np.vstack((x1, y1, x2, y2, np.ones(num_gt), rng.randint(0, crops - 1, num_gt))).transpose()
+    return feat_shapes, gt_boxes.astype(np.float32), im_info
+
+
+def _assign(feat_shapes, gt_boxes, im_info, cfg, allowed_border):
+    return assign_pyramid_anchor(feat_shapes, gt_boxes, im_info, cfg, feat_strides=STRIDES, scales=SCALES,
+                                 ratios=RATIOS, allowed_border=allowed_border)
+
+
+def _densify(sparse, dense_shapes):
+    """ scatter the entries of a sparse label into dense maps, as rpn_sparse_label does """
+    label = np.full(np.prod(dense_shapes['label']) + 1, -1, dtype=np.float32)
+    label[sparse['label_ind'].ravel()] = sparse['label'].ravel()
+    dense = {'label': label[:-1].reshape(dense_shapes['label'])}
+    for k in ('bbox_target', 'bbox_weight'):
+        maps = np.zeros(np.prod(dense_shapes[k]) + 1, dtype=np.float32)
+        maps[sparse['bbox_ind'].ravel()] = sparse[k].ravel()
+        dense[k] = maps[:-1].reshape(dense_shapes[k])
+    return dense
+
+
+@pytest.mark.parametrize('kernel', ['dense', 'sorted'])
+@pytest.mark.parametrize('allowed_border', [0, np.inf])
+def test_pyramid_labels_match_reference(kernel, allowed_border):
+    rng = np.random.RandomState(0)
+    for num_gt in (1, 4, 9):
+        feat_shapes, gt_boxes, im_info = _label_inputs(rng, num_gt)
+        cfg = _rpn_config(kernel=kernel)
+        expected = _reference_label(feat_shapes, gt_boxes, im_info[0], cfg, allowed_border)
+        label = _assign(feat_shapes, gt_boxes, im_info, cfg, allowed_border)
+        assert np.sum(expected['label'] == 1) > 0
+        for k in ('label', 'bbox_target', 'bbox_weight'):
+            assert label[k].shape == expected[k].shape
+            np.testing.assert_allclose(label[k], expected[k], rtol=0, atol=1e-6)
+
+
+def test_sampled_pyramid_labels_are_reference_labels():
+    rng = np.random.RandomState(1)
+    feat_shapes, gt_boxes, im_info = _label_inputs(rng, 6)
+    expected = _reference_label(feat_shapes, gt_boxes, im_info[0], _rpn_config(), 0)
+    cfg = _rpn_config(batch_size=64)
+    for seed in range(5):
+        npr.seed(seed)
+        label = _assign(feat_shapes, gt_boxes, im_info, cfg, 0)
+        sampled = label['label'] != -1
+        assert np.sum(sampled) == 64 and np.sum(label['label'] == 1) <= 32
+        assert np.array_equal(label['label'][sampled], expected['label'][sampled])
+        num_fg = np.sum(label['label'] == 1)
+        assert num_fg > 0
+        # targets of the sampled positives only
+        fg_maps = label['bbox_weight'] > 0
+        assert fg_maps.sum() == 4 * num_fg
+        assert np.all(expected['bbox_weight'][fg_maps] > 0)
+        np.testing.assert_allclose(label['bbox_target'][fg_maps], expected['bbox_target'][fg_maps], atol=1e-6)
+        assert not label['bbox_target'][~fg_maps].any()
+
+
+@pytest.mark.parametrize('num_gt', [0, 5])
+def test_sparse_labels_densify_to_dense_labels(num_gt):
+    rng = np.random.RandomState(2)
+    feat_shapes, gt_boxes, im_info = _label_inputs(rng, num_gt)
+    for seed in range(3):
+        npr.seed(seed)
+        dense = _assign(feat_shapes, gt_boxes, im_info, _rpn_config(batch_size=64), 0)
+        npr.seed(seed)
+        sparse = _assign(feat_shapes, gt_boxes, im_info, _rpn_config(batch_size=64, sparse=True), 0)
+        assert sparse['label'].shape == (1, 64) and sparse['bbox_ind'].shape == (1, 64, 4)
+        assert sparse['label_ind'].dtype == sparse['bbox_ind'].dtype == np.int32
+        densified = _densify(sparse, dict((k, v.shape) for k, v in dense.items()))
+        for k in ('label', 'bbox_target', 'bbox_weight'):
+            assert np.array_equal(densified[k], dense[k])
+
+
+def test_sample_rows_are_distinct_and_sorted():
+    npr.seed(3)
+    for num_rows, num_samples in ((10, 10), (10, 20), (100, 40), (10000, 256), (1000000, 256), (5, 0)):
+        rows = _sample_rows(num_rows, num_samples)
+        assert len(rows) == min(num_rows, num_samples)
+        assert np.all(np.diff(rows) > 0)
+        assert len(rows) == 0 or (rows[0] >= 0 and rows[-1] < num_rows)
+    # every row is drawn equally often
+    counts = np.bincount(np.concatenate([_sample_rows(200, 5) for _ in range(8000)]), minlength=200)
+    assert np.abs(counts / (8000 * 5 / 200.0) - 1).max() < 0.25
+
+
+def test_label_cache_gives_the_uncached_labels(tmpdir, monkeypatch):
+    rng = np.random.RandomState(4)
+    cache_path = str(tmpdir.join('labels'))
+    cfg = _rpn_config(batch_size=64, label_cache=cache_path)
+    inputs = [_label_inputs(rng, num_gt) for num_gt in (1, 5)]
+    for allowed_border in (0, np.inf):
+        expected = []
+        for feat_shapes, gt_boxes, im_info in inputs:
+            npr.seed(5)
+            expected.append(_assign(feat_shapes, gt_boxes, im_info, _rpn_config(batch_size=64), allowed_border))
+        # a miss matches and writes the entry, a hit reads it without matching
+        for hit in (False, True):
+            if hit:
+                monkeypatch.setattr(rpn, '_crop_block_overlaps', None)
+            for (feat_shapes, gt_boxes, im_info), expected_label in zip(inputs, expected):
+                npr.seed(5)
+                label = _assign(feat_shapes, gt_boxes, im_info, cfg, allowed_border)
+                for k in ('label', 'bbox_target', 'bbox_weight'):
+                    assert np.array_equal(label[k], expected_label[k])
+        monkeypatch.undo()
+
+    # one directory of the anchor settings per allowed_border, no temporary files left
+    entries = [os.path.join(root, name)[len(cache_path):] for root, _, names in os.walk(cache_path) for name in names]
+    assert len(entries) == 4 and all([x.endswith('.npz') for x in entries])
+    assert len(os.listdir(cache_path)) == 2
+
+
+def test_label_cache_directory_follows_the_anchor_settings(tmpdir):
+    feat_shapes, gt_boxes, im_info = _label_inputs(np.random.RandomState(6), 3)
+    cfg = _rpn_config(label_cache=str(tmpdir))
+
+    def path(cfg, allowed_border=0, scales=SCALES):
+        return anchor_label_path(cfg, feat_shapes, gt_boxes, im_info[0], STRIDES, scales, RATIOS, allowed_border)
+    base = path(cfg)
+    assert path(_rpn_config(label_cache=str(tmpdir))) == base
+    changed = []
+    for key, value in (('RPN_POSITIVE_OVERLAP', 0.7), ('RPN_NEGATIVE_OVERLAP', 0.2), ('RPN_CLOBBER_POSITIVES', True)):
+        other = _rpn_config(label_cache=str(tmpdir))
+        other.TRAIN[key] = value
+        changed.append(path(other))
+    changed += [path(cfg, allowed_border=np.inf), path(cfg, scales=(8,)), path(_rpn_config(n=3, label_cache=str(tmpdir)))]
+    for other in changed:
+        assert os.path.dirname(other) != os.path.dirname(base)
+        assert os.path.basename(other) == os.path.basename(base)
+    assert path(_rpn_config()) is None
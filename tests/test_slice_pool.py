@@ -0,0 +1,64 @@
+# --------------------------------------------------------
+# Deformable Convolutional Networks
+# Copyright (c) 2017 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+import random
+import numpy as np
+import pytest
+
+from utils.slice_pool import SlicePool, map_serial
+
+
+def _make_slice(size, fail=False):
+    """ stand-in for load_slice: random data of a device slice, drawn from random and np.random """
+    if fail:
+        raise ValueError('slice of %d is broken' % size)
+    return {'data': np.random.randint(0, 256, (1, 27, size, size)).astype(np.uint8),
+            'label': [np.random.rand(1, size), np.array([random.random()])]}
+
+
+def _assert_same_slices(results, expected):
+    assert len(results) == len(expected)
+    for result, slice_expected in zip(results, expected):
+        assert np.array_equal(result['data'], slice_expected['data'])
+        for x, y in zip(result['label'], slice_expected['label']):
+            assert np.array_equal(x, y)
+
+
+def test_slice_pool_matches_serial():
+    pool = SlicePool(_make_slice, num_workers=2, num_slots=4, slot_bytes=1 << 20)
+    try:
+        for args_list in ([(64,), (32,), (80,), (8,)], [(16,)], [(300,), (4,)]):
+            np.random.seed(7)
+            results = pool.map(args_list)
+            after_pool = np.random.rand()
+            np.random.seed(7)
+            expected = map_serial(_make_slice, args_list)
+            # the caller's np.random went on the same way
+            assert np.random.rand() == after_pool
+            _assert_same_slices(results, expected)
+        # calls of one map get different seeds
+        np.random.seed(8)
+        first, second = pool.map([(16,), (16,)])
+        assert not np.array_equal(first['data'], second['data'])
+    finally:
+        pool.close()
+    assert not pool.workers
+
+
+def test_slice_pool_raises_worker_errors():
+    pool = SlicePool(_make_slice, num_workers=2, num_slots=3, slot_bytes=1 << 16)
+    try:
+        with pytest.raises(RuntimeError) as error:
+            pool.map([(8,), (9, True), (10,)])
+        assert 'ValueError: slice of 9 is broken' in str(error.value)
+        assert 'Traceback' in str(error.value) and '_make_slice' in str(error.value)
+        # every result of the failed map was collected, the pool goes on
+        np.random.seed(9)
+        results = pool.map([(8,), (10,)])
+        np.random.seed(9)
+        _assert_same_slices(results, map_serial(_make_slice, [(8,), (10,)]))
+    finally:
+        pool.close()
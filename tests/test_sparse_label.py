@@ -0,0 +1,82 @@
+# --------------------------------------------------------
+# Deformable Convolutional Networks
+# Copyright (c) 2017 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+import numpy as np
+import numpy.random as npr
+import pytest
+from easydict import EasyDict as edict
+
+mx = pytest.importorskip('mxnet')
+import operator_py.rpn_sparse_label
+from core.metric import RPNAccMetric, RPNLogLossMetric
+from rpn.rpn import assign_pyramid_anchor
+
+STRIDES = (4, 8, 16, 32)
+
+
+def _rpn_config(batch_size, sparse):
+    return edict({'CROP_NUM': 2, 'TRAIN': {
+        'RPN_BATCH_SIZE': batch_size, 'RPN_FG_FRACTION': 0.5, 'RPN_POSITIVE_OVERLAP': 0.5,
+        'RPN_NEGATIVE_OVERLAP': 0.3, 'RPN_CLOBBER_POSITIVES': False, 'RPN_BBOX_WEIGHTS': (1.0, 1.0, 1.0, 1.0),
+        'RPN_OVERLAPS_KERNEL': 'dense', 'RPN_LABEL_CACHE': '', 'RPN_SPARSE_LABEL': sparse}})
+
+
+def _batch_labels(batch_size, sparse, seed, height=64, width=96):
+    """ rpn labels of two images stacked as the anchor loader does, the second one without gt boxes """
+    rng = np.random.RandomState(0)
+    feat_shapes = [[(1, 1, height // s, width // s)] for s in STRIDES]
+    im_info = np.array([[height, width, 1.0]], dtype=np.float32)
+    gt_boxes = np.array([[10, 8, 40, 30, 1, 0], [50, 20, 90, 60, 1, 2], [5, 30, 25, 62, 1, 2]], dtype=np.float32)
+    npr.seed(seed)
+    labels = [assign_pyramid_anchor(feat_shapes, boxes, im_info, _rpn_config(batch_size, sparse),
+                                    feat_strides=STRIDES, scales=(4,), ratios=(0.5, 1, 2))
+              for boxes in (gt_boxes, np.zeros((0, 6), dtype=np.float32))]
+    return dict((k, np.vstack([label[k] for label in labels])) for k in labels[0])
+
+
+def _densify(sparse, dense):
+    outputs = mx.nd.Custom(*[mx.nd.array(sparse[k], dtype=sparse[k].dtype) for k in
+                             ('label', 'bbox_target', 'bbox_weight', 'label_ind', 'bbox_ind')] +
+                           [mx.nd.zeros((dense['label'].shape[0], 2, dense['label'].shape[1])),
+                            mx.nd.zeros(dense['bbox_target'].shape)], op_type='rpn_sparse_label')
+    return dict(zip(('label', 'bbox_target', 'bbox_weight'), [x.asnumpy() for x in outputs]))
+
+
+@pytest.mark.parametrize('batch_size', [64, 20000])
+def test_sparse_label_op_densifies_to_dense_labels(batch_size):
+    for seed in range(3):
+        dense = _batch_labels(batch_size, False, seed)
+        sparse = _batch_labels(batch_size, True, seed)
+        assert sparse['label'].shape == (2, batch_size)
+        if batch_size > dense['label'].shape[1]:
+            # fewer anchors than entries, the padding points at the spare slot past the last anchor
+            padding = sparse['label'] == -1
+            assert padding.any(axis=1).all()
+            assert np.all(sparse['label_ind'][padding] == dense['label'].shape[1])
+            assert np.all(sparse['bbox_ind'][padding] == dense['bbox_target'][0].size)
+        densified = _densify(sparse, dense)
+        for k in ('label', 'bbox_target', 'bbox_weight'):
+            assert densified[k].shape == dense[k].shape
+            assert np.array_equal(densified[k], dense[k])
+
+
+@pytest.mark.parametrize('batch_size', [64, 20000])
+def test_sparse_rpn_metrics_match_dense(batch_size):
+    rng = np.random.RandomState(1)
+    dense = _batch_labels(batch_size, False, 0)
+    sparse = _batch_labels(batch_size, True, 0)
+    # rpn_cls_prob (b, 2, p) of SoftmaxOutput
+    fg = rng.rand(dense['label'].shape[0], dense['label'].shape[1]).astype(np.float32)
+    preds = [mx.nd.array(np.stack((1 - fg, fg), axis=1)), mx.nd.zeros(dense['bbox_target'].shape)]
+    dense_labels = [mx.nd.array(dense[k]) for k in ('label', 'bbox_target', 'bbox_weight')]
+    sparse_labels = [mx.nd.array(sparse[k], dtype=sparse[k].dtype)
+                     for k in ('label', 'bbox_target', 'bbox_weight', 'label_ind', 'bbox_ind')]
+    for metric in (RPNAccMetric, RPNLogLossMetric):
+        dense_metric, sparse_metric = metric(), metric(sparse_label=True)
+        dense_metric.update(dense_labels, preds)
+        sparse_metric.update(sparse_labels, preds)
+        assert dense_metric.num_inst == sparse_metric.num_inst > 0
+        np.testing.assert_allclose(sparse_metric.sum_metric, dense_metric.sum_metric, rtol=1e-6)
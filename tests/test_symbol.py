@@ -0,0 +1,25 @@
+# --------------------------------------------------------
+# Deformable Convolutional Networks
+# Copyright (c) 2017 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+import numpy as np
+import pytest
+
+mx = pytest.importorskip('mxnet')
+from symbols.resnet_v1_101_fpn_rcnn_l2_focal import resnet_v1_101_fpn_rcnn_l2_focal
+from utils.image import transform_crop
+
+
+def test_normalized_data_matches_transform_crop():
+    """ uint8 tiles as get_crop_image ships them with DEVICE_NORMALIZE, normalized on the cpu """
+    rng = np.random.RandomState(0)
+    pixel_means = np.array([103.06, 115.90, 123.15])
+    ims = [rng.randint(0, 256, (45, 61, 27)).astype(np.uint8) for _ in range(2)]
+    data = np.vstack([im.transpose((2, 0, 1))[np.newaxis] for im in ims])
+    sym = resnet_v1_101_fpn_rcnn_l2_focal().get_normalized_data(mx.sym.Variable('data'), pixel_means)
+    executor = sym.bind(mx.cpu(), {'data': mx.nd.array(data, dtype=np.uint8)})
+    normalized = executor.forward()[0].asnumpy()
+    assert normalized.dtype == np.float32 and normalized.shape == (2, 27, 45, 61)
+    np.testing.assert_array_equal(normalized, np.vstack([transform_crop(im, pixel_means) for im in ims]))
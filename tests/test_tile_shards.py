@@ -0,0 +1,69 @@
+# --------------------------------------------------------
+# Deformable Convolutional Networks
+# Copyright (c) 2017 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+import cv2
+import numpy as np
+import pytest
+from easydict import EasyDict as edict
+
+from utils.image import load_crop_image, get_crop_rec
+from utils.tile_shards import write_tile_shards, TileShardReader, SHARD_REC_FIELDS
+
+
+def _shard_config(path='', n=3, pipeline='crop_first'):
+    return edict({'CROP_NUM': n, 'CROP_PIPELINE': pipeline, 'SCALES': [(300, 500), (150, 250)],
+                  'TILE_SHARD_PATH': path, 'network': {'IMAGE_STRIDE': 32}})
+
+
+def _roidb(tmpdir, rng):
+    roidb = []
+    for i, (height, width) in enumerate(((240, 320), (200, 260))):
+        path = str(tmpdir.join('im%d.png' % i))
+        cv2.imwrite(path, rng.randint(0, 256, (height, width, 3)).astype(np.uint8))
+        boxes = np.array([[10, 20, 60, 90], [width // 2, height // 2, width // 2 + 30, height // 2 + 25]],
+                         dtype=np.uint16)
+        gt_overlaps = np.zeros((2, 3), dtype=np.float32)
+        gt_overlaps[:, 1] = 1
+        rec = {'image': path, 'height': height, 'width': width, 'boxes': boxes, 'gt_classes': np.array([1, 1]),
+               'gt_overlaps': gt_overlaps, 'max_classes': np.array([1, 1]), 'max_overlaps': np.ones(2)}
+        flipped = dict(rec, flipped=True, boxes=np.vstack((width - boxes[:, 2] - 1, boxes[:, 1],
+                                                           width - boxes[:, 0] - 1, boxes[:, 3])).transpose())
+        roidb += [dict(rec, flipped=False), flipped]
+    return roidb
+
+
+@pytest.mark.parametrize('pipeline', ['crop_first', 'resize_first'])
+def test_shards_read_back_the_crop_pipeline(tmpdir, pipeline):
+    rng = np.random.RandomState(0)
+    roidb = _roidb(tmpdir, rng)
+    shard_path = str(tmpdir.join('shards'))
+    config = _shard_config(shard_path, pipeline=pipeline)
+    # small shards, every image starts a new one
+    num_shards = write_tile_shards(roidb, config, shard_path, shard_bytes=1 << 16)
+    assert num_shards == len(roidb) * len(config.SCALES)
+
+    reader = TileShardReader(shard_path, config)
+    for roi_rec in roidb:
+        for scale_ind, scale in enumerate(config.SCALES):
+            im, new_rec = reader.get(roi_rec, scale)
+            expected_im, im_scale, grid = load_crop_image(roi_rec, scale_ind, config)
+            expected_rec = get_crop_rec(roi_rec, expected_im.shape, im_scale, grid, config)
+            assert im.dtype == np.uint8 and not im.flags.writeable
+            assert np.array_equal(im, expected_im)
+            for k in SHARD_REC_FIELDS:
+                assert np.array_equal(new_rec[k], expected_rec[k])
+            assert new_rec['image'] == roi_rec['image'] and new_rec['flipped'] == roi_rec['flipped']
+    assert reader.get(dict(roidb[0], image='missing.png'), config.SCALES[0]) is None
+    assert reader.get(roidb[0], (600, 1000)) is None
+
+
+def test_reader_refuses_other_settings(tmpdir):
+    rng = np.random.RandomState(1)
+    shard_path = str(tmpdir.join('shards'))
+    write_tile_shards(_roidb(tmpdir, rng)[:1], _shard_config(shard_path), shard_path)
+    for config in (_shard_config(shard_path, n=4), _shard_config(shard_path, pipeline='resize_first')):
+        with pytest.raises(AssertionError):
+            TileShardReader(shard_path, config)